@@ -72,6 +72,24 @@ class ApplicationScoresAdmin(admin.ModelAdmin):
     list_filter = ('application', 'a1', 'a2', 'a3', 'a4', 'a5', 'a6', 'a7')
 
 
+@admin.register(models.ScoringCoefficients)
+class ScoringCoefficientsAdmin(admin.ModelAdmin):
+    list_display = ('id', 'k1', 'k2', 'k3', 'k4', 'k5', 'k6', 'k7', 'create_date')
+
+
+@admin.register(models.ApplicationRank)
+class ApplicationRankAdmin(admin.ModelAdmin):
+    list_display = ('application', 'direction', 'draft_year', 'draft_season', 'rank', 'final_score', 'score_bucket')
+    list_filter = ('draft_year', 'draft_season', 'direction')
+
+
+@admin.register(models.MasterApplicationState)
+class MasterApplicationStateAdmin(admin.ModelAdmin):
+    list_display = ('master', 'application', 'is_booked', 'is_booked_our', 'can_unbook', 'wishlist_len',
+                    'is_in_wishlist', 'is_viewed')
+    list_filter = ('master',)
+
+
 @admin.register(models.AdditionField)
 class AdditionFieldAdmin(admin.ModelAdmin):
     list_display = ('name',)
@@ -112,3 +130,9 @@ class WorkGroupAdmin(admin.ModelAdmin):
 @admin.register(models.ViewedApplication)
 class ViewedApplicationAdmin(admin.ModelAdmin):
     list_display = ('member', 'application')
+
+
+@admin.register(models.ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('document_type', 'member', 'status', 'create_date', 'finish_date')
+    list_filter = ('document_type', 'status')
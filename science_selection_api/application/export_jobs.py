@@ -0,0 +1,253 @@
+"""
+Фоновые выгрузки файлов.
+
+Выгрузка выполняется в пуле потоков повторным вызовом синхронного эндпоинта выгрузки с сохраненными query параметрами
+от имени мастера, поэтому фильтры, права и форматы файла совпадают с обычной выгрузкой. Готовый файл сохраняется
+в MEDIA_ROOT/exports под ключом - хешем типа документа, параметров, принадлежностей мастера и версии данных
+(DataVersion), и отдается повторным выгрузкам с тем же ключом, пока данные не изменятся.
+
+Когда выгрузка сохраняет новый файл, прежние выгрузки мастера с теми же параметрами по устаревшим данным удаляются
+вместе с файлами. Выгрузки старше EXPORT_RESULTS_MAX_AGE часов и файлы без выгрузок удаляет команда cleanup_exports.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import unquote
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.http import HttpRequest, QueryDict
+from django.urls import reverse, resolve
+from django.utils import timezone
+
+from account.models import Affiliation
+from .models import ExportJob, DataVersion
+
+logger = logging.getLogger(__name__)
+
+# эндпоинты синхронной выгрузки документов
+EXPORT_URL_NAMES = {
+    'applications': 'application-export-applications-list',
+    'working-list': 'working-export-working-list',
+    'service-document': 'download-file',
+}
+# папка результатов выгрузок в MEDIA_ROOT
+EXPORT_DIR = 'exports'
+
+
+def get_export_key(member, document_type, params):
+    """
+    Возвращает ключ результата выгрузки
+    :param member: экземпляр Member мастера
+    :param document_type: тип документа
+    :param params: query параметры выгрузки
+    :return: sha256 от типа документа, параметров, принадлежностей мастера и версии данных
+    """
+    data_version = DataVersion.get()
+    affiliations = sorted(Affiliation.objects.filter(member=member).values_list('pk', flat=True))
+    parts = [document_type, sorted(params.items()), affiliations,
+             data_version.version, data_version.update_date.timestamp()]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+
+def get_cached_result(key):
+    """
+    Возвращает готовую выгрузку с ключом key, файл которой еще существует
+    :param key: ключ результата
+    :return: экземпляр ExportJob или None
+    """
+    job = ExportJob.objects.filter(key=key, status=ExportJob.DONE).exclude(file='').order_by('-pk').first()
+    return job if job is not None and job.file.storage.exists(job.file.name) else None
+
+
+def set_result(job, file_name, filename, content_type):
+    """Отмечает выгрузку выполненной с результатом в файле file_name"""
+    job.file.name = file_name
+    job.filename = filename
+    job.content_type = content_type
+    job.status = ExportJob.DONE
+    job.error = ''
+    job.finish_date = timezone.now()
+
+
+def create_export_job(member, document_type, params):
+    """
+    Создает выгрузку. Если результат с тем же ключом уже есть, выгрузка сразу выполнена, иначе ставится в очередь.
+    :param member: экземпляр Member мастера
+    :param document_type: тип документа
+    :param params: query параметры выгрузки
+    :return: экземпляр ExportJob
+    """
+    job = ExportJob(member=member, document_type=document_type, params=params,
+                    key=get_export_key(member, document_type, params))
+    cached = get_cached_result(job.key)
+    if cached is not None:
+        set_result(job, cached.file.name, cached.filename, cached.content_type)
+    job.save()
+    if cached is None:
+        export_runner.submit(job.pk)
+        # без фонового режима выгрузка уже выполнена
+        job.refresh_from_db()
+    return job
+
+
+def get_export_response(job):
+    """
+    Вызывает синхронный эндпоинт выгрузки с параметрами выгрузки от имени мастера
+    :param job: экземпляр ExportJob
+    :return: ответ эндпоинта
+    """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.path = request.path_info = reverse(EXPORT_URL_NAMES[job.document_type])
+    request.GET = QueryDict(mutable=True)
+    for param, value in job.params.items():
+        request.GET.setlist(param, value if isinstance(value, list) else [value])
+    request.user = job.member.user
+    request._dont_enforce_csrf_checks = True
+    match = resolve(request.path_info)
+    return match.func(request, *match.args, **match.kwargs)
+
+
+def save_response(job, response):
+    """
+    Сохраняет файл из ответа эндпоинта выгрузки в MEDIA_ROOT/exports
+    :param job: экземпляр ExportJob
+    :param response: ответ эндпоинта выгрузки
+    """
+    disposition = re.search(r'filename="(.+)"', response.get('Content-Disposition', ''))
+    filename = unquote(disposition.group(1)) if disposition else job.document_type
+    file_name = f'{EXPORT_DIR}/{job.key}{os.path.splitext(filename)[1]}'
+    path = os.path.join(settings.MEDIA_ROOT, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # файл пишется под временным именем, чтобы параллельная выгрузка не отдала его недописанным
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            for part in response.streaming_content if response.streaming else [response.content]:
+                file.write(part)
+        os.replace(tmp_path, path)
+    finally:
+        response.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    set_result(job, file_name, filename, response['Content-Type'])
+
+
+def delete_export_jobs(jobs):
+    """
+    Удаляет выгрузки и их файлы, если на файлы не ссылаются оставшиеся выгрузки
+    :param jobs: queryset выгрузок
+    :return: количество удаленных выгрузок
+    """
+    file_names = set(jobs.exclude(file='').values_list('file', flat=True))
+    count = jobs.delete()[0]
+    file_names -= set(ExportJob.objects.filter(file__in=file_names).values_list('file', flat=True))
+    storage = ExportJob._meta.get_field('file').storage
+    for file_name in file_names:
+        storage.delete(file_name)
+    return count
+
+
+def delete_superseded_jobs(job):
+    """
+    Удаляет выполненные выгрузки мастера с теми же типом документа и параметрами, что и job, но по другим данным:
+    их результаты больше не отдаются повторным выгрузкам
+    :param job: выполненная выгрузка, экземпляр ExportJob
+    :return: количество удаленных выгрузок
+    """
+    others = ExportJob.objects.filter(member_id=job.member_id, document_type=job.document_type, status=ExportJob.DONE) \
+        .exclude(key=job.key).only('pk', 'params')
+    superseded = [other.pk for other in others if other.params == job.params]
+    return delete_export_jobs(ExportJob.objects.filter(pk__in=superseded)) if superseded else 0
+
+
+def cleanup_exports(max_age=None):
+    """
+    Удаляет выгрузки, созданные больше max_age часов назад, с их файлами, а также файлы в MEDIA_ROOT/exports
+    старше max_age часов, на которые не ссылается ни одна выгрузка (например, недописанные временные файлы)
+    :param max_age: возраст в часах (по умолчанию - EXPORT_RESULTS_MAX_AGE)
+    :return: кортеж (количество удаленных выгрузок, количество удаленных файлов без выгрузок)
+    """
+    max_age = settings.EXPORT_RESULTS_MAX_AGE if max_age is None else max_age
+    count = delete_export_jobs(ExportJob.objects.filter(create_date__lt=timezone.now() - timedelta(hours=max_age)))
+    export_dir = os.path.join(settings.MEDIA_ROOT, EXPORT_DIR)
+    if not os.path.isdir(export_dir):
+        return count, 0
+    used = {os.path.basename(name) for name in ExportJob.objects.exclude(file='').values_list('file', flat=True)}
+    min_mtime = time.time() - max_age * 3600
+    orphans = [entry.path for entry in os.scandir(export_dir)
+               if entry.is_file() and entry.name not in used and entry.stat().st_mtime < min_mtime]
+    for path in orphans:
+        os.remove(path)
+    return count, len(orphans)
+
+
+def run_export_job(job_id):
+    """
+    Выполняет выгрузку и сохраняет ее результат или ошибку
+    :param job_id: id выгрузки
+    """
+    job = ExportJob.objects.select_related('member__user').get(pk=job_id)
+    cached = get_cached_result(job.key)
+    if cached is not None:
+        set_result(job, cached.file.name, cached.filename, cached.content_type)
+        job.save()
+        return
+    ExportJob.objects.filter(pk=job_id).update(status=ExportJob.RUNNING)
+    try:
+        response = get_export_response(job)
+        if response.status_code != 200:
+            content = response.render().content if hasattr(response, 'render') else response.content
+            raise ValueError(f'{response.status_code}: {content.decode()}')
+        save_response(job, response)
+    except Exception as e:
+        logger.exception(f'Не удалось выполнить выгрузку {job_id}')
+        job.status = ExportJob.FAILED
+        job.error = str(e)
+        job.finish_date = timezone.now()
+    job.save()
+    if job.status == ExportJob.DONE:
+        delete_superseded_jobs(job)
+
+
+class ExportJobRunner:
+    """Выполнение выгрузок в локальном пуле потоков (в запросе, если EXPORT_JOBS_BACKGROUND выключен)"""
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def submit(self, job_id):
+        """
+        Ставит выгрузку в очередь пула после фиксации транзакции, в которой она создана
+        :param job_id: id выгрузки
+        """
+        if not settings.EXPORT_JOBS_BACKGROUND:
+            run_export_job(job_id)
+            return
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=settings.EXPORT_JOBS_WORKERS,
+                                                   thread_name_prefix='export-job')
+        transaction.on_commit(lambda: self.executor.submit(self.run, job_id))
+
+    @staticmethod
+    def run(job_id):
+        """Выполняет выгрузку в потоке пула"""
+        close_old_connections()
+        try:
+            run_export_job(job_id)
+        except Exception:
+            logger.exception(f'Не удалось выполнить выгрузку {job_id}')
+        finally:
+            close_old_connections()
+
+
+export_runner = ExportJobRunner()
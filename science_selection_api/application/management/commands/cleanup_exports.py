@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from application.export_jobs import cleanup_exports
+
+
+class Command(BaseCommand):
+    help = 'Удаляет выгрузки старше EXPORT_RESULTS_MAX_AGE часов с их файлами и файлы выгрузок без выгрузок'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=float, default=None,
+                            help=f'Возраст в часах (по умолчанию {settings.EXPORT_RESULTS_MAX_AGE})')
+
+    def handle(self, *args, **options):
+        jobs, files = cleanup_exports(options['max_age'])
+        self.stdout.write(self.style.SUCCESS(f'Удалено выгрузок: {jobs}, файлов без выгрузок: {files}'))
@@ -0,0 +1,16 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from application.models import MasterApplicationState, DataVersion
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает флаги бронирования, избранного и просмотра заявок для всех мастеров'
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        MasterApplicationState.rebuild()
+        DataVersion.bump()
+        self.stdout.write(self.style.SUCCESS(f'Строк состояний: {MasterApplicationState.objects.count()} '
+                                             f'за {time.monotonic() - start:.2f} с'))
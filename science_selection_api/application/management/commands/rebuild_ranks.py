@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from application.models import Application, ApplicationRank, DataVersion
+from utils.calculations import get_current_draft_year
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинги направлений призыва по сохраненным итоговым баллам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, help='Год призыва (по умолчанию - текущий)')
+        parser.add_argument('--season', type=int, choices=[season for season, _ in Application.season],
+                            help='Сезон призыва (по умолчанию - текущий)')
+        parser.add_argument('--all', action='store_true', help='Пересчитать рейтинги всех призывов')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            ApplicationRank.rebuild_for(Application.objects.all())
+        else:
+            current_year, current_season = get_current_draft_year()
+            ApplicationRank.rebuild(options['year'] or current_year, options['season'] or current_season[0])
+        DataVersion.bump()
+        self.stdout.write(self.style.SUCCESS(f'Мест в рейтингах: {ApplicationRank.objects.count()}'))
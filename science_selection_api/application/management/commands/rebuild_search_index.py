@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from application.models import Application, DataVersion
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает поисковые документы заявок и поисковый индекс'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Количество заявок в пачке')
+
+    def handle(self, *args, **options):
+        application_ids = list(Application.objects.order_by('pk').values_list('pk', flat=True))
+        chunk_size = options['chunk_size']
+        count = 0
+        for start in range(0, len(application_ids), chunk_size):
+            count += len(Application.objects.filter(pk__in=application_ids[start:start + chunk_size])
+                         .update_search_documents())
+        DataVersion.bump()
+        self.stdout.write(self.style.SUCCESS(f'Обновлено поисковых документов: {count}'))
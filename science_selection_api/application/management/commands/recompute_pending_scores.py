@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from application.workers import recompute_pending_scores
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает баллы заявок, фоновый пересчет которых не был выполнен (флаг scores_pending)'
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        count = recompute_pending_scores()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано заявок: {count} за {time.monotonic() - start:.2f} с'))
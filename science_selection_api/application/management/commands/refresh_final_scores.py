@@ -0,0 +1,17 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from application.scoring import refresh_stale_final_scores
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает итоговые баллы заявок, посчитанные по устаревшей версии весовых коэффициентов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Размер пачки при записи в БД')
+
+    def handle(self, *args, **options):
+        start = time.monotonic()
+        count = refresh_stale_final_scores(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано заявок: {count} за {time.monotonic() - start:.2f} с'))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from application.models import Application
+from application.scoring import rescore_applications
+from utils.calculations import get_current_draft_year
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает оценки, заполненность и итоговые баллы заявок призыва'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--year', type=int, help='Год призыва (по умолчанию - текущий)')
+        parser.add_argument('--season', type=int, choices=[season for season, _ in Application.season],
+                            help='Сезон призыва (по умолчанию - текущий)')
+        parser.add_argument('--all', action='store_true', help='Пересчитать заявки всех призывов')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Размер пачки при записи в БД')
+
+    def handle(self, *args, **options):
+        applications = Application.objects.all()
+        if not options['all']:
+            current_year, current_season = get_current_draft_year()
+            applications = applications.filter(draft_year=options['year'] or current_year,
+                                               draft_season=options['season'] or current_season[0])
+        start = time.monotonic()
+        count = rescore_applications(applications, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано заявок: {count} за {time.monotonic() - start:.2f} с'))
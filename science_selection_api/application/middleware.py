@@ -0,0 +1,12 @@
+from .models import DataVersion
+
+
+class DataVersionMiddleware:
+    """Увеличивает версию данных заявок (DataVersion) один раз за запрос, а не при каждом изменении модели"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with DataVersion.defer_bumps():
+            return self.get_response(request)
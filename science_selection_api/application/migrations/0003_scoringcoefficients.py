@@ -0,0 +1,47 @@
+# Generated by Django 4.0.2 on 2026-10-16 23:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from utils.constants import MEANING_COEFFICIENTS
+
+
+def create_initial_coefficients(apps, schema_editor):
+    """Создает первую версию коэффициентов из значений переменных окружения"""
+    ScoringCoefficients = apps.get_model('application', 'ScoringCoefficients')
+    ScoringCoefficients.objects.create(**MEANING_COEFFICIENTS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0002_viewedapplication'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScoringCoefficients',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('k1', models.FloatField(verbose_name='Коэффициент k1')),
+                ('k2', models.FloatField(verbose_name='Коэффициент k2')),
+                ('k3', models.FloatField(verbose_name='Коэффициент k3')),
+                ('k4', models.FloatField(verbose_name='Коэффициент k4')),
+                ('k5', models.FloatField(verbose_name='Коэффициент k5')),
+                ('k6', models.FloatField(verbose_name='Коэффициент k6')),
+                ('k7', models.FloatField(verbose_name='Коэффициент k7')),
+                ('create_date', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Весовые коэффициенты итоговой оценки',
+                'verbose_name_plural': 'Весовые коэффициенты итоговой оценки',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='coefficients',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='applications', to='application.scoringcoefficients', verbose_name='Версия коэффициентов итоговой оценки'),
+        ),
+        migrations.RunPython(create_initial_coefficients, migrations.RunPython.noop),
+    ]
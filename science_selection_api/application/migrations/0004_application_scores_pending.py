@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-16 23:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0003_scoringcoefficients'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='scores_pending',
+            field=models.BooleanField(default=False, verbose_name='Баллы ожидают фонового пересчета'),
+        ),
+    ]
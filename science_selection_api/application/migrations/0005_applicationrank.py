@@ -0,0 +1,62 @@
+# Generated by Django 4.0.2 on 2026-10-16 23:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+from utils.constants import RANK_SCORE_BUCKET_SIZE
+
+
+def fill_ranks(apps, schema_editor):
+    """Заполняет рейтинги направлений всех призывов по сохраненным итоговым баллам"""
+    Application = apps.get_model('application', 'Application')
+    ApplicationRank = apps.get_model('application', 'ApplicationRank')
+    rows = Application.directions.through.objects.annotate(rank=Window(
+        RowNumber(), partition_by=[F('application__draft_year'), F('application__draft_season'), F('direction_id')],
+        order_by=[F('application__final_score').desc(), F('application_id').asc()])) \
+        .values_list('application_id', 'direction_id', 'application__draft_year', 'application__draft_season',
+                     'application__final_score', 'rank')
+    ApplicationRank.objects.bulk_create([
+        ApplicationRank(application_id=application_id, direction_id=direction_id, draft_year=draft_year,
+                        draft_season=draft_season, final_score=final_score,
+                        score_bucket=int(final_score // RANK_SCORE_BUCKET_SIZE), rank=rank)
+        for application_id, direction_id, draft_year, draft_season, final_score, rank in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0004_application_scores_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApplicationRank',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('draft_year', models.PositiveIntegerField(verbose_name='Год призыва')),
+                ('draft_season', models.IntegerField(choices=[(1, 'Весна'), (2, 'Осень')], verbose_name='Сезон призыва')),
+                ('final_score', models.FloatField(verbose_name='Итоговая оценка заявки')),
+                ('score_bucket', models.IntegerField(verbose_name='Интервал итоговой оценки')),
+                ('rank', models.PositiveIntegerField(verbose_name='Место в рейтинге')),
+                ('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ranks', to='application.application', verbose_name='Заявка')),
+                ('direction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='application_ranks', to='application.direction', verbose_name='Направление')),
+            ],
+            options={
+                'verbose_name': 'Место в рейтинге',
+                'verbose_name_plural': 'Места в рейтинге',
+                'ordering': ['draft_year', 'draft_season', 'direction', 'rank'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='applicationrank',
+            index=models.Index(fields=['draft_year', 'draft_season', 'direction', 'rank'], name='application_draft_y_b563f7_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='applicationrank',
+            unique_together={('application', 'direction')},
+        ),
+        migrations.RunPython(fill_ranks, migrations.RunPython.noop),
+    ]
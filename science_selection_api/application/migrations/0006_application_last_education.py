@@ -0,0 +1,65 @@
+# Generated by Django 4.0.2 on 2026-10-16 23:55
+
+from django.db import migrations, models
+
+SNAPSHOT_FIELDS = {'education_type': 'last_education_type', 'university': 'last_education_university',
+                   'specialization': 'last_education_specialization', 'avg_score': 'last_education_avg_score',
+                   'end_year': 'last_education_end_year', 'is_ended': 'last_education_is_ended'}
+
+
+def fill_last_education(apps, schema_editor):
+    """Заполняет копию последнего образования заявок"""
+    Application = apps.get_model('application', 'Application')
+    Education = apps.get_model('application', 'Education')
+    snapshots = {}
+    educations = Education.objects.order_by('application_id', '-end_year', 'pk').values('application_id',
+                                                                                         *SNAPSHOT_FIELDS)
+    for education in educations.iterator():
+        snapshots.setdefault(education['application_id'], education)
+    applications = list(Application.objects.filter(pk__in=snapshots).only('pk'))
+    for application in applications:
+        for education_field, field in SNAPSHOT_FIELDS.items():
+            setattr(application, field, snapshots[application.pk][education_field])
+    Application.objects.bulk_update(applications, list(SNAPSHOT_FIELDS.values()), batch_size=1000)
+
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0005_applicationrank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='last_education_avg_score',
+            field=models.FloatField(blank=True, null=True, verbose_name='Средний балл последнего образования'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='last_education_end_year',
+            field=models.IntegerField(blank=True, null=True, verbose_name='Год окончания последнего образования'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='last_education_is_ended',
+            field=models.BooleanField(default=False, verbose_name='Последнее образование окончено'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='last_education_specialization',
+            field=models.CharField(blank=True, max_length=256, verbose_name='Специальность последнего образования'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='last_education_type',
+            field=models.CharField(blank=True, choices=[('b', 'Бакалавриат'), ('m', 'Магистратура'), ('a', 'Аспирантура'), ('s', 'Специалитет')], max_length=1, verbose_name='Программа последнего образования'),
+        ),
+        migrations.AddField(
+            model_name='application',
+            name='last_education_university',
+            field=models.CharField(blank=True, max_length=256, verbose_name='Университет последнего образования'),
+        ),
+        migrations.RunPython(fill_last_education, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.2 on 2026-10-17 00:06
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0002_initial'),
+        ('application', '0006_application_last_education'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MasterApplicationState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_booked', models.BooleanField(default=False, verbose_name='Заявка отобрана')),
+                ('is_booked_our', models.BooleanField(default=False, verbose_name='Отобрана на принадлежность мастера')),
+                ('can_unbook', models.BooleanField(default=False, verbose_name='Мастер может отменить отбор')),
+                ('wishlist_len', models.PositiveIntegerField(default=0, verbose_name='Количество добавлений в избранное')),
+                ('is_in_wishlist', models.BooleanField(default=False, verbose_name='В избранном принадлежности мастера')),
+                ('is_viewed', models.BooleanField(default=False, verbose_name='Просмотрена мастером')),
+                ('application', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='master_states', to='application.application', verbose_name='Заявка')),
+                ('master', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='application_states', to='account.member', verbose_name='Мастер')),
+            ],
+            options={
+                'verbose_name': 'Состояние заявки для мастера',
+                'verbose_name_plural': 'Состояния заявок для мастеров',
+                'unique_together': {('master', 'application')},
+            },
+        ),
+    ]
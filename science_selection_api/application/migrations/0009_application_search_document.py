@@ -0,0 +1,69 @@
+# Generated by Django 4.0.2 on 2026-10-17 00:19
+
+from django.db import migrations, models
+
+SEARCH_TABLE = 'application_search'
+TRIGRAM_INDEX = 'application_search_document_trgm'
+
+
+def create_search_index(apps, schema_editor):
+    """Создает таблицу FTS5 в SQLite или триграммный GIN индекс в PostgreSQL"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(search_document, tokenize='trigram')")
+    elif vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(f'CREATE INDEX {TRIGRAM_INDEX} ON application_application '
+                              f'USING gin (search_document gin_trgm_ops)')
+
+
+def drop_search_index(apps, schema_editor):
+    """Удаляет поисковый индекс"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+    elif vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {TRIGRAM_INDEX}')
+
+
+def fill_search_documents(apps, schema_editor):
+    """Заполняет поисковые документы заявок и таблицу FTS5"""
+    Application = apps.get_model('application', 'Application')
+    Education = apps.get_model('application', 'Education')
+    MilitaryCommissariat = apps.get_model('application', 'MilitaryCommissariat')
+    subjects = dict(MilitaryCommissariat.objects.values_list('name', 'subject'))
+    educations = {}
+    for application_id, *values in Education.objects.order_by('pk').values_list('application_id', 'university',
+                                                                                   'specialization'):
+        educations.setdefault(application_id, []).extend(values)
+    applications = []
+    for application in Application.objects.select_related('member__user').only(
+            'pk', 'birth_place', 'military_commissariat', 'member__father_name', 'member__user__first_name',
+            'member__user__last_name').iterator():
+        values = (application.member.user.last_name, application.member.user.first_name,
+                  application.member.father_name, application.birth_place,
+                  subjects.get(application.military_commissariat), *educations.get(application.pk, ()))
+        application.search_document = '\n'.join(str(value).lower() for value in values if value)
+        applications.append(application)
+    Application.objects.bulk_update(applications, ['search_document'], batch_size=1000)
+    if schema_editor.connection.vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(f'INSERT INTO {SEARCH_TABLE}(rowid, search_document) VALUES (%s, %s)',
+                               [(application.pk, application.search_document) for application in applications])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0008_dataversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Поисковый документ'),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(fill_search_documents, migrations.RunPython.noop),
+    ]
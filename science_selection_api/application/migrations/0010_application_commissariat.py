@@ -0,0 +1,29 @@
+# Generated by Django 4.0.2 on 2026-10-17 00:24
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def fill_commissariats(apps, schema_editor):
+    """Привязывает заявки к комиссариатам справочника по названию комиссариата"""
+    Application = apps.get_model('application', 'Application')
+    MilitaryCommissariat = apps.get_model('application', 'MilitaryCommissariat')
+    commissariat = MilitaryCommissariat.objects.filter(name=OuterRef('military_commissariat')).order_by('pk')
+    Application.objects.update(commissariat=Subquery(commissariat.values('pk')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0009_application_search_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='application',
+            name='commissariat',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='applications', to='application.militarycommissariat', verbose_name='Военный комиссариат из справочника'),
+        ),
+        migrations.RunPython(fill_commissariats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.0.2 on 2026-10-17 00:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('account', '0002_initial'),
+        ('application', '0010_application_commissariat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_type', models.CharField(choices=[('applications', 'Список заявок'), ('working-list', 'Рабочий лист'), ('service-document', 'Служебный документ')], max_length=32, verbose_name='Тип документа')),
+                ('params', models.JSONField(blank=True, default=dict, verbose_name='Query параметры выгрузки')),
+                ('key', models.CharField(db_index=True, max_length=64, verbose_name='Ключ результата')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Готово'), ('failed', 'Ошибка')], default='pending', max_length=16, verbose_name='Статус')),
+                ('file', models.FileField(blank=True, upload_to='exports', verbose_name='Файл')),
+                ('filename', models.CharField(blank=True, max_length=256, verbose_name='Имя файла для скачивания')),
+                ('content_type', models.CharField(blank=True, max_length=128, verbose_name='Тип содержимого файла')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('create_date', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('finish_date', models.DateTimeField(blank=True, null=True, verbose_name='Дата завершения')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to='account.member', verbose_name='Мастер')),
+            ],
+            options={
+                'verbose_name': 'Выгрузка',
+                'verbose_name_plural': 'Выгрузки',
+                'ordering': ['-create_date'],
+            },
+        ),
+    ]
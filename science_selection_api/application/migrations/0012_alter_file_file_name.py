@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-17 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('application', '0011_exportjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='file',
+            name='file_name',
+            field=models.CharField(blank=True, max_length=128, verbose_name='Название документа'),
+        ),
+    ]
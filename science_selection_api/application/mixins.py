@@ -1,9 +1,18 @@
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
 from django.shortcuts import redirect
+from django.utils.cache import get_conditional_response, patch_cache_control
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 
 from account.models import Affiliation
-from application.models import Competence, Direction
-from utils.exceptions import MasterHasNoDirectionsException
+from application.models import Competence, Direction, DataVersion
+from application.scoring import refresh_stale_applications, refresh_stale_rows
+from application.serializers import ApplicationListValues
+from application.utils import CursorPaginationApplication, is_master, iter_chunks, stream_json_list
+from utils.exceptions import MasterHasNoDirectionsException, NotModifiedException
 
 
 class PermissionPolicyMixin:
@@ -77,3 +86,204 @@ class DataApplicationMixin:
             item = [*old, affiliation] if old else [affiliation]
             master_directions_affiliations.update({affiliation.direction.id: item})
         return master_directions_affiliations
+
+
+class ActualFinalScoreMixin:
+    """
+    Пересчитывает итоговые баллы отдаваемых заявок, если они посчитаны по устаревшей версии весовых коэффициентов.
+    Пересчитываются только заявки текущей страницы, остальные (в том числе списки без пагинации) -
+    командой refresh_final_scores.
+    """
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is None:
+            return page
+        if page and isinstance(page[0], dict):
+            refresh_stale_rows(page)
+        else:
+            refresh_stale_applications(page)
+        return page
+
+    def get_object(self):
+        obj = super().get_object()
+        refresh_stale_applications([obj])
+        return obj
+
+
+class CursorPaginationMixin:
+    """
+    Позволяет списку переключаться на курсорную пагинацию query параметром pagination=cursor
+    (ссылки next и previous уже содержат курсор). По умолчанию используется pagination_class.
+    """
+    cursor_pagination_class = CursorPaginationApplication
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.action == 'list' and self.cursor_pagination_class.is_requested(self.request):
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = self.pagination_class() if self.pagination_class is not None else None
+        return self._paginator
+
+
+class SparseFieldsetMixin:
+    """
+    Позволяет списку отдавать только часть полей query параметрами fields (только перечисленные поля)
+    или omit (все поля, кроме перечисленных), например ?fields=id,member,final_score.
+    Запрошенные поля передаются в контекст сериализатора и возвращаются get_sparse_fields,
+    чтобы get_queryset не загружал данные для полей, которые не будут отданы.
+    """
+    fields_query_param = 'fields'
+    omit_query_param = 'omit'
+
+    def get_query_param_fields(self, param, available_fields):
+        """
+        Возвращает поля, перечисленные через запятую в query параметре
+        :param param: название query параметра
+        :param available_fields: поля сериализатора
+        :return: множество полей или None, если параметр не передан
+        """
+        value = self.request.query_params.get(param)
+        if value is None:
+            return None
+        fields = {field.strip() for field in value.split(',') if field.strip()}
+        unknown = fields - set(available_fields)
+        if unknown:
+            raise ValidationError({param: f'Неизвестные поля: {", ".join(sorted(unknown))}'})
+        return fields
+
+    def get_sparse_fields(self):
+        """
+        Возвращает поля сериализатора списка, запрошенные параметрами fields и omit
+        :return: кортеж полей в порядке сериализатора или None, если нужны все поля
+        """
+        if not hasattr(self, '_sparse_fields'):
+            self._sparse_fields = None
+            if self.action == 'list':
+                available_fields = self.get_serializer_class().Meta.fields
+                fields = self.get_query_param_fields(self.fields_query_param, available_fields)
+                omit = self.get_query_param_fields(self.omit_query_param, available_fields)
+                if fields is not None or omit is not None:
+                    self._sparse_fields = tuple(field for field in available_fields
+                                                if (fields is None or field in fields) and field not in (omit or ()))
+        return self._sparse_fields
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.get_sparse_fields() is not None:
+            context['fields'] = self.get_sparse_fields()
+        return context
+
+
+class ApplicationListValuesMixin:
+    """
+    Отдает список заявок мастеру через ApplicationListValues: страница выбирается строками values(),
+    вложенные списки загружаются для страницы и собираются без экземпляров моделей и сериализаторов.
+    Ответ совпадает с ответом сериализатора списка. Включается настройкой APPLICATION_LIST_VALUES.
+    """
+
+    def use_list_values(self):
+        """Возвращает True, если список собирается через ApplicationListValues"""
+        return settings.APPLICATION_LIST_VALUES and is_master(self.request.user)
+
+    def get_list_values(self, **kwargs):
+        """Возвращает ApplicationListValues для полей, запрошенных в списке"""
+        return ApplicationListValues(self.request.user.member, self.get_master_affiliations(),
+                                     self.get_master_directions_id(), fields=self.get_sparse_fields(), **kwargs)
+
+    def get_values_queryset(self, queryset, list_values):
+        """Возвращает queryset строк values() с колонками, нужными list_values"""
+        return queryset.prefetch_related(None).values(*list_values.get_columns())
+
+    def list(self, request, *args, **kwargs):
+        if not self.use_list_values():
+            return super().list(request, *args, **kwargs)
+        list_values = self.get_list_values()
+        queryset = self.get_values_queryset(self.filter_queryset(self.get_queryset()), list_values)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(list_values.to_representation(page))
+        return Response(list_values.to_representation(list(queryset)))
+
+
+class StreamingListMixin(ApplicationListValuesMixin):
+    """
+    Отдает весь отфильтрованный список без пагинации по query параметру page_size=all.
+    Заявки читаются через iterator() пачками по stream_chunk_size, связанные данные загружаются для каждой пачки,
+    а JSON массив пишется в StreamingHttpResponse по мере сборки пачек, поэтому память не растет с размером списка.
+    """
+    stream_query_param = 'page_size'
+    stream_query_value = 'all'
+    stream_chunk_size = 500
+
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get(self.stream_query_param) != self.stream_query_value:
+            return super().list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        return StreamingHttpResponse(stream_json_list(self.iter_list_chunks(queryset)),
+                                     content_type='application/json')
+
+    def iter_list_chunks(self, queryset):
+        """
+        Возвращает представления заявок пачками
+        :param queryset: отфильтрованный queryset заявок
+        :return: генератор списков представлений заявок
+        """
+        if self.use_list_values():
+            list_values = self.get_list_values()
+            rows = self.get_values_queryset(queryset, list_values).iterator(chunk_size=self.stream_chunk_size)
+            for chunk in iter_chunks(rows, self.stream_chunk_size):
+                yield list_values.to_representation(chunk)
+            return
+        lookups = queryset._prefetch_related_lookups
+        for chunk in iter_chunks(queryset.iterator(chunk_size=self.stream_chunk_size), self.stream_chunk_size):
+            prefetch_related_objects(chunk, *lookups)
+            yield self.get_serializer(chunk, many=True).data
+
+
+class ConditionalGetMixin:
+    """
+    Поддерживает условные GET запросы (If-None-Match) к действиям conditional_actions.
+    ETag строится по счетчику изменений DataVersion, поэтому проверка стоит один запрос. Для списков она выполняется
+    после проверки прав, но до построения queryset: если данные не менялись, сразу отдается 304. ETag не зависит
+    от объекта, поэтому для действий с объектом 304 отдается только после его получения в get_object,
+    чтобы проверки прав на объект и 404 для несуществующих id не пропускались.
+    Last-Modified не отдается: его точность - секунда, и If-Modified-Since пропустил бы изменения в ту же секунду.
+    """
+    conditional_actions = ('list', 'retrieve')
+
+    def get_etag(self):
+        """
+        Возвращает ETag по текущей версии данных.
+        ETag зависит от пользователя, так как списки и флаги заявок у мастеров разные.
+        """
+        return f'"{DataVersion.get().version}-{self.request.user.pk}"'
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = None
+        if request.method in ('GET', 'HEAD') and self.action in self.conditional_actions:
+            self.etag = self.get_etag()
+            if not self.detail:
+                self.check_not_modified()
+
+    def get_object(self):
+        obj = super().get_object()
+        if getattr(self, 'etag', None) and self.detail:
+            self.check_not_modified()
+        return obj
+
+    def check_not_modified(self):
+        """Отдает 304, если ETag из If-None-Match совпадает с текущим"""
+        response = get_conditional_response(self.request, etag=self.etag)
+        if response is not None:
+            raise NotModifiedException(response)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code in (200, 304):
+            response['ETag'] = self.etag
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
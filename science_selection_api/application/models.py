@@ -1,11 +1,22 @@
 import datetime
-
-from django.db import models
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import models, transaction, connections
+from django.db.models import prefetch_related_objects, Exists, OuterRef, Case, When, Value, ExpressionWrapper, F, \
+    Q, Window, Subquery, Count, FilteredRelation
+from django.db.models.functions import Coalesce, RowNumber
 from django.core.exceptions import ValidationError
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 from utils import constants as const
-from account.models import Member, Affiliation
+from account.models import Member, Affiliation, Booking
+from .search import build_search_document, update_search_index, remove_from_search_index
 
 
 def validate_draft_year(value: int):
@@ -13,6 +24,40 @@ def validate_draft_year(value: int):
         raise ValidationError(_(f'Год призыва {value} раньше текущего'))
 
 
+class DirtyFieldsMixin:
+    """Отслеживает изменение полей tracked_fields с момента загрузки модели из БД или последнего сохранения"""
+    tracked_fields = ()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.reset_dirty_fields()
+        return instance
+
+    def reset_dirty_fields(self, fields=None):
+        """
+        Запоминает текущие значения отслеживаемых полей
+        :param fields: поля, значения которых нужно запомнить (по умолчанию - все отслеживаемые)
+        """
+        deferred = self.get_deferred_fields()
+        loaded_values = getattr(self, '_loaded_values', {})
+        loaded_values.update({field: getattr(self, field) for field in fields or self.tracked_fields
+                              if field in self.tracked_fields and field not in deferred})
+        self._loaded_values = loaded_values
+
+    def get_dirty_fields(self) -> set:
+        """Возвращает отслеживаемые поля, значения которых изменились. Для новой записи - все отслеживаемые поля"""
+        if self._state.adding or not hasattr(self, '_loaded_values'):
+            return set(self.tracked_fields)
+        return {field for field, value in self._loaded_values.items() if getattr(self, field) != value}
+
+    def save(self, *args, **kwargs):
+        """Сохраняет модель, запоминая в saved_dirty_fields поля, которые изменились"""
+        self.saved_dirty_fields = self.get_dirty_fields()
+        super().save(*args, **kwargs)
+        self.reset_dirty_fields(kwargs.get('update_fields'))
+
+
 class WorkGroup(models.Model):
     """Рабочая группа, в которую происходит распределение забронированных заявок"""
     name = models.CharField(max_length=256, verbose_name='Название рабочей группы')
@@ -28,7 +73,148 @@ class WorkGroup(models.Model):
         verbose_name_plural = 'Рабочие группы'
 
 
-class Application(models.Model):
+class ScoringCoefficients(models.Model):
+    """Версия весовых коэффициентов итоговой оценки заявки. Актуальной считается последняя созданная версия"""
+    k1 = models.FloatField(verbose_name='Коэффициент k1')
+    k2 = models.FloatField(verbose_name='Коэффициент k2')
+    k3 = models.FloatField(verbose_name='Коэффициент k3')
+    k4 = models.FloatField(verbose_name='Коэффициент k4')
+    k5 = models.FloatField(verbose_name='Коэффициент k5')
+    k6 = models.FloatField(verbose_name='Коэффициент k6')
+    k7 = models.FloatField(verbose_name='Коэффициент k7')
+    create_date = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = 'Весовые коэффициенты итоговой оценки'
+        verbose_name_plural = 'Весовые коэффициенты итоговой оценки'
+
+    def __str__(self):
+        return f'Версия {self.pk} от {self.create_date:%d.%m.%Y}'
+
+    @classmethod
+    def get_current(cls):
+        """
+        Возвращает актуальную версию коэффициентов.
+        Если версий нет, возвращает несохраненный экземпляр с коэффициентами из переменных окружения.
+        """
+        return cls.objects.order_by('-pk').first() or cls(**const.MEANING_COEFFICIENTS)
+
+    @classmethod
+    def get_current_id_subquery(cls):
+        """Возвращает подзапрос id актуальной версии коэффициентов для аннотаций"""
+        return Subquery(cls.objects.order_by('-pk').values('pk')[:1])
+
+    def as_dict(self):
+        """Возвращает коэффициенты в виде словаря {'k1': ..., 'k7': ...}"""
+        return {f'k{i}': getattr(self, f'k{i}') for i in range(1, 8)}
+
+
+class ApplicationQuerySet(models.QuerySet):
+    # аннотации заполненности блоков анкеты, кроме всегда заполненных основных данных
+    filled_blocks_annotations = ('has_education', 'has_directions', 'has_competencies', 'has_files')
+
+    def with_filled_blocks(self):
+        """Аннотирует заполненность блоков анкеты подзапросами Exists, без отдельных запросов на каждую заявку"""
+        return self.annotate(
+            has_education=Exists(Education.objects.filter(application=OuterRef('pk'))),
+            has_directions=Exists(Application.directions.through.objects.filter(application=OuterRef('pk'))),
+            has_competencies=Exists(ApplicationCompetencies.objects.filter(application=OuterRef('pk'))),
+            has_files=Exists(File.objects.filter(member=OuterRef('member'))),
+        )
+
+    def with_actual_fullness(self):
+        """Аннотирует actual_fullness - заполненность анкеты в %, рассчитанную одним SQL запросом для всех заявок"""
+        filled_blocks_count = Value(1)
+        for annotation in self.filled_blocks_annotations:
+            filled_blocks_count += Case(When(**{annotation: True}, then=Value(1)), default=Value(0))
+        return self.with_filled_blocks().annotate(actual_fullness=ExpressionWrapper(
+            filled_blocks_count * 100 / len(const.DEFAULT_FILED_BLOCKS), output_field=models.IntegerField()))
+
+    def with_booking_flags(self, member, master_affiliations, flags=None):
+        """
+        Аннотирует флаги бронирования, избранного и просмотра заявки для мастера: is_booked, is_booked_our,
+        can_unbook, wishlist_len, is_in_wishlist, is_viewed. Каждая аннотация - коррелированный подзапрос
+        Exists/Subquery, поэтому основной запрос не соединяется с бронированиями и не группируется.
+        :param member: экземпляр Member мастера
+        :param master_affiliations: принадлежности мастера
+        :param flags: аннотируемые флаги (по умолчанию - все)
+        """
+        booked = Booking.objects.filter(slave=OuterRef('member'), booking_type__name=const.BOOKED)
+        wishlist = Booking.objects.filter(slave=OuterRef('member'), booking_type__name=const.IN_WISHLIST)
+        annotations = {
+            'is_booked': Exists(booked),
+            'is_booked_our': Exists(booked.filter(affiliation__in=master_affiliations)),
+            'can_unbook': Exists(booked.filter(affiliation__in=master_affiliations, master=member)),
+            'wishlist_len': Coalesce(Subquery(wishlist.order_by().values('slave').annotate(count=Count('pk'))
+                                              .values('count')[:1], output_field=models.IntegerField()), Value(0)),
+            'is_in_wishlist': Exists(wishlist.filter(affiliation__in=master_affiliations)),
+            'is_viewed': Exists(ViewedApplication.objects.filter(application=OuterRef('pk'), member=member)),
+        }
+        return self.annotate(**{flag: annotation for flag, annotation in annotations.items()
+                                if flags is None or flag in flags})
+
+    def with_master_states(self, member, flags=None):
+        """
+        Аннотирует те же флаги, что и with_booking_flags, из таблицы MasterApplicationState одним соединением
+        по уникальному индексу (мастер, заявка). Отсутствие строки означает значения по умолчанию.
+        :param member: экземпляр Member мастера
+        :param flags: аннотируемые флаги (по умолчанию - все), если не нужен ни один, соединения не будет
+        """
+        flags = {flag: default for flag, default in MasterApplicationState.flags.items()
+                 if flags is None or flag in flags}
+        if not flags:
+            return self
+        return self.annotate(master_state=FilteredRelation('master_states', condition=Q(master_states__master=member))) \
+            .annotate(**{flag: Coalesce(F(f'master_state__{flag}'), Value(default)) for flag, default in flags.items()})
+
+    def with_current_coefficients(self):
+        """
+        Загружает версию коэффициентов заявки и аннотирует current_coefficients_id - id актуальной версии,
+        чтобы проверить актуальность итогового балла и пересчитать его без отдельного запроса коэффициентов
+        """
+        return self.select_related('coefficients') \
+            .annotate(current_coefficients_id=ScoringCoefficients.get_current_id_subquery())
+
+    def update_search_documents(self):
+        """
+        Пересобирает поисковые документы заявок (см. application.search) и обновляет поисковый индекс
+        :return: словарь {id заявки: поисковый документ}
+        """
+        rows = list(self.order_by().values_list(
+            'pk', 'member__user__last_name', 'member__user__first_name', 'member__father_name', 'birth_place',
+            'commissariat__subject'))
+        if not rows:
+            return {}
+        educations = {}
+        for application_id, *values in Education.objects.filter(application__in=[row[0] for row in rows]) \
+                .order_by('pk').values_list('application_id', 'university', 'specialization'):
+            educations.setdefault(application_id, []).extend(values)
+        documents = {pk: build_search_document((*values, *educations.get(pk, ()))) for pk, *values in rows}
+        Application.objects.bulk_update([Application(pk=pk, search_document=document)
+                                         for pk, document in documents.items()], ['search_document'], batch_size=1000)
+        update_search_index(connections[self.db], documents)
+        return documents
+
+    def with_calculated_final_score(self, coefficients=None):
+        """
+        Аннотирует score_a1..score_a7 - оценки по критериям и calculated_final_score - итоговый балл,
+        рассчитанный в БД по оценкам критериев и весовым коэффициентам. В отличие от сохраненного final_score
+        не зависит от того, пересчитана ли заявка, поэтому подходит для сортировки и фильтрации.
+        :param coefficients: экземпляр ScoringCoefficients (по умолчанию - актуальная версия)
+        """
+        if 'calculated_final_score' in self.query.annotations:
+            return self
+        coefficients = (coefficients or ScoringCoefficients.get_current()).as_dict()
+        final_score = Value(0.0)
+        for i, criterion in enumerate(const.SCORE_CRITERIA, 1):
+            final_score += F(f'score_{criterion}') * Value(coefficients[f'k{i}'])
+        return self.annotate(**{f'score_{criterion}': Coalesce(F(f'scores__{criterion}'), Value(0.0))
+                                for criterion in const.SCORE_CRITERIA}) \
+            .annotate(calculated_final_score=ExpressionWrapper(final_score, output_field=models.FloatField()))
+
+
+class Application(DirtyFieldsMixin, models.Model):
     """Заявка кандидата в операторы"""
     season = [
         (1, 'Весна'),
@@ -36,6 +222,19 @@ class Application(models.Model):
     ]
     hidden_fields = ['compliance_prior_direction', 'compliance_additional_direction',
                      'postgraduate_additional_direction', 'postgraduate_prior_direction']
+    # поля, при изменении которых меняются места заявки в рейтингах
+    rank_fields = {'final_score', 'draft_year', 'draft_season'}
+    # поля заявки, входящие в поисковый документ
+    search_document_fields = ('birth_place', 'commissariat_id', 'member_id')
+    # поля копии последнего образования {поле образования: поле заявки}
+    last_education_fields = {'education_type': 'last_education_type', 'university': 'last_education_university',
+                             'specialization': 'last_education_specialization',
+                             'avg_score': 'last_education_avg_score', 'end_year': 'last_education_end_year',
+                             'is_ended': 'last_education_is_ended'}
+    tracked_fields = (*sorted({field for fields_scores in (*const.CRITERIA_FIELDS_SCORES.values(),
+                                                          const.POSTGRADUATE_FIELDS_SCORES)
+                               for field in fields_scores}), 'fullness', 'final_score', 'coefficients_id',
+                      'draft_year', 'draft_season', *last_education_fields.values(), 'search_document')
 
     member = models.OneToOneField(Member, on_delete=models.CASCADE, verbose_name='Пользователь',
                                   related_name='application')
@@ -47,6 +246,10 @@ class Application(models.Model):
     birth_place = models.CharField(max_length=128, verbose_name='Место рождения', help_text='Область, город')
     nationality = models.CharField(max_length=128, verbose_name='Гражданство')
     military_commissariat = models.CharField(max_length=128, verbose_name='Военный комиссариат')
+    # комиссариат из справочника с тем же названием, обновляется при сохранении заявки и комиссариата
+    commissariat = models.ForeignKey('MilitaryCommissariat', on_delete=models.SET_NULL, blank=True, null=True,
+                                     editable=False, verbose_name='Военный комиссариат из справочника',
+                                     related_name='applications')
     group_of_health = models.CharField(max_length=32, verbose_name='Группа здоровья')
     draft_year = models.IntegerField(verbose_name='Год призыва', validators=[validate_draft_year])
     draft_season = models.IntegerField(choices=season, verbose_name='Сезон призыва')
@@ -72,6 +275,24 @@ class Application(models.Model):
     work_group = models.ForeignKey(WorkGroup, on_delete=models.SET_NULL, blank=True, null=True,
                                    verbose_name="Рабочая группа",
                                    related_name='application')
+    coefficients = models.ForeignKey(ScoringCoefficients, on_delete=models.SET_NULL, blank=True, null=True,
+                                     verbose_name='Версия коэффициентов итоговой оценки',
+                                     related_name='applications')
+    scores_pending = models.BooleanField(default=False, verbose_name='Баллы ожидают фонового пересчета')
+    # копия последнего образования, обновляется при сохранении и удалении образований заявки
+    last_education_type = models.CharField(choices=const.EDUCATION_PROGRAMS, max_length=1, blank=True,
+                                           verbose_name='Программа последнего образования')
+    last_education_university = models.CharField(max_length=256, blank=True,
+                                                 verbose_name='Университет последнего образования')
+    last_education_specialization = models.CharField(max_length=256, blank=True,
+                                                     verbose_name='Специальность последнего образования')
+    last_education_avg_score = models.FloatField(null=True, blank=True,
+                                                 verbose_name='Средний балл последнего образования')
+    last_education_end_year = models.IntegerField(null=True, blank=True,
+                                                  verbose_name='Год окончания последнего образования')
+    last_education_is_ended = models.BooleanField(default=False, verbose_name='Последнее образование окончено')
+    # поисковый документ, обновляется при сохранении заявки, образований, участника и пользователя
+    search_document = models.TextField(blank=True, default='', editable=False, verbose_name='Поисковый документ')
     # дальше идут новые поля для калькулятора
     international_articles = models.BooleanField(default=False,
                                                  verbose_name="Наличие опубликованных научных статей в международных изданиях")
@@ -120,26 +341,49 @@ class Application(models.Model):
     postgraduate_prior_direction = models.BooleanField(default=False,
                                                        verbose_name="Наличие ученой степени по специальности, соответствующей профилю научных исследований научной роты")
 
+    objects = ApplicationQuerySet.as_manager()
+
     class Meta:
         ordering = ['create_date']
         verbose_name = "Заявка"
         verbose_name_plural = "Заявки"
 
     def get_filed_blocks(self):
-        return {
-            'Основные данные': True,
-            'Образование': self.education.all().exists(),
-            'Направления': self.directions.all().exists(),
-            'Компетенции': self.competencies.all().exists(),
-            'Загруженные файлы': File.objects.filter(member=self.member).exists(),
-        }
+        """
+        Возвращает заполненность блоков анкеты.
+        Использует аннотации ApplicationQuerySet.with_filled_blocks, если они есть и заявка не менялась после загрузки,
+        иначе получает их одним запросом.
+        """
+        annotations = ApplicationQuerySet.filled_blocks_annotations
+        if all(hasattr(self, annotation) for annotation in annotations) and not self.get_dirty_fields():
+            filled_blocks = [getattr(self, annotation) for annotation in annotations]
+        else:
+            filled_blocks = Application.objects.filter(pk=self.pk).with_filled_blocks() \
+                .values_list(*annotations).get()
+        return {'Основные данные': True, **dict(zip(['Образование', 'Направления', 'Компетенции', 'Загруженные файлы'],
+                                                     map(bool, filled_blocks)))}
+
+    def reset_filled_blocks(self):
+        """Удаляет аннотации заполненности блоков, устаревшие после изменения заявки или ее направлений"""
+        for annotation in ApplicationQuerySet.filled_blocks_annotations:
+            self.__dict__.pop(annotation, None)
 
     def get_last_education(self):
         """
         Получение последнего образования
         :return: объект Education
         """
-        return self.education.all().order_by('-end_year').first()
+        return self.education.all().order_by('-end_year', 'pk').first()
+
+    def get_last_education_snapshot(self):
+        """
+        Получение последнего образования из его копии в заявке, без запроса к БД
+        :return: несохраненный объект Education только с полями копии или None, если образования нет
+        """
+        if not self.last_education_type:
+            return None
+        return Education(application=self, **{education_field: getattr(self, field)
+                                              for education_field, field in self.last_education_fields.items()})
 
     def calculate_fullness(self) -> int:
         """
@@ -150,55 +394,232 @@ class Application(models.Model):
         fullness = [v for k, v in filed_blocks.items() if v]
         return int(len(fullness) / len(filed_blocks) * 100)
 
+    def calculate_criterion_by_fields(self, criterion) -> float:
+        """
+        Подсчет критерия, который складывается из баллов за отмеченные поля заявки
+        :param criterion: название критерия из const.CRITERIA_FIELDS_SCORES
+        :return: рассчитанное значение
+        """
+        return round(sum(int(getattr(self, field)) * score
+                         for field, score in const.CRITERIA_FIELDS_SCORES[criterion].items()), 2)
+
+    @staticmethod
+    def calculate_education_score(last_education) -> float:
+        """
+        Подсчет критерия a2 по последнему образованию
+        :param last_education: объект Education или None
+        :return: рассчитанное значение
+        """
+        if not last_education:
+            return 0
+        coef = const.BACHELOR_COEF if last_education.education_type == 'b' else const.SPECIAL_AND_MORE_COEF
+        return round(last_education.avg_score * coef, 2)
+
+    def calculate_postgraduate_score(self, educations) -> float:
+        """
+        Подсчет критерия a5, баллы начисляются только при оконченной аспирантуре
+        :param educations: список образований заявки
+        :return: рассчитанное значение
+        """
+        if not any(education.education_type == Education.education_program[2][0] and education.is_ended
+                   for education in educations):
+            return 0
+        return round(const.POSTGRADUATE_ENDED_SCORE + sum(
+            int(getattr(self, field)) * score for field, score in const.POSTGRADUATE_FIELDS_SCORES.items()), 2)
+
+    @staticmethod
+    def get_criteria_by_fields(fields) -> set:
+        """
+        Возвращает критерии, на которые влияют переданные поля заявки
+        :param fields: названия полей заявки
+        :return: множество критериев
+        """
+        fields = set(fields)
+        criteria = {criterion for criterion, fields_scores in const.CRITERIA_FIELDS_SCORES.items()
+                    if fields & fields_scores.keys()}
+        if fields & const.POSTGRADUATE_FIELDS_SCORES.keys():
+            criteria.add('a5')
+        return criteria
+
+    def get_scores(self):
+        """Возвращает оценки заявки, создавая их при отсутствии"""
+        try:
+            return self.scores
+        except ApplicationScores.DoesNotExist:
+            self.scores = ApplicationScores.objects.create(application=self)
+            return self.scores
+
+    def calculate_criteria(self, criteria):
+        """
+        Пересчитывает переданные критерии и сохраняет изменившиеся оценки
+        :param criteria: названия критериев (a1..a7)
+        """
+        scores = self.get_scores()
+        for criterion in criteria:
+            if criterion in const.CRITERIA_FIELDS_SCORES:
+                setattr(scores, criterion, self.calculate_criterion_by_fields(criterion))
+        if 'a2' in criteria:
+            scores.a2 = self.calculate_education_score(self.get_last_education_snapshot())
+        if 'a5' in criteria:
+            scores.a5 = self.calculate_postgraduate_score(self.education.all())
+        scores.save()
+
     def calculate_final_score(self) -> float:
         """
         Подсчет рейтингового балла заявки оператора по формуле
         :return: рассчитание значение
         """
-        self.scores.a1 = round(int(self.international_articles) * const.INTERNATIONAL_ARTICLES_SCORE + int(
-            self.patents) * const.PATENTS_SCORE + int(self.vac_articles) * const.VAC_ARTICLES_SCORE + int(
-            self.innovation_proposals) * const.INNOVATION_PROPOSALS_SCORE + int(
-            self.rinc_articles) * const.RINC_ARTICLES_SCORE + int(self.evm_register) * const.EVM_REGISTER_SCORE, 2)
-        last_education = self.get_last_education()
-        if last_education:
-            if last_education.education_type == 'b':
-                score = round(last_education.avg_score * const.BACHELOR_COEF, 2)
-            else:
-                score = round(last_education.avg_score * const.SPECIAL_AND_MORE_COEF, 2)
-            self.scores.a2 = score
-        self.scores.a3 = round(int(self.compliance_prior_direction) * const.COMPLIANCE_PRIOR_DIRECTION_SCORE + int(
-            self.compliance_additional_direction) * const.COMPLIANCE_ADDITIONAL_DIRECTION_SCORE, 2)
-        self.scores.a4 = round(int(self.international_olympics) * const.INTERNATIONAL_OLYMPICS_SCORE + int(
-            self.president_scholarship) * const.PRESIDENT_SCHOLARSHIP_SCORE + int(
-            self.country_olympics) * const.COUNTRY_OLYMPICS_SCORE + int(
-            self.government_scholarship) * const.GOVERNMENT_SCHOLARSHIP_SCORE + int(
-            self.military_grants) * const.MILITARY_GRANTS_SCORE + int(
-            self.region_olympics) * const.REGION_OLYMPICS_SCORE + int(self.city_olympics) * const.CITY_OLYMPICS_SCORE,
-                               2)
-        if self.education.filter(education_type=Education.education_program[2][0], is_ended=True).exists():
-            self.scores.a5 = round(const.POSTGRADUATE_ENDED_SCORE + int(
-                self.postgraduate_prior_direction) * const.POSTGRADUATE_PRIOR_DIRECTION_SCORE + int(
-                self.compliance_additional_direction) * const.POSTGRADUATE_ADDITIONAL_DIRECTION_SCORE, 2)
-        self.scores.a6 = round(int(self.science_experience) * const.SCIENCE_EXPERIENCE_SCORE + int(
-            self.opk_experience) * const.OPK_EXPERIENCE_SCORE + int(
-            self.commercial_experience) * const.COMMERCIAL_EXPERIENCE_SCORE, 2)
-        self.scores.a7 = round(int(self.military_sport_achievements) * const.MILITARY_SPORT_ACHIEVEMENTS_SCORE + int(
-            self.sport_achievements) * const.SPORT_ACHIEVEMENTS_SCORE, 2)
-        self.scores.save()
-        return round(self.scores.a1 * const.MEANING_COEFFICIENTS['k1'] + self.scores.a2 * const.MEANING_COEFFICIENTS[
-            'k2'] + self.scores.a3 * const.MEANING_COEFFICIENTS['k3'] + self.scores.a4 * const.MEANING_COEFFICIENTS[
-                         'k4'] + self.scores.a5 * const.MEANING_COEFFICIENTS['k5'] + self.scores.a6 * \
-                     const.MEANING_COEFFICIENTS['k6'] + self.scores.a7 * const.MEANING_COEFFICIENTS['k7'], 2)
+        self.calculate_criteria(const.SCORE_CRITERIA)
+        return self.scores.calculate_weighted_score(self.get_current_coefficients().as_dict())
+
+    def get_current_coefficients(self):
+        """
+        Возвращает актуальную версию коэффициентов. У заявки, загруженной with_current_coefficients, актуальная версия
+        определяется без запроса, а если заявка посчитана по ней, берется загруженная версия заявки.
+        """
+        if hasattr(self, 'current_coefficients_id'):
+            if self.current_coefficients_id is None:
+                return ScoringCoefficients(**const.MEANING_COEFFICIENTS)
+            if self.current_coefficients_id == self.coefficients_id:
+                return self.coefficients
+        return ScoringCoefficients.get_current()
+
+    def refresh_final_score(self, coefficients=None):
+        """
+        Пересчитывает итоговый балл по сохраненным оценкам критериев, запоминая версию коэффициентов
+        :param coefficients: экземпляр ScoringCoefficients (по умолчанию - актуальная версия)
+        """
+        coefficients = coefficients or self.get_current_coefficients()
+        self.final_score = self.get_scores().calculate_weighted_score(coefficients.as_dict())
+        self.coefficients_id = coefficients.pk
 
     def get_draft_time(self):
         return f'{self.season[self.draft_season - 1][1]} {self.draft_year}'
 
-    def update_scores(self, *args, **kwargs):
-        self.fullness = self.calculate_fullness()
-        if not ApplicationScores.objects.filter(application=self).exists():
-            ApplicationScores(application=self).save()
-        self.final_score = self.calculate_final_score()
+    def update_scores(self, criteria=None, fullness=True, fields=()):
+        """
+        Пересчитывает баллы заявки и сохраняет только изменившиеся значения
+        :param criteria: пересчитываемые критерии (по умолчанию - все)
+        :param fullness: нужно ли пересчитать заполненность анкеты
+        :param fields: другие отслеживаемые поля заявки, которые сохраняются тем же запросом, если изменились
+        """
+        criteria = const.SCORE_CRITERIA if criteria is None else criteria
+        if fullness:
+            self.fullness = self.calculate_fullness()
+        if criteria:
+            self.calculate_criteria(criteria)
+            self.refresh_final_score()
+        update_fields = self.get_dirty_fields() & {'fullness', 'final_score', 'coefficients_id', *fields}
+        if update_fields:
+            self.save(update_fields=update_fields)
+
+    def set_educations(self, educations):
+        """
+        Запоминает образования заявки так же, как prefetch_related('education')
+        :param educations: список всех образований заявки
+        """
+        queryset = Education.objects.filter(application=self)
+        queryset._result_cache, queryset._prefetch_done = list(educations), True
+        self._prefetched_objects_cache = {**getattr(self, '_prefetched_objects_cache', {}), 'education': queryset}
+
+    def set_directions(self, directions):
+        """
+        Заменяет направления заявки и обновляет ее места в рейтингах.
+        Связи удаляются и добавляются запросами к промежуточной таблице без чтения текущих направлений и сигналов
+        m2m_changed (set() отправляет их отдельно на удаление и добавление), места в рейтингах обновляются один раз.
+        :param directions: id направлений
+        """
+        through = Application.directions.through
+        directions = set(directions)
+        with transaction.atomic(savepoint=False):
+            through.objects.filter(application=self).exclude(direction__in=directions).delete()
+            through.objects.bulk_create([through(application=self, direction_id=direction_id)
+                                         for direction_id in sorted(directions)], ignore_conflicts=True)
+            ApplicationRank.place_application(self, directions=directions)
+        if 'has_directions' in self.__dict__:
+            self.has_directions = bool(directions)
+        DataVersion.bump_on_commit()
+
+    def get_search_document(self, educations):
+        """
+        Собирает поисковый документ заявки (см. application.search)
+        :param educations: образования заявки
+        """
+        user = self.member.user
+        return build_search_document((
+            user.last_name, user.first_name, self.member.father_name, self.birth_place,
+            self.commissariat.subject if self.commissariat_id else None,
+            *(value for education in sorted(educations, key=lambda education: education.pk)
+              for value in (education.university, education.specialization))
+        ))
+
+    def update_education_data(self, saved=None, deleted_pk=None):
+        """
+        Обновляет данные заявки, зависящие от образований, после сохранения или удаления образования:
+        копию последнего образования, поисковый документ и критерии a2, a5 (сразу или в фоне, см. workers).
+        Заполненность пересчитывается, только если блок образования мог стать пустым или заполненным.
+        Изменившиеся поля заявки сохраняются одним запросом. Образования, загруженные вместе с заявкой,
+        не читаются повторно, иначе они читаются одним запросом только для пересчета.
+        :param saved: сохраненное образование
+        :param deleted_pk: id удаленного образования
+        """
+        from .workers import recompute_scores, EDUCATION_CRITERIA
+        prefetched = 'education' in getattr(self, '_prefetched_objects_cache', {})
+        if prefetched:
+            changed = {deleted_pk, saved.pk if saved else None}
+            self.set_educations([education for education in self.education.all() if education.pk not in changed] +
+                                ([saved] if saved else []))
+        else:
+            prefetch_related_objects([self], 'education')
+        educations = self.education.all()
+        last_education = min(educations, key=lambda education: (-education.end_year, education.pk), default=None)
+        for education_field, field in self.last_education_fields.items():
+            setattr(self, field, getattr(last_education, education_field) if last_education
+                    else Application._meta.get_field(field).get_default())
+        self.search_document = self.get_search_document(educations)
+        recompute_scores(self, criteria=EDUCATION_CRITERIA, fullness=len(educations) <= 1,
+                         fields=(*self.last_education_fields.values(), 'search_document'))
+        if not prefetched:
+            self._prefetched_objects_cache.pop('education')
+
+    def save(self, *args, **kwargs):
+        """
+        Сохраняет заявку, привязывая ее к комиссариату справочника при изменении названия комиссариата,
+        и обновляет ее места в рейтингах, если изменились итоговый балл или призыв,
+        и поисковый документ, если изменились входящие в него поля
+        """
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        if (update_fields is None or 'military_commissariat' in update_fields) and \
+                (adding or self.__dict__.get('military_commissariat') != getattr(self, '_military_commissariat', None)):
+            self.commissariat = MilitaryCommissariat.get_by_name(self.military_commissariat)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'commissariat'}
+            self._military_commissariat = self.military_commissariat
         super().save(*args, **kwargs)
+        self.reset_filled_blocks()
+        if self.saved_dirty_fields & {'draft_year', 'draft_season'}:
+            ApplicationRank.place_application(self)
+        elif self.saved_dirty_fields & self.rank_fields:
+            ApplicationRank.move_application(self)
+        if adding or self.get_search_values() != getattr(self, '_search_values', None):
+            # документ записывается и в экземпляр, иначе следующее полное сохранение вернет прежнее значение
+            self.search_document = Application.objects.filter(pk=self.pk).update_search_documents()[self.pk]
+            self.reset_dirty_fields(['search_document'])
+            self._search_values = self.get_search_values()
+        elif 'search_document' in self.saved_dirty_fields & set(update_fields or ['search_document']):
+            update_search_index(connections[self._state.db], {self.pk: self.search_document})
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._search_values = instance.get_search_values()
+        instance._military_commissariat = instance.__dict__.get('military_commissariat')
+        return instance
+
+    def get_search_values(self):
+        """Значения полей заявки, входящих в поисковый документ, без загрузки отложенных полей"""
+        return tuple(self.__dict__.get(field) for field in self.search_document_fields)
 
     def __str__(self):
         return f'{self.member.user.first_name} {self.member.user.last_name}'
@@ -211,12 +632,7 @@ def validate_avg_score(value: float):
 
 class Education(models.Model):
     """Образование, указанное в заявке кандидата"""
-    education_program = [
-        ('b', 'Бакалавриат'),
-        ('m', 'Магистратура'),
-        ('a', 'Аспирантура'),
-        ('s', 'Специалитет'),
-    ]
+    education_program = const.EDUCATION_PROGRAMS
     application = models.ForeignKey(Application, on_delete=models.CASCADE, verbose_name='Заявка',
                                     related_name='education')
     education_type = models.CharField(choices=education_program, max_length=1, verbose_name='Программа')
@@ -232,6 +648,18 @@ class Education(models.Model):
     def __str__(self):
         return f'{self.application.member.user.first_name} {self.application.member.user.last_name}: {self.get_education_type_display()}'
 
+    def save(self, *args, **kwargs):
+        """Сохраняет образование и обновляет зависящие от образований данные и баллы заявки"""
+        super().save(*args, **kwargs)
+        self.application.update_education_data(saved=self)
+
+    def delete(self, *args, **kwargs):
+        """Удаляет образование и обновляет зависящие от образований данные и баллы заявки"""
+        application, pk = self.application, self.pk
+        result = super().delete(*args, **kwargs)
+        application.update_education_data(deleted_pk=pk)
+        return result
+
     def check_name_uni(self):
         """Проверяет, что имя университета уникально."""
         return True if Universities.objects.filter(name=self.university).exists() else False
@@ -280,7 +708,8 @@ class File(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         if self.member.is_slave() and hasattr(self.member, 'application'):
-            self.member.application.update_scores(update_fields=['fullness', 'final_score'])
+            from .workers import recompute_scores
+            recompute_scores(self.member.application, criteria=(), fullness=True)
 
 
 class AdditionField(models.Model):
@@ -372,7 +801,9 @@ class ApplicationNote(models.Model):
         return f'{self.text}'
 
 
-class ApplicationScores(models.Model):
+class ApplicationScores(DirtyFieldsMixin, models.Model):
+    tracked_fields = const.SCORE_CRITERIA
+
     application = models.OneToOneField(Application, on_delete=models.CASCADE, verbose_name='Заявка',
                                        related_name='scores')
     # поля без форм
@@ -396,6 +827,342 @@ class ApplicationScores(models.Model):
     def __str__(self):
         return f'{self.application}'
 
+    def save(self, *args, **kwargs):
+        """Сохраняет только изменившиеся оценки"""
+        if not self._state.adding and 'update_fields' not in kwargs:
+            kwargs['update_fields'] = self.get_dirty_fields()
+            if not kwargs['update_fields']:
+                return
+        super().save(*args, **kwargs)
+
+    def calculate_weighted_score(self, coefficients=None) -> float:
+        """
+        Подсчет итогового балла по оценкам критериев
+        :param coefficients: словарь весовых коэффициентов {'k1': ..., 'k7': ...}, по умолчанию текущие
+        :return: рассчитанное значение
+        """
+        coefficients = coefficients or const.MEANING_COEFFICIENTS
+        return round(sum(getattr(self, f'a{i}') * coefficients[f'k{i}'] for i in range(1, 8)), 2)
+
+
+class ApplicationRank(models.Model):
+    """
+    Место заявки в рейтинге направления призыва.
+    Рейтинг упорядочен по убыванию итогового балла, при равных баллах выше заявка, поданная раньше.
+    Обновляется при изменении итогового балла, призыва или направлений заявки.
+    """
+    application = models.ForeignKey(Application, on_delete=models.CASCADE, verbose_name='Заявка',
+                                    related_name='ranks')
+    direction = models.ForeignKey('Direction', on_delete=models.CASCADE, verbose_name='Направление',
+                                  related_name='application_ranks')
+    draft_year = models.PositiveIntegerField(verbose_name='Год призыва')
+    draft_season = models.IntegerField(choices=Application.season, verbose_name='Сезон призыва')
+    final_score = models.FloatField(verbose_name='Итоговая оценка заявки')
+    score_bucket = models.IntegerField(verbose_name='Интервал итоговой оценки')
+    rank = models.PositiveIntegerField(verbose_name='Место в рейтинге')
+
+    class Meta:
+        verbose_name = 'Место в рейтинге'
+        verbose_name_plural = 'Места в рейтинге'
+        ordering = ['draft_year', 'draft_season', 'direction', 'rank']
+        unique_together = ('application', 'direction')
+        indexes = [models.Index(fields=['draft_year', 'draft_season', 'direction', 'rank'])]
+
+    def __str__(self):
+        return f'{self.application} - {self.rank} место ({self.direction})'
+
+    @staticmethod
+    def get_score_bucket(final_score):
+        """Возвращает номер интервала итоговой оценки шириной RANK_SCORE_BUCKET_SIZE"""
+        return int(final_score // const.RANK_SCORE_BUCKET_SIZE)
+
+    @staticmethod
+    def get_above_q(final_score, application_id):
+        """Условие на места рейтинга выше места заявки application_id с итоговым баллом final_score"""
+        return Q(final_score__gt=final_score) | Q(final_score=final_score, application_id__lt=application_id)
+
+    @staticmethod
+    def get_below_q(final_score, application_id):
+        """Условие на места рейтинга ниже места заявки application_id с итоговым баллом final_score"""
+        return Q(final_score__lt=final_score) | Q(final_score=final_score, application_id__gt=application_id)
+
+    @staticmethod
+    def get_group_exists(rows, condition):
+        """
+        Возвращает Exists: в рейтинге места внешнего запроса есть место из rows, удовлетворяющее condition
+        :param rows: queryset мест рейтинга
+        :param condition: условие Q на место из rows (через OuterRef ссылается на место внешнего запроса)
+        """
+        return Exists(rows.filter(condition, direction=OuterRef('direction'), draft_year=OuterRef('draft_year'),
+                                  draft_season=OuterRef('draft_season')))
+
+    @classmethod
+    def lock_directions(cls, directions=None):
+        """
+        Блокирует строки направлений до конца транзакции, чтобы их рейтинги не изменялись параллельно.
+        На БД без SELECT ... FOR UPDATE (SQLite) запись в БД и так выполняется одной транзакцией за раз.
+        :param directions: id направлений (по умолчанию - все направления)
+        """
+        if not connections[cls.objects.db].features.has_select_for_update:
+            return
+        direction_model = cls._meta.get_field('direction').related_model
+        locked = direction_model.objects.select_for_update().order_by('pk')
+        list((locked if directions is None else locked.filter(pk__in=directions)).values_list('pk'))
+
+    @classmethod
+    def remove_application(cls, application_id):
+        """
+        Сдвигает вверх заявки ниже заявки application_id во всех ее рейтингах одним запросом.
+        Вызывается перед удалением заявки, места которой удаляются каскадно.
+        :param application_id: id заявки
+        """
+        rows = cls.objects.filter(application_id=application_id)
+        with transaction.atomic(savepoint=False):
+            cls.lock_directions(rows.values('direction_id'))
+            cls.objects.filter(cls.get_group_exists(rows, cls.get_above_q(OuterRef('final_score'),
+                                                                          OuterRef('application_id')))) \
+                .exclude(application_id=application_id).update(rank=F('rank') - 1)
+
+    @classmethod
+    def shift_for_move(cls, rows, application):
+        """
+        Сдвигает одним запросом заявки между старыми местами rows заявки и местами по ее новому итоговому баллу
+        :param rows: queryset мест заявки с прежним итоговым баллом
+        :param application: экземпляр Application с новым итоговым баллом
+        """
+        outer = OuterRef('final_score'), OuterRef('application_id')
+        below_new = cls.get_below_q(application.final_score, application.pk)
+        above_new = cls.get_above_q(application.final_score, application.pk)
+        cls.objects.exclude(application=application).filter(
+            (cls.get_group_exists(rows, cls.get_below_q(*outer)) & below_new) |
+            (cls.get_group_exists(rows, cls.get_above_q(*outer)) & above_new)
+        ).update(rank=F('rank') + Case(When(below_new, then=Value(1)), default=Value(-1)))
+
+    @classmethod
+    def update_application_rows(cls, application):
+        """Записывает в места заявки ее итоговый балл и место, посчитанное по местам остальных заявок"""
+        final_score = application.final_score
+        above_count = cls.objects.exclude(application=application) \
+            .filter(cls.get_above_q(final_score, application.pk), direction=OuterRef('direction'),
+                    draft_year=OuterRef('draft_year'), draft_season=OuterRef('draft_season')) \
+            .order_by().values('direction').annotate(count=Count('pk')).values('count')
+        cls.objects.filter(application=application).update(
+            final_score=final_score, score_bucket=cls.get_score_bucket(final_score),
+            rank=Coalesce(Subquery(above_count), 0) + 1)
+
+    @classmethod
+    def move_application(cls, application):
+        """
+        Перемещает заявку во всех ее рейтингах по новому итоговому баллу двумя запросами, без чтения ее мест
+        :param application: экземпляр Application
+        """
+        rows = cls.objects.filter(application=application)
+        with transaction.atomic(savepoint=False):
+            cls.lock_directions(rows.values('direction_id'))
+            cls.shift_for_move(rows, application)
+            cls.update_application_rows(application)
+
+    @classmethod
+    def place_application(cls, application, directions=None):
+        """
+        Обновляет места заявки в рейтингах всех выбранных ею направлений и ее призыва.
+        Места остальных заявок сдвигаются одним запросом по сохраненным в рейтинге местам заявки и ее новому месту,
+        поэтому количество запросов не зависит от количества направлений: по одному на сдвиг, удаление, добавление
+        и обновление мест заявки.
+        :param application: экземпляр Application
+        :param directions: id направлений заявки, если они изменились (иначе направления берутся из ее мест в рейтингах)
+        """
+        draft = {'draft_year': application.draft_year, 'draft_season': application.draft_season}
+        final_score, application_id = application.final_score, application.pk
+        with transaction.atomic(savepoint=False):
+            rows = list(cls.objects.filter(application=application).order_by())
+            directions = {row.direction_id for row in rows} if directions is None else set(directions)
+            cls.lock_directions(sorted(directions | {row.direction_id for row in rows}))
+            kept = [row for row in rows if row.direction_id in directions and
+                    (row.draft_year, row.draft_season) == (application.draft_year, application.draft_season)]
+            removed = [row.pk for row in rows if row not in kept]
+            added = directions - {row.direction_id for row in kept}
+            moved = [row for row in kept if row.final_score != final_score]
+            if not (removed or added or moved):
+                return
+            # заявка уходит с прежних мест удаленных и перемещаемых строк и встает на новые места добавленных
+            # и перемещаемых строк, место другой заявки меняется, если она ниже только одного из этих мест
+            # Exists обернут в Q, чтобы отрицание пустого подзапроса (нет удаленных и перемещаемых строк) было истинным
+            below_old = Q(cls.get_group_exists(cls.objects.filter(pk__in=[*removed, *(row.pk for row in moved)]),
+                                               cls.get_above_q(OuterRef('final_score'), OuterRef('application_id'))))
+            below_new = Q(direction__in=added | {row.direction_id for row in moved}, **draft) & \
+                cls.get_below_q(final_score, application_id)
+            cls.objects.exclude(application=application).filter((below_old & ~below_new) | (~below_old & below_new)) \
+                .update(rank=F('rank') + Case(When(below_new, then=Value(1)), default=Value(-1)))
+            if removed:
+                cls.objects.filter(pk__in=removed).delete()
+            if added:
+                cls.objects.bulk_create([cls(application=application, direction_id=direction_id, final_score=final_score,
+                                             score_bucket=cls.get_score_bucket(final_score), rank=0, **draft)
+                                         for direction_id in sorted(added)])
+            if added or moved:
+                cls.update_application_rows(application)
+
+    @classmethod
+    def rebuild(cls, draft_year, draft_season):
+        """
+        Полностью пересчитывает рейтинги направлений призыва одним запросом с оконной функцией
+        :param draft_year: год призыва
+        :param draft_season: сезон призыва
+        """
+        rows = Application.directions.through.objects \
+            .filter(application__draft_year=draft_year, application__draft_season=draft_season) \
+            .annotate(rank=Window(RowNumber(), partition_by=[F('direction_id')],
+                                  order_by=[F('application__final_score').desc(), F('application_id').asc()])) \
+            .values_list('application_id', 'direction_id', 'application__final_score', 'rank')
+        with transaction.atomic():
+            cls.lock_directions()
+            # удаляются и места заявок призыва, оставшиеся в рейтингах призыва, к которому они относились раньше
+            cls.objects.filter(Q(draft_year=draft_year, draft_season=draft_season) |
+                               Q(application__draft_year=draft_year, application__draft_season=draft_season)) \
+                .delete()
+            cls.objects.bulk_create([
+                cls(application_id=application_id, direction_id=direction_id, draft_year=draft_year,
+                    draft_season=draft_season, final_score=final_score, score_bucket=cls.get_score_bucket(final_score),
+                    rank=rank)
+                for application_id, direction_id, final_score, rank in rows
+            ], batch_size=1000)
+
+    @classmethod
+    def rebuild_for(cls, applications):
+        """
+        Пересчитывает рейтинги всех призывов, к которым относятся или относились заявки из queryset applications
+        """
+        drafts = set(applications.order_by().values_list('draft_year', 'draft_season').distinct())
+        drafts.update(cls.objects.filter(application__in=applications.order_by().values('pk')).order_by()
+                      .values_list('draft_year', 'draft_season').distinct())
+        for draft_year, draft_season in sorted(drafts):
+            cls.rebuild(draft_year, draft_season)
+
+
+@receiver(pre_delete, sender=Application)
+def remove_application_ranks(sender, instance, **kwargs):
+    """
+    Сдвигает заявки ниже удаляемой во всех ее рейтингах, в том числе при каскадном удалении и удалении queryset
+    """
+    ApplicationRank.remove_application(instance.pk)
+
+
+@receiver(m2m_changed, sender=Application.directions.through)
+def update_ranks_on_directions_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Обновляет места заявки в рейтингах при изменении ее направлений"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    applications = Application.objects.filter(pk__in=pk_set or ()) if reverse else [instance]
+    for application in applications:
+        application.reset_filled_blocks()
+        ApplicationRank.place_application(application, directions=application.directions.values_list('pk', flat=True))
+
+
+class MasterApplicationState(models.Model):
+    """
+    Флаги бронирования, избранного и просмотра заявки для мастера, используемые в списке заявок мастера.
+    Хранятся только строки, в которых хотя бы один флаг отличается от значения по умолчанию.
+    Обновляются при изменении бронирований, просмотров и принадлежностей мастеров,
+    если включен MASTER_APPLICATION_STATES.
+    """
+    # флаги и их значения по умолчанию
+    flags = {'is_booked': False, 'is_booked_our': False, 'can_unbook': False, 'wishlist_len': 0,
+             'is_in_wishlist': False, 'is_viewed': False}
+
+    master = models.ForeignKey(Member, on_delete=models.CASCADE, verbose_name='Мастер',
+                               related_name='application_states')
+    application = models.ForeignKey(Application, on_delete=models.CASCADE, verbose_name='Заявка',
+                                    related_name='master_states')
+    is_booked = models.BooleanField(default=False, verbose_name='Заявка отобрана')
+    is_booked_our = models.BooleanField(default=False, verbose_name='Отобрана на принадлежность мастера')
+    can_unbook = models.BooleanField(default=False, verbose_name='Мастер может отменить отбор')
+    wishlist_len = models.PositiveIntegerField(default=0, verbose_name='Количество добавлений в избранное')
+    is_in_wishlist = models.BooleanField(default=False, verbose_name='В избранном принадлежности мастера')
+    is_viewed = models.BooleanField(default=False, verbose_name='Просмотрена мастером')
+
+    class Meta:
+        verbose_name = 'Состояние заявки для мастера'
+        verbose_name_plural = 'Состояния заявок для мастеров'
+        unique_together = ('master', 'application')
+
+    @staticmethod
+    def get_masters():
+        """Возвращает queryset мастеров"""
+        return Member.objects.filter(role__role_name=const.MASTER_ROLE_NAME)
+
+    @classmethod
+    def create_states(cls, rows, key, **kwargs):
+        """
+        Создает строки, в которых хотя бы один флаг отличается от значения по умолчанию
+        :param rows: кортежи (id, *значения флагов в порядке flags)
+        :param key: поле строки, в которое записывается id (master_id или application_id)
+        :param kwargs: общие поля строк
+        """
+        defaults = tuple(cls.flags.values())
+        cls.objects.bulk_create([cls(**{key: pk}, **kwargs, **dict(zip(cls.flags, values)))
+                                 for pk, *values in rows if tuple(values) != defaults], batch_size=1000)
+
+    @classmethod
+    def refresh_application(cls, application_id):
+        """Пересчитывает флаги заявки для всех мастеров одним запросом по мастерам"""
+        booked = Booking.objects.filter(slave__application=application_id, booking_type__name=const.BOOKED)
+        wishlist = Booking.objects.filter(slave__application=application_id, booking_type__name=const.IN_WISHLIST)
+        rows = cls.get_masters().annotate(
+            is_booked=Exists(booked),
+            is_booked_our=Exists(booked.filter(affiliation__member=OuterRef('pk'))),
+            can_unbook=Exists(booked.filter(affiliation__member=OuterRef('pk'), master=OuterRef('pk'))),
+            wishlist_len=Value(wishlist.count()),
+            is_in_wishlist=Exists(wishlist.filter(affiliation__member=OuterRef('pk'))),
+            is_viewed=Exists(ViewedApplication.objects.filter(application=application_id, member=OuterRef('pk'))),
+        ).values_list('pk', *cls.flags)
+        with transaction.atomic():
+            cls.objects.filter(application=application_id).delete()
+            cls.create_states(rows, 'master_id', application_id=application_id)
+
+    @classmethod
+    def refresh_master(cls, master):
+        """Пересчитывает флаги всех заявок для мастера одним запросом по заявкам"""
+        rows = Application.objects.order_by().with_booking_flags(master, master.affiliations.all()) \
+            .values_list('pk', *cls.flags)
+        with transaction.atomic():
+            cls.objects.filter(master=master).delete()
+            cls.create_states(rows, 'application_id', master_id=master.pk)
+
+    @classmethod
+    def rebuild(cls):
+        """Пересчитывает флаги всех заявок для всех мастеров"""
+        for master in cls.get_masters():
+            cls.refresh_master(master)
+
+    @classmethod
+    def mark_viewed(cls, master_id, application_id):
+        """Отмечает заявку просмотренной мастером, не пересчитывая остальные флаги"""
+        if not cls.objects.filter(master=master_id, application=application_id).update(is_viewed=True):
+            cls.objects.create(master_id=master_id, application_id=application_id, is_viewed=True)
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def update_master_states_on_booking_change(sender, instance, **kwargs):
+    """Пересчитывает флаги заявки кандидата для мастеров при изменении его бронирований"""
+    if not settings.MASTER_APPLICATION_STATES:
+        return
+    application_id = Application.objects.filter(member=instance.slave_id).values_list('pk', flat=True).first()
+    if application_id:
+        MasterApplicationState.refresh_application(application_id)
+
+
+@receiver(m2m_changed, sender=Member.affiliations.through)
+def update_master_states_on_affiliations_change(sender, instance, action, reverse, pk_set, **kwargs):
+    """Пересчитывает флаги заявок для мастеров, у которых изменились принадлежности"""
+    if not settings.MASTER_APPLICATION_STATES or action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    members = MasterApplicationState.get_masters().filter(pk__in=pk_set or ()) if reverse else [instance]
+    for member in members:
+        if member.role and member.role.role_name == const.MASTER_ROLE_NAME:
+            MasterApplicationState.refresh_master(member)
+
 
 class MilitaryCommissariat(models.Model):
     name = models.CharField(max_length=256, verbose_name='Название коммисариата', )
@@ -405,6 +1172,15 @@ class MilitaryCommissariat(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def get_by_name(cls, name):
+        """
+        Возвращает комиссариат справочника по названию, указанному в заявке
+        :param name: название комиссариата
+        :return: объект MilitaryCommissariat или None
+        """
+        return cls.objects.filter(name=name).order_by('pk').first() if name else None
+
     class Meta:
         verbose_name = 'Военный комиссариат'
         verbose_name_plural = 'Военные комиссариаты'
@@ -435,3 +1211,182 @@ class ViewedApplication(models.Model):
     #     """ Возвращает список id анкет, которые были просмотрены переданным мембером"""
     #     return AppsViewedByMaster.objects.filter(member=member, application__in=apps).values_list('application_id',
     #                                                                                                   flat=True)
+
+
+@receiver(post_save, sender=ViewedApplication)
+def update_master_states_on_view(sender, instance, created, **kwargs):
+    """Отмечает заявку просмотренной в таблице состояний заявок для мастеров"""
+    if settings.MASTER_APPLICATION_STATES and created:
+        MasterApplicationState.mark_viewed(instance.member_id, instance.application_id)
+
+
+class DataVersion(models.Model):
+    """
+    Счетчик изменений данных, по которому строится заголовок ETag ответов с заявками.
+    Увеличивается после фиксации изменений любой модели, попадающей в эти ответы, один раз на транзакцию или запрос
+    (DataVersionMiddleware).
+    """
+    APPLICATIONS = 'applications'
+
+    name = models.CharField(max_length=32, unique=True, verbose_name='Набор данных')
+    version = models.PositiveBigIntegerField(default=0, verbose_name='Версия')
+    update_date = models.DateTimeField(default=timezone.now, verbose_name='Дата изменения')
+
+    class Meta:
+        verbose_name = 'Версия данных'
+        verbose_name_plural = 'Версии данных'
+
+    def __str__(self):
+        return f'{self.name}: {self.version}'
+
+    @classmethod
+    def get(cls, name=APPLICATIONS):
+        """Возвращает текущую версию набора данных, создавая ее при первом обращении"""
+        return cls.objects.get_or_create(name=name)[0]
+
+    # отложенные увеличения версий текущего потока: deferred - наборы данных, отложенные до выхода
+    # из defer_bumps, pending - {набор данных: callback}, зарегистрированные в transaction.on_commit
+    state = threading.local()
+
+    @classmethod
+    def bump(cls, name=APPLICATIONS):
+        """Увеличивает версию набора данных одним UPDATE"""
+        if not cls.objects.filter(name=name).update(version=F('version') + 1, update_date=timezone.now()):
+            cls.objects.get_or_create(name=name, defaults={'version': 1})
+
+    @classmethod
+    def bump_on_commit(cls, name=APPLICATIONS):
+        """
+        Увеличивает версию набора данных после фиксации текущей транзакции, один раз на транзакцию.
+        Внутри defer_bumps увеличение откладывается до выхода из блока.
+        """
+        deferred = getattr(cls.state, 'deferred', None)
+        if deferred is not None:
+            deferred.add(name)
+            return
+        connection = transaction.get_connection()
+        if not hasattr(cls.state, 'pending'):
+            cls.state.pending = {}
+        registered = cls.state.pending.get(name)
+        # увеличение уже ожидает фиксации транзакции (выполненные и отмененные откатом callback'и не учитываются)
+        if registered is not None and any(hook[1] is registered for hook in connection.run_on_commit):
+            return
+
+        def callback():
+            cls.state.pending.pop(name, None)
+            cls.bump(name)
+
+        cls.state.pending[name] = callback
+        transaction.on_commit(callback)
+
+    @classmethod
+    @contextmanager
+    def defer_bumps(cls):
+        """Откладывает увеличения версий до выхода из блока и выполняет их по одному на набор данных"""
+        if getattr(cls.state, 'deferred', None) is not None:
+            yield
+            return
+        cls.state.deferred = set()
+        try:
+            yield
+        finally:
+            names, cls.state.deferred = cls.state.deferred, None
+            for name in sorted(names):
+                cls.bump_on_commit(name)
+
+
+class ExportJob(models.Model):
+    """
+    Фоновая выгрузка файла (списка заявок, рабочего листа или служебного документа).
+    Готовые файлы хранятся в MEDIA_ROOT/exports под ключом key и отдаются повторным выгрузкам с тем же ключом.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    statuses = [
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    ]
+    document_types = [
+        ('applications', 'Список заявок'),
+        ('working-list', 'Рабочий лист'),
+        ('service-document', 'Служебный документ'),
+    ]
+
+    member = models.ForeignKey(Member, on_delete=models.CASCADE, verbose_name='Мастер', related_name='export_jobs')
+    document_type = models.CharField(max_length=32, choices=document_types, verbose_name='Тип документа')
+    params = models.JSONField(default=dict, blank=True, verbose_name='Query параметры выгрузки')
+    key = models.CharField(max_length=64, db_index=True, verbose_name='Ключ результата')
+    status = models.CharField(max_length=16, choices=statuses, default=PENDING, verbose_name='Статус')
+    file = models.FileField(upload_to='exports', blank=True, verbose_name='Файл')
+    filename = models.CharField(max_length=256, blank=True, verbose_name='Имя файла для скачивания')
+    content_type = models.CharField(max_length=128, blank=True, verbose_name='Тип содержимого файла')
+    error = models.TextField(blank=True, verbose_name='Ошибка')
+    create_date = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
+    finish_date = models.DateTimeField(null=True, blank=True, verbose_name='Дата завершения')
+
+    class Meta:
+        ordering = ['-create_date']
+        verbose_name = 'Выгрузка'
+        verbose_name_plural = 'Выгрузки'
+
+    def __str__(self):
+        return f'{self.get_document_type_display()} ({self.get_status_display()})'
+
+
+def bump_data_version(sender, **kwargs):
+    """Увеличивает версию данных заявок при изменении моделей, попадающих в ответы с заявками"""
+    if kwargs.get('action', 'post').startswith('pre'):
+        return
+    if sender is User and kwargs.get('update_fields') == frozenset({'last_login'}):
+        return
+    DataVersion.bump_on_commit()
+
+
+for model in (Application, Education, ApplicationScores, ApplicationCompetencies, ApplicationNote, ViewedApplication,
+              WorkGroup, Direction, Competence, MilitaryCommissariat, ScoringCoefficients, Booking, Member,
+              Affiliation, User):
+    post_save.connect(bump_data_version, sender=model)
+    post_delete.connect(bump_data_version, sender=model)
+for through in (Application.directions.through, ApplicationNote.affiliations.through,
+                Competence.directions.through, Member.affiliations.through):
+    m2m_changed.connect(bump_data_version, sender=through)
+
+
+@receiver(post_save, sender=Member)
+def update_search_document_on_member_change(sender, instance, created, **kwargs):
+    """Обновляет поисковый документ заявки при изменении отчества участника"""
+    if not created:
+        Application.objects.filter(member=instance).update_search_documents()
+
+
+@receiver(post_save, sender=User)
+def update_search_document_on_user_change(sender, instance, created, update_fields, **kwargs):
+    """Обновляет поисковый документ заявки при изменении имени или фамилии пользователя"""
+    if not created and update_fields != frozenset({'last_login'}):
+        Application.objects.filter(member__user=instance).update_search_documents()
+
+
+@receiver(post_save, sender=MilitaryCommissariat)
+@receiver(post_delete, sender=MilitaryCommissariat)
+def link_applications_to_commissariat(sender, instance, **kwargs):
+    """
+    Перепривязывает к справочнику заявки с названием комиссариата и заявки, ссылавшиеся на него,
+    и обновляет их поисковые документы (субъект комиссариата входит в документ)
+    """
+    applications = Application.objects.filter(pk__in=list(Application.objects.filter(
+        Q(military_commissariat=instance.name) | Q(commissariat=instance.pk)).values_list('pk', flat=True)))
+    for name in set(applications.values_list('military_commissariat', flat=True)):
+        commissariat = MilitaryCommissariat.get_by_name(name)
+        applications.filter(military_commissariat=name).exclude(commissariat=commissariat) \
+            .update(commissariat=commissariat)
+    applications.update_search_documents()
+
+
+@receiver(post_delete, sender=Application)
+def remove_application_from_search_index(sender, instance, using, **kwargs):
+    """Удаляет документ удаленной заявки из поискового индекса"""
+    remove_from_search_index(connections[using], [instance.pk])
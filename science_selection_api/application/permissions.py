@@ -48,16 +48,26 @@ class ApplicationIsNotFinalPermission(permissions.BasePermission):
         return not obj.is_final
 
 
+def get_nested_application(view):
+    """
+    Возвращает заявку вложенного эндпоинта (application_pk), загружая ее один раз на запрос для всех проверок прав.
+    Queryset заявки можно задать методом представления get_nested_application_queryset.
+    """
+    if getattr(view, 'nested_application', None) is None:
+        queryset = view.get_nested_application_queryset() if hasattr(view, 'get_nested_application_queryset') \
+            else Application.objects.select_related('member')
+        view.nested_application = queryset.get(pk=view.kwargs['application_pk'])
+    return view.nested_application
+
+
 class IsNestedApplicationOwnerPermission(permissions.BasePermission):
     """ Предоставляет доступ к анкете ее автору."""
 
     def has_object_permission(self, request, view, obj):
-        obj = Application.objects.get(pk=view.kwargs['application_pk'])
-        return obj.member.user == request.user
+        return self.has_permission(request, view)
 
     def has_permission(self, request, view):
-        obj = Application.objects.get(pk=view.kwargs['application_pk'])
-        return obj.member.user == request.user
+        return get_nested_application(view).member.user_id == request.user.pk
 
 
 class IsNotFinalNestedApplicationPermission(permissions.BasePermission):
@@ -67,19 +77,17 @@ class IsNotFinalNestedApplicationPermission(permissions.BasePermission):
         return not obj.application.is_final
 
     def has_permission(self, request, view):
-        obj = Application.objects.get(pk=view.kwargs['application_pk'])
-        return not obj.is_final
+        return not get_nested_application(view).is_final
 
 
 class IsNestedApplicationBookedOnMasterDirectionPermission(permissions.BasePermission):
     """ Предоставляет доступ мастеру, если данная заявка отобрана на его направление"""
 
     def has_object_permission(self, request, view, obj):
-        return is_booked_by_user(obj.application.pk, request.user)
+        return is_booked_by_user(obj.application_id, request.user)
 
     def has_permission(self, request, view):
-        obj = Application.objects.get(pk=view.kwargs['application_pk'])
-        return is_booked_by_user(obj.pk, request.user)
+        return is_booked_by_user(get_nested_application(view).pk, request.user)
 
 
 class IsApplicationBookedByCurrentMasterPermission(permissions.BasePermission):
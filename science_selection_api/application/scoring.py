@@ -0,0 +1,260 @@
+import numpy as np
+from django.db import transaction, connection
+from django.db.models import Case, When, Value, FloatField, Exists, OuterRef, F
+
+from utils import constants as const
+from .models import Application, ApplicationScores, Education, ScoringCoefficients, ApplicationRank, DataVersion
+
+# поля заявки, участвующие в расчете критериев, в порядке столбцов матрицы отметок
+SCORED_FIELDS = tuple(sorted({field for fields_scores in (*const.CRITERIA_FIELDS_SCORES.values(),
+                                                          const.POSTGRADUATE_FIELDS_SCORES)
+                              for field in fields_scores}))
+
+
+_round = np.frompyfunc(round, 2, 1)
+
+
+def round_column(values, digits=2):
+    """
+    Округляет массив так же, как встроенный round (np.round расходится с ним на границах),
+    чтобы массовый и построчный расчет давали одинаковые баллы
+    """
+    return _round(values, digits).astype(float)
+
+
+def get_weights_matrix(criteria_fields_scores):
+    """
+    Собирает матрицу баллов за поля заявки
+    :param criteria_fields_scores: словарь {критерий: {поле заявки: балл}}
+    :return: матрица размера (количество полей в SCORED_FIELDS) x (количество критериев)
+    """
+    weights = np.zeros((len(SCORED_FIELDS), len(criteria_fields_scores)))
+    for column, fields_scores in enumerate(criteria_fields_scores.values()):
+        for field, score in fields_scores.items():
+            weights[SCORED_FIELDS.index(field), column] = score
+    return weights
+
+
+def get_education_annotations():
+    """
+    Возвращает аннотации заявок для расчета критериев образования: коэффициент к среднему баллу последнего
+    образования (по копии последнего образования в заявке) и наличие оконченной аспирантуры
+    :return: словарь {название аннотации: выражение}
+    """
+    return {
+        'education_coef': Case(When(last_education_type='', then=Value(0.0)),
+                               When(last_education_type='b', then=Value(const.BACHELOR_COEF)),
+                               default=Value(const.SPECIAL_AND_MORE_COEF), output_field=FloatField()),
+        'has_postgraduate': Exists(Education.objects.filter(
+            application=OuterRef('pk'), education_type=Education.education_program[2][0], is_ended=True)),
+    }
+
+
+def get_scores_ids(application_ids, applications):
+    """
+    Возвращает id оценок заявок, создавая недостающие
+    :param application_ids: массив id заявок
+    :param applications: queryset заявок
+    :return: список id ApplicationScores в порядке application_ids
+    """
+    existing = ApplicationScores.objects.filter(application__in=applications.values('pk'))
+    scores_ids = dict(existing.values_list('application_id', 'pk'))
+    missing = [app_id for app_id in application_ids.tolist() if app_id not in scores_ids]
+    if missing:
+        ApplicationScores.objects.bulk_create([ApplicationScores(application_id=app_id) for app_id in missing])
+        scores_ids = dict(existing.values_list('application_id', 'pk'))
+    return [scores_ids[app_id] for app_id in application_ids.tolist()]
+
+
+def bulk_update_columns(model, field_names, rows, chunk_size=1000):
+    """
+    Обновляет столбцы модели пачками одного параметризованного UPDATE.
+    Быстрее QuerySet.bulk_update, который строит CASE WHEN выражение на каждую строку.
+    Сигналы моделей не отправляются, поэтому версия данных заявок увеличивается здесь.
+    :param model: класс модели
+    :param field_names: обновляемые поля
+    :param rows: список кортежей (pk, *значения полей)
+    :param chunk_size: размер пачки
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    assignments = ', '.join(f'{qn(opts.get_field(name).column)} = %s' for name in field_names)
+    sql = f'UPDATE {qn(opts.db_table)} SET {assignments} WHERE {qn(opts.pk.column)} = %s'
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), chunk_size):
+            cursor.executemany(sql, [(*values, pk) for pk, *values in rows[start:start + chunk_size]])
+    DataVersion.bump()
+
+
+def calculate_final_scores(criteria_scores, coefficients):
+    """
+    Считает итоговые баллы по столбцам оценок критериев в том же порядке сложения, что и построчный расчет
+    :param criteria_scores: словарь {критерий: массив оценок}
+    :param coefficients: словарь весовых коэффициентов {'k1': ..., 'k7': ...}
+    :return: массив итоговых баллов
+    """
+    final_scores = np.zeros(len(criteria_scores[const.SCORE_CRITERIA[0]]))
+    for i, criterion in enumerate(const.SCORE_CRITERIA, 1):
+        final_scores += criteria_scores[criterion] * coefficients[f'k{i}']
+    return round_column(final_scores)
+
+
+def rescore_applications(applications=None, chunk_size=1000):
+    """
+    Пересчитывает оценки по критериям, заполненность и итоговый балл заявок за несколько запросов.
+    Значения считаются по столбцам для всех заявок сразу и записываются пачками.
+    :param applications: queryset заявок (все заявки, если None)
+    :param chunk_size: размер пачки при записи в БД
+    :return: количество пересчитанных заявок
+    """
+    applications = (Application.objects.all() if applications is None else applications).order_by()
+    rows = list(applications.with_actual_fullness().annotate(**get_education_annotations()).order_by('pk')
+                .values_list('pk', 'actual_fullness', 'education_coef', 'last_education_avg_score', 'has_postgraduate',
+                             *SCORED_FIELDS))
+    if not rows:
+        return 0
+    columns = np.nan_to_num(np.array(rows, dtype=float))
+    application_ids, fullness = columns[:, 0].astype(np.int64), columns[:, 1].astype(np.int64)
+    coefficients, avg_scores, has_postgraduate = columns[:, 2], columns[:, 3], columns[:, 4].astype(bool)
+    flags = columns[:, 5:]
+
+    scores = dict(zip(const.CRITERIA_FIELDS_SCORES,
+                      round_column(flags @ get_weights_matrix(const.CRITERIA_FIELDS_SCORES)).T))
+    scores['a2'] = round_column(avg_scores * coefficients)
+    scores['a5'] = np.where(has_postgraduate, round_column(
+        const.POSTGRADUATE_ENDED_SCORE + flags @ get_weights_matrix({'a5': const.POSTGRADUATE_FIELDS_SCORES})[:, 0]),
+                            0)
+
+    coefficients = ScoringCoefficients.get_current()
+    final_scores = calculate_final_scores(scores, coefficients.as_dict())
+
+    scores_ids = get_scores_ids(application_ids, applications)
+    with transaction.atomic():
+        bulk_update_columns(ApplicationScores, const.SCORE_CRITERIA,
+                            list(zip(scores_ids, *(scores[criterion].tolist() for criterion in const.SCORE_CRITERIA))),
+                            chunk_size)
+        bulk_update_columns(Application, ['fullness', 'final_score', 'coefficients'],
+                            [(*row, coefficients.pk) for row in zip(application_ids.tolist(), fullness.tolist(),
+                                                                     final_scores.tolist())], chunk_size)
+        ApplicationRank.rebuild_for(applications)
+    return len(rows)
+
+
+def refresh_final_scores(applications, coefficients):
+    """
+    Пересчитывает итоговые баллы заявок по сохраненным оценкам критериев и переданной версии коэффициентов
+    :param applications: queryset заявок
+    :param coefficients: экземпляр ScoringCoefficients
+    :return: словарь {id заявки: итоговый балл}
+    """
+    rows = list(applications.order_by().values_list('pk', *(f'scores__{criterion}'
+                                                            for criterion in const.SCORE_CRITERIA)))
+    if not rows:
+        return {}
+    columns = np.nan_to_num(np.array(rows, dtype=float))
+    application_ids = columns[:, 0].astype(np.int64).tolist()
+    final_scores = calculate_final_scores(dict(zip(const.SCORE_CRITERIA, columns[:, 1:].T)),
+                                          coefficients.as_dict()).tolist()
+    bulk_update_columns(Application, ['final_score', 'coefficients'],
+                        [(pk, final_score, coefficients.pk) for pk, final_score in zip(application_ids, final_scores)])
+    return dict(zip(application_ids, final_scores))
+
+
+def refresh_stale_final_scores(applications=None, chunk_size=1000):
+    """
+    Пересчитывает пачками итоговые баллы заявок, посчитанные по неактуальной версии коэффициентов.
+    Каждая пачка пишется отдельной транзакцией, чтобы не блокировать таблицу заявок целиком.
+    :param applications: queryset заявок (все заявки, если None)
+    :param chunk_size: размер пачки
+    :return: количество пересчитанных заявок
+    """
+    coefficients = ScoringCoefficients.get_current()
+    if coefficients.pk is None:
+        return 0
+    stale = (Application.objects.all() if applications is None else applications) \
+        .exclude(coefficients=coefficients.pk).order_by('pk')
+    count = 0
+    while True:
+        with transaction.atomic():
+            chunk_ids = list(stale.values_list('pk', flat=True)[:chunk_size])
+            count += len(refresh_final_scores(Application.objects.filter(pk__in=chunk_ids), coefficients))
+        if len(chunk_ids) < chunk_size:
+            break
+    # рейтинги пересчитываются и для заявок, итоговый балл которых обновлен при чтении страницы списка
+    stale_ranks = ApplicationRank.objects.exclude(final_score=F('application__final_score'))
+    if applications is not None:
+        stale_ranks = stale_ranks.filter(application__in=applications.order_by().values('pk'))
+    ApplicationRank.rebuild_for(Application.objects.filter(pk__in=stale_ranks.values('application_id')))
+    return count
+
+
+def refresh_stale_applications(applications):
+    """
+    Пересчитывает итоговый балл у переданных экземпляров заявок, если он посчитан по неактуальной версии коэффициентов.
+    Места в рейтингах при чтении не пересчитываются, это делают команды refresh_final_scores и rebuild_ranks.
+    :param applications: список экземпляров Application
+    """
+    # у заявок, загруженных with_current_coefficients, актуальность проверяется без запроса коэффициентов
+    if all(app.coefficients_id == getattr(app, 'current_coefficients_id', -1) for app in applications):
+        return
+    coefficients = ScoringCoefficients.get_current()
+    stale = {app.pk: app for app in applications if app.coefficients_id != coefficients.pk}
+    if not stale or coefficients.pk is None:
+        return
+    for pk, final_score in refresh_final_scores(Application.objects.filter(pk__in=stale), coefficients).items():
+        stale[pk].final_score, stale[pk].coefficients_id = final_score, coefficients.pk
+        stale[pk].reset_dirty_fields(['final_score', 'coefficients_id'])
+
+
+def refresh_stale_rows(rows):
+    """
+    Пересчитывает итоговый балл у строк values() заявок, если он посчитан по неактуальной версии коэффициентов.
+    Места в рейтингах при чтении не пересчитываются, это делают команды refresh_final_scores и rebuild_ranks.
+    :param rows: список словарей со столбцами id, coefficients и, если нужен в ответе, final_score
+    """
+    coefficients = ScoringCoefficients.get_current()
+    stale = {row['id']: row for row in rows if row['coefficients'] != coefficients.pk}
+    if not stale or coefficients.pk is None:
+        return
+    for pk, final_score in refresh_final_scores(Application.objects.filter(pk__in=stale), coefficients).items():
+        stale[pk]['coefficients'] = coefficients.pk
+        if 'final_score' in stale[pk]:
+            stale[pk]['final_score'] = final_score
+
+
+def get_ranks(scores):
+    """
+    Возвращает места в рейтинге по убыванию балла, при равных баллах выше заявка, поданная раньше
+    :param scores: массив баллов в порядке возрастания id заявок
+    :return: массив мест (начиная с 1)
+    """
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[np.argsort(-scores, kind='stable')] = np.arange(1, len(scores) + 1)
+    return ranks
+
+
+def simulate_ranking(applications, coefficients):
+    """
+    Моделирует рейтинг заявок при других весовых коэффициентах без записи в БД.
+    Оценки критериев загружаются одним запросом в матрицу, баллы по текущим и предлагаемым
+    коэффициентам считаются одним умножением матрицы на матрицу весов.
+    :param applications: queryset заявок
+    :param coefficients: словарь предлагаемых весовых коэффициентов {'k1': ..., 'k7': ...}
+    :return: список заявок в порядке нового рейтинга с текущими и новыми баллами и местами
+    """
+    rows = list(applications.order_by('pk').values_list(
+        'pk', 'member__user__last_name', 'member__user__first_name', 'member__father_name',
+        *(f'scores__{criterion}' for criterion in const.SCORE_CRITERIA)))
+    if not rows:
+        return []
+    scores = np.nan_to_num(np.array([row[4:] for row in rows], dtype=float))
+    current_coefficients = ScoringCoefficients.get_current().as_dict()
+    weights = np.array([[current_coefficients[k], coefficients[k]] for k in current_coefficients])
+    current_scores, new_scores = round_column(scores @ weights).T
+    current_ranks, new_ranks = get_ranks(current_scores), get_ranks(new_scores)
+    ranking = [{'id': pk, 'last_name': last_name, 'first_name': first_name, 'father_name': father_name,
+                'current_score': current_score, 'current_rank': current_rank,
+                'new_score': new_score, 'new_rank': new_rank, 'rank_delta': current_rank - new_rank}
+               for (pk, last_name, first_name, father_name, *_), current_score, current_rank, new_score, new_rank
+               in zip(rows, current_scores.tolist(), current_ranks.tolist(), new_scores.tolist(), new_ranks.tolist())]
+    return sorted(ranking, key=lambda app: app['new_rank'])
@@ -0,0 +1,64 @@
+"""
+Поисковый индекс заявок.
+
+У каждой заявки в поле search_document хранится поисковый документ: фамилия, имя, отчество, место рождения,
+субъект военного комиссариата, университеты и специальности образований в нижнем регистре, по строке на значение.
+В SQLite документы индексируются таблицей FTS5 с триграммным токенизатором, в PostgreSQL - GIN индексом pg_trgm
+по search_document (создаются миграцией). Оба индекса ищут подстроку, как icontains, но без соединений
+с участниками и образованиями, DISTINCT и полного просмотра таблицы.
+"""
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+# таблица FTS5 в SQLite, rowid - id заявки
+SEARCH_TABLE = 'application_search'
+# минимальная длина слова для поиска по триграммам, более короткие слова ищутся по search_document
+MIN_TRIGRAM_LENGTH = 3
+
+
+def build_search_document(values):
+    """
+    Собирает поисковый документ заявки
+    :param values: значения полей, участвующих в поиске
+    :return: строка документа
+    """
+    return '\n'.join(str(value).lower() for value in values if value)
+
+
+def update_search_index(connection, documents):
+    """
+    Обновляет документы заявок в таблице FTS5 (в PostgreSQL индекс обновляется вместе с search_document)
+    :param connection: подключение к БД
+    :param documents: словарь {id заявки: поисковый документ}
+    """
+    if connection.vendor != 'sqlite' or not documents:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT OR REPLACE INTO {SEARCH_TABLE}(rowid, search_document) VALUES (%s, %s)',
+                           list(documents.items()))
+
+
+def remove_from_search_index(connection, application_ids):
+    """
+    Удаляет документы заявок из таблицы FTS5
+    :param connection: подключение к БД
+    :param application_ids: id удаленных заявок
+    """
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = %s', [(pk,) for pk in application_ids])
+
+
+def filter_by_search_term(queryset, term):
+    """
+    Оставляет заявки, в поисковом документе которых есть подстрока term (без учета регистра)
+    :param queryset: queryset заявок
+    :param term: слово поискового запроса
+    """
+    term = term.lower()
+    if connections[queryset.db].vendor == 'sqlite' and len(term) >= MIN_TRIGRAM_LENGTH:
+        phrase = '"{}"'.format(term.replace('"', '""'))
+        return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s',
+                                             [phrase]))
+    return queryset.filter(search_document__contains=term)
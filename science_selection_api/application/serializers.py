@@ -4,8 +4,9 @@ from rest_framework import serializers
 from account.models import Member, Booking, Affiliation
 from utils import constants as const
 from .models import Application, Direction, Education, Competence, ApplicationCompetencies, WorkGroup, ApplicationNote, \
-    ViewedApplication, File
+    ViewedApplication, File, ApplicationRank, ExportJob
 from .utils import has_affiliation, get_booking, get_master_affiliations_id
+from .workers import recompute_scores
 
 
 class UserListSerializer(serializers.ModelSerializer):
@@ -25,6 +26,17 @@ class EducationListSerializer(serializers.ModelSerializer):
         fields = ('education_type', 'university', 'specialization')
 
 
+class LastEducationField(serializers.Field):
+    """Последнее образование заявки (или None), читается из копии в заявке без запроса к образованиям"""
+
+    def __init__(self, **kwargs):
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    def to_representation(self, application):
+        education = application.get_last_education_snapshot()
+        return EducationListSerializer(education).data if education else None
+
+
 class EducationDetailSerializer(serializers.ModelSerializer):
     """Образование"""
     education_type_display = serializers.CharField(source='get_education_type_display', read_only=True)
@@ -127,10 +139,22 @@ class ApplicationNoteSerializer(serializers.ModelSerializer):
         super().save(**kwargs)
 
 
-class ApplicationMasterListSerializer(serializers.ModelSerializer):
+class SparseFieldsSerializerMixin:
+    """Оставляет в сериализаторе только поля, переданные в контексте под ключом fields (по умолчанию - все поля)"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get('fields')
+        if fields is not None:
+            for field in set(self.fields) - set(fields):
+                self.fields.pop(field)
+
+
+class ApplicationMasterListSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     """Список заявок для мастера"""
     member = MemberListSerialiser(read_only=True)
     education = EducationListSerializer(many=True)
+    last_education = LastEducationField()
     draft_season = serializers.CharField(source='get_draft_season_display')
     directions = DirectionListSerializer(many=True)
 
@@ -150,20 +174,23 @@ class ApplicationMasterListSerializer(serializers.ModelSerializer):
     wishlist = BookingSerializer(many=True, read_only=True, source='member.candidate')  # в избранном
     notes = ApplicationNoteSerializer(many=True, read_only=True)  # заметки
     is_viewed = serializers.BooleanField(read_only=True)
+    rank = serializers.IntegerField(read_only=True)  # лучшее место в рейтингах направлений мастера
 
     class Meta:
         model = Application
         fields = (
             'id', 'directions', 'draft_season', 'birth_day', 'birth_place', 'draft_year', 'fullness', 'final_score',
-            'member', 'education', 'is_booked', 'is_booked_our', 'can_unbook', 'wishlist_len', 'is_in_wishlist',
-            'our_direction', 'subject', 'available_booking_direction', 'booking', 'wishlist', 'notes', 'is_viewed'
+            'scores_pending', 'rank', 'member', 'education', 'last_education', 'is_booked', 'is_booked_our',
+            'can_unbook', 'wishlist_len', 'is_in_wishlist', 'our_direction', 'subject', 'available_booking_direction',
+            'booking', 'wishlist', 'notes', 'is_viewed'
         )
 
 
-class ApplicationListSerializer(serializers.ModelSerializer):
+class ApplicationListSerializer(SparseFieldsSerializerMixin, serializers.ModelSerializer):
     """Список заявок"""
     member = MemberListSerialiser(read_only=True)
     education = EducationListSerializer(many=True)
+    last_education = LastEducationField()
     draft_season = serializers.CharField(source='get_draft_season_display')
     directions = DirectionListSerializer(many=True)
 
@@ -171,7 +198,7 @@ class ApplicationListSerializer(serializers.ModelSerializer):
         model = Application
         fields = (
             'id', 'directions', 'draft_season', 'birth_day', 'birth_place', 'draft_year', 'fullness', 'final_score',
-            'member', 'education'
+            'scores_pending', 'member', 'education', 'last_education'
         )
 
 
@@ -183,7 +210,7 @@ class ApplicationSlaveCreateSerializer(serializers.ModelSerializer):
         exclude = (
             'directions', 'compliance_prior_direction', 'compliance_additional_direction',
             'postgraduate_additional_direction', 'postgraduate_prior_direction', 'competencies', 'fullness',
-            'final_score', 'is_final', 'work_group', 'member',
+            'final_score', 'scores_pending', 'is_final', 'work_group', 'member',
         )
 
 
@@ -199,7 +226,7 @@ class ApplicationSlaveDetailSerializer(serializers.ModelSerializer):
         model = Application
         exclude = ('compliance_prior_direction', 'compliance_additional_direction',
                    'postgraduate_additional_direction', 'postgraduate_prior_direction', 'competencies', 'fullness',
-                   'final_score', 'work_group', 'create_date', 'update_date')
+                   'final_score', 'scores_pending', 'work_group', 'create_date', 'update_date')
 
 
 class ApplicationMasterDetailSerializer(serializers.ModelSerializer):
@@ -213,7 +240,7 @@ class ApplicationMasterDetailSerializer(serializers.ModelSerializer):
         model = Application
         exclude = ('competencies', 'create_date', 'update_date')
         extra_kwargs = {'final_score': {'read_only': True}, 'is_final': {'read_only': True},
-                        'fullness': {'read_only': True}}
+                        'fullness': {'read_only': True}, 'scores_pending': {'read_only': True}}
 
 
 def validate_work_group(slave_member, work_group):
@@ -257,17 +284,14 @@ class ChooseDirectionListSerializer(serializers.ListSerializer):
 
     def save(self, user_app=None):
         """
-        Сохраняет список полученных направлений в заявку с pk. Обновляет итоговый балл заявки.
+        Сохраняет список полученных направлений в заявку с pk. Обновляет заполненность заявки.
         :param user_app: экземпляр заяви
         :return: None
         """
         directions_ids = [item.pop('id') for item in self.validated_data]
-        if directions_ids:
-            directions = Direction.objects.filter(pk__in=directions_ids)
-            user_app.directions.set(list(directions))
-        else:
-            user_app.directions.clear()
-        user_app.update_scores(update_fields=['fullness', 'final_score'])
+        user_app.set_directions(Direction.objects.filter(pk__in=directions_ids).values_list('pk', flat=True)
+                                if directions_ids else ())
+        recompute_scores(user_app, criteria=(), fullness=True)
 
     def validate(self, data):
         """
@@ -477,7 +501,238 @@ class WorkingListSerializer(ApplicationMasterListSerializer):
         model = Application
         fields = (
             'id', 'directions', 'draft_season', 'birth_day', 'birth_place', 'draft_year', 'fullness', 'final_score',
-            'member', 'education', 'is_booked', 'is_booked_our', 'can_unbook', 'wishlist_len', 'is_in_wishlist',
-            'our_direction', 'subject', 'available_booking_direction', 'booking', 'wishlist', 'notes', 'is_viewed',
-            'competences'
+            'scores_pending', 'rank', 'member', 'education', 'last_education', 'is_booked', 'is_booked_our',
+            'can_unbook', 'wishlist_len', 'is_in_wishlist', 'our_direction', 'subject', 'available_booking_direction',
+            'booking', 'wishlist', 'notes', 'is_viewed', 'competences'
         )
+
+
+class RankingSimulationSerializer(serializers.Serializer):
+    """Предлагаемые весовые коэффициенты и выборка заявок для моделирования рейтинга"""
+    k1 = serializers.FloatField(min_value=0)
+    k2 = serializers.FloatField(min_value=0)
+    k3 = serializers.FloatField(min_value=0)
+    k4 = serializers.FloatField(min_value=0)
+    k5 = serializers.FloatField(min_value=0)
+    k6 = serializers.FloatField(min_value=0)
+    k7 = serializers.FloatField(min_value=0)
+    draft_year = serializers.IntegerField(required=False)
+    draft_season = serializers.ChoiceField(choices=Application.season, required=False)
+    directions = serializers.PrimaryKeyRelatedField(queryset=Direction.objects.all(), many=True, required=False)
+
+
+class ApplicationRankSerializer(serializers.ModelSerializer):
+    """Место заявки в рейтинге направления"""
+    member = MemberListSerialiser(read_only=True, source='application.member')
+
+    class Meta:
+        model = ApplicationRank
+        fields = ('rank', 'application', 'member', 'final_score', 'score_bucket', 'draft_year', 'draft_season',
+                  'direction')
+
+
+class ExportJobSerializer(serializers.ModelSerializer):
+    """Фоновая выгрузка файла"""
+
+    class Meta:
+        model = ExportJob
+        fields = ('id', 'document_type', 'params', 'status', 'filename', 'error', 'create_date', 'finish_date')
+        read_only_fields = ('status', 'filename', 'error', 'create_date', 'finish_date')
+
+    def validate_params(self, value):
+        """Query параметры выгрузки - словарь {параметр: значение или список значений}"""
+        if not isinstance(value, dict) or not all(
+                isinstance(item, str) for values in value.values()
+                for item in (values if isinstance(values, list) else [values])):
+            raise serializers.ValidationError('Ожидается словарь {параметр: строка или список строк}')
+        return value
+
+
+class ApplicationListValues:
+    """
+    Список заявок для мастера в том же виде, что и ApplicationMasterListSerializer (WorkingListSerializer,
+    если передано направление компетенций), собранный из строк values() без экземпляров моделей и сериализаторов.
+    Вложенные списки страницы загружаются одним запросом каждый и группируются по заявке, в порядке Meta.ordering
+    их моделей, как и при загрузке через prefetch_related.
+    """
+    # поля, которые отдаются значением столбца values() без преобразования
+    plain_fields = ('id', 'birth_place', 'draft_year', 'fullness', 'final_score', 'scores_pending', 'rank',
+                    'our_direction', 'subject', 'is_booked', 'is_booked_our', 'can_unbook', 'wishlist_len',
+                    'is_in_wishlist', 'is_viewed')
+    # столбцы values(), нужные для остальных полей
+    field_columns = {
+        'draft_season': ('draft_season',),
+        'birth_day': ('birth_day',),
+        'member': ('member__user__first_name', 'member__user__last_name', 'member__father_name'),
+        'last_education': ('last_education_type', 'last_education_university', 'last_education_specialization'),
+        'booking': ('member_id',),
+        'wishlist': ('member_id',),
+    }
+
+    def __init__(self, member, master_affiliations, master_directions_id, fields=None, competences_direction=None):
+        """
+        :param member: экземпляр Member мастера
+        :param master_affiliations: принадлежности мастера
+        :param master_directions_id: id направлений мастера
+        :param fields: отдаваемые поля (по умолчанию - все поля сериализатора)
+        :param competences_direction: направление, компетенции которого отдаются в рабочем списке
+        """
+        serializer_class = WorkingListSerializer if competences_direction else ApplicationMasterListSerializer
+        self.fields = tuple(field for field in serializer_class.Meta.fields if fields is None or field in fields)
+        self.member = member
+        self.master_affiliations = master_affiliations
+        self.master_directions_id = master_directions_id
+        self.competences_direction = competences_direction
+
+    def get_columns(self):
+        """
+        Возвращает столбцы values(), нужные для отдаваемых полей, и версию коэффициентов итогового балла
+        :return: список столбцов
+        """
+        columns = {'id', 'coefficients'}
+        for field in self.fields:
+            columns.update((field,) if field in self.plain_fields else self.field_columns.get(field, ()))
+        return sorted(columns)
+
+    @staticmethod
+    def get_ordering(model):
+        """Порядок строк вложенного списка - Meta.ordering модели, который применяет и prefetch_related"""
+        return model._meta.ordering
+
+    @staticmethod
+    def get_member(row, prefix):
+        """Участник в виде MemberListSerialiser по столбцам строки с префиксом prefix"""
+        return {'first_name': row[f'{prefix}user__first_name'], 'second_name': row[f'{prefix}user__last_name'],
+                'father_name': row[f'{prefix}father_name']}
+
+    @staticmethod
+    def get_last_education(row):
+        """Последнее образование в виде LastEducationField по копии в строке заявки"""
+        if not row['last_education_type']:
+            return None
+        return {'education_type': dict(const.EDUCATION_PROGRAMS).get(row['last_education_type']),
+                'university': row['last_education_university'],
+                'specialization': row['last_education_specialization']}
+
+    def get_educations(self, application_ids):
+        """
+        Возвращает образования заявок в виде EducationListSerializer
+        :return: словарь {id заявки: [образование]}
+        """
+        education_types = dict(const.EDUCATION_PROGRAMS)
+        educations = {}
+        for application_id, education_type, university, specialization in Education.objects.filter(
+                application__in=application_ids).order_by(*self.get_ordering(Education)) \
+                .values_list('application_id', 'education_type', 'university', 'specialization'):
+            educations.setdefault(application_id, []).append(
+                {'education_type': education_types.get(education_type, education_type), 'university': university,
+                 'specialization': specialization})
+        return educations
+
+    def get_directions(self, application_ids):
+        """
+        Возвращает направления заявок
+        :return: словарь {id заявки: [(id направления, наименование)]}
+        """
+        directions = {}
+        for application_id, *direction in Application.directions.through.objects.filter(
+                application__in=application_ids) \
+                .order_by(*(f'direction__{field}' for field in self.get_ordering(Direction))) \
+                .values_list('application_id', 'direction_id', 'direction__name'):
+            directions.setdefault(application_id, []).append(direction)
+        return directions
+
+    def get_bookings(self, member_ids, **filters):
+        """
+        Возвращает бронирования кандидатов в виде BookingSerializer
+        :param member_ids: id участников заявок
+        :param filters: условия на бронирования
+        :return: словарь {id участника: [бронирование]}
+        """
+        bookings = {}
+        for row in Booking.objects.filter(slave__in=member_ids, **filters).order_by(*self.get_ordering(Booking)) \
+                .values('id', 'slave_id', 'master__user__first_name', 'master__user__last_name', 'master__father_name',
+                        'affiliation_id', 'affiliation__company', 'affiliation__platoon'):
+            affiliation = None if row['affiliation_id'] is None else {
+                'id': row['affiliation_id'], 'company': row['affiliation__company'],
+                'platoon': row['affiliation__platoon']}
+            bookings.setdefault(row['slave_id'], []).append(
+                {'id': row['id'], 'master': self.get_member(row, 'master__'), 'affiliation': affiliation})
+        return bookings
+
+    def get_notes(self, application_ids):
+        """
+        Возвращает заметки мастера о заявках в виде ApplicationNoteSerializer
+        :return: словарь {id заявки: [заметка]}
+        """
+        rows = list(ApplicationNote.objects.filter(application__in=application_ids, author=self.member,
+                                                   affiliations__in=self.master_affiliations)
+                    .order_by(*self.get_ordering(ApplicationNote))
+                    .values('id', 'application_id', 'text', 'author__user__first_name', 'author__user__last_name',
+                            'author__father_name'))
+        affiliations = {}
+        for note_id, affiliation_id in ApplicationNote.affiliations.through.objects.filter(
+                applicationnote__in={row['id'] for row in rows}) \
+                .order_by(*(f'affiliation__{field}' for field in self.get_ordering(Affiliation))) \
+                .values_list('applicationnote_id', 'affiliation_id'):
+            affiliations.setdefault(note_id, []).append(affiliation_id)
+        notes = {}
+        for row in rows:
+            notes.setdefault(row['application_id'], []).append(
+                {'id': row['id'], 'author': self.get_member(row, 'author__'), 'text': row['text'],
+                 'affiliations': affiliations.get(row['id'], [])})
+        return notes
+
+    def get_competences(self, application_ids):
+        """
+        Возвращает оцененные компетенции направления в виде ApplicationShortCompetenciesSerializer
+        :return: словарь {id заявки: [компетенция]}
+        """
+        competences = {}
+        for application_id, level, name in ApplicationCompetencies.objects.filter(
+                application__in=application_ids, competence__directions=self.competences_direction,
+                level__in=[1, 2, 3]).order_by(*self.get_ordering(ApplicationCompetencies)) \
+                .values_list('application_id', 'level', 'competence__name'):
+            competences.setdefault(application_id, []).append({'level': level, 'competence': {'name': name}})
+        return competences
+
+    def to_representation(self, rows):
+        """
+        Собирает список заявок
+        :param rows: строки values() со столбцами get_columns()
+        :return: список словарей заявок
+        """
+        application_ids = [row['id'] for row in rows]
+        member_ids = [row['member_id'] for row in rows if 'member_id' in row]
+        directions = self.get_directions(application_ids) \
+            if {'directions', 'available_booking_direction'} & set(self.fields) else {}
+        master_directions_id = set(self.master_directions_id) if 'available_booking_direction' in self.fields else ()
+        seasons = dict(Application.season)
+        getters = {
+            'directions': lambda row: [{'id': pk, 'name': name} for pk, name in directions.get(row['id'], [])],
+            'available_booking_direction': lambda row: [{'id': pk, 'name': name}
+                                                        for pk, name in directions.get(row['id'], [])
+                                                        if pk in master_directions_id],
+            'draft_season': lambda row: seasons.get(row['draft_season'], row['draft_season']),
+            'birth_day': lambda row: row['birth_day'] and row['birth_day'].isoformat(),
+            'member': lambda row: self.get_member(row, 'member__'),
+            'last_education': self.get_last_education,
+        }
+        if 'education' in self.fields:
+            educations = self.get_educations(application_ids)
+            getters['education'] = lambda row: educations.get(row['id'], [])
+        if 'booking' in self.fields:
+            booking = self.get_bookings(member_ids, booking_type__name=const.BOOKED)
+            getters['booking'] = lambda row: booking.get(row['member_id'], [])
+        if 'wishlist' in self.fields:
+            wishlist = self.get_bookings(member_ids, booking_type__name=const.IN_WISHLIST,
+                                         affiliation__in=self.master_affiliations)
+            getters['wishlist'] = lambda row: wishlist.get(row['member_id'], [])
+        if 'notes' in self.fields:
+            notes = self.get_notes(application_ids)
+            getters['notes'] = lambda row: notes.get(row['id'], [])
+        if 'competences' in self.fields:
+            competences = self.get_competences(application_ids)
+            getters['competences'] = lambda row: competences.get(row['id'], [])
+        getters.update({field: lambda row, field=field: row[field] for field in self.plain_fields})
+        return [{field: getters[field](row) for field in self.fields} for row in rows]
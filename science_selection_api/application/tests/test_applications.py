@@ -1,17 +1,37 @@
+import csv
+import json
 import logging
+import time
 from datetime import datetime
+from io import BytesIO, StringIO
 from random import randint
+from unittest import mock
+from urllib.parse import urlencode
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.http import http_date
+from openpyxl import load_workbook
 from rest_framework import status
 from rest_framework.test import APITestCase
 
-from application.models import Application
+from application.mixins import StreamingListMixin
+from application.models import Application, ApplicationScores, ViewedApplication, MilitaryCommissariat, Education, \
+    DataVersion
+from application.scoring import refresh_stale_final_scores
+from application.serializers import ApplicationListSerializer
 from application.tests.factories import UserFactory, RoleFactory, DirectionFactory, MemberFactory, AffiliationFactory, \
     BookingTypeFactory, BookingFactory, WorkGroupFactory, CompetenceFactory, create_uniq_application, \
-    create_batch_competences_scores, create_uniq_member
-from application.utils import set_is_final, has_application_viewed
+    create_batch_competences_scores, create_uniq_member, EducationFactory, ApplicationNoteFactory, \
+    ApplicationCompetenciesFactory
+from application.utils import set_is_final, has_application_viewed, CursorPaginationApplication, \
+    ApplicationExporter
+from application.views import ApplicationViewSet
 from utils import constants as const
 
 logging.disable(logging.FATAL)
@@ -76,6 +96,14 @@ class ApplicationsTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data.get('results')), 6)
 
+    def test_application_list_ordering_is_not_accumulated(self):
+        """Сортировка запроса не добавляется к сортировке по умолчанию следующих запросов"""
+        self.client.force_login(user=self.master_user)
+        default_ordering = list(ApplicationViewSet.ordering)
+        for _ in range(2):
+            self.client.get(reverse('application-list'), {'ordering': 'final_score'})
+        self.assertEqual(ApplicationViewSet.ordering, default_ordering)
+
     def test_application_list_by_unauthorized_user(self):
         """Получение списка заявок неавторизованным пользователем"""
         response = self.client.get(reverse('application-list'))
@@ -529,7 +557,637 @@ class ApplicationsTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(response.get('Content-Type'), "application/xlsx")
 
+    @mock.patch.object(ApplicationExporter, 'spool_max_size', 1)
+    @mock.patch.object(ApplicationExporter, 'chunk_size', 1)
+    def test_export_applications_in_chunks(self):
+        """Экспорт заявок пачками через временный файл"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('application-export-applications-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        sheet = load_workbook(BytesIO(b''.join(response.streaming_content))).active
+        self.assertEqual(sheet.max_row, Application.objects.count() + 1)
+        self.assertEqual([cell.value for cell in sheet[1]], const.HEADERS_FOR_EXCEL_APP_TABLES)
+
     def test_export_applications_by_unauthorized_user(self):
         """Экспорт списка анкет неавторизованным пользователем"""
         response = self.client.get(reverse('application-export-applications-list'))
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@mock.patch.object(CursorPaginationApplication, 'page_size', 3)
+class CursorPaginationTest(APITestCase):
+    def setUp(self) -> None:
+        direction = DirectionFactory.create()
+        self.affiliation = AffiliationFactory.create(direction=direction)
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[self.affiliation], user=self.master_user,
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        # половина заявок подана на направление мастера, итоговые баллы повторяются
+        for i in range(8):
+            app = create_uniq_application(slave_role, directions=[direction] if i % 2 else DirectionFactory.create_batch(1))
+            ApplicationScores.objects.create(application=app, a1=i // 3)
+            app.refresh_final_score()
+            app.save()
+        self.client.force_login(user=self.master_user)
+
+    def walk(self, params, url_name='application-list'):
+        """Проходит список по ссылкам next, затем обратно по ссылкам previous и возвращает страницы"""
+        pages = []
+        url = reverse(url_name) + '?' + urlencode({**params, 'pagination': 'cursor'})
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            pages.append([app['id'] for app in response.data['results']])
+            url, previous = response.data['next'], response.data['previous']
+        backward_pages = [pages[-1]]
+        while previous:
+            response = self.client.get(previous)
+            backward_pages.append([app['id'] for app in response.data['results']])
+            previous = response.data['previous']
+        self.assertEqual(list(reversed(backward_pages)), pages)
+        return pages
+
+    def get_apps(self, params=None):
+        """Возвращает заявки списка без курсорной пагинации"""
+        return self.client.get(reverse('application-list'), params or {}).data['results']
+
+    def test_default_ordering(self):
+        """Курсорная пагинация с сортировкой по умолчанию и id"""
+        pages = self.walk({})
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        apps = sorted(self.get_apps(), key=lambda app: (not app['our_direction'], app['id']))
+        self.assertEqual(sum(pages, []), [app['id'] for app in apps])
+
+    def test_ordering_by_final_score(self):
+        """Курсорная пагинация по составной сортировке с повторяющимися значениями"""
+        pages = self.walk({'ordering': '-final_score'})
+        apps = sorted(self.get_apps(), key=lambda app: (not app['our_direction'], -app['final_score'], app['id']))
+        self.assertEqual(sum(pages, []), [app['id'] for app in apps])
+
+    def test_ordering_by_nullable_field(self):
+        """Заявки без места в рейтинге идут в конце"""
+        pages = self.walk({'ordering': 'rank'})
+        apps = sorted(self.get_apps(), key=lambda app: (not app['our_direction'], app['rank'] is None,
+                                                        app['rank'] or 0, app['id']))
+        self.assertEqual(sum(pages, []), [app['id'] for app in apps])
+
+    def test_page_cost_does_not_depend_on_depth(self):
+        """Последняя страница запрашивается так же, как первая: без OFFSET и подсчета"""
+        url = reverse('application-list') + '?pagination=cursor'
+        with CaptureQueriesContext(connection) as first_page_queries:
+            response = self.client.get(url)
+        url = self.client.get(response.data['next']).data['next']
+        with CaptureQueriesContext(connection) as last_page_queries:
+            self.client.get(url)
+        self.assertEqual(len(first_page_queries), len(last_page_queries))
+        self.assertFalse([query for query in last_page_queries
+                          if 'OFFSET' in query['sql'] or query['sql'].startswith('SELECT COUNT(*)')])
+
+    def test_invalid_cursor(self):
+        """Неверный курсор"""
+        response = self.client.get(reverse('application-list'), {'cursor': 'invalid'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_working_list(self):
+        """Курсорная пагинация рабочего списка"""
+        pages = self.walk({'affiliation': self.affiliation.id}, url_name='working-list')
+        self.assertEqual(len(sum(pages, [])), 4)
+
+
+class SparseFieldsetTest(APITestCase):
+    def setUp(self) -> None:
+        direction = DirectionFactory.create()
+        self.affiliation = AffiliationFactory.create(direction=direction)
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[self.affiliation], user=self.master_user,
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        for _ in range(3):
+            create_uniq_application(slave_role, directions=[direction])
+        self.client.force_login(user=self.master_user)
+
+    def get_list(self, params, url_name='application-list'):
+        """Возвращает список заявок и количество запросов к БД"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results'], len(queries)
+
+    def test_fields(self):
+        """Отдаются только запрошенные поля за меньшее число запросов"""
+        full, full_queries = self.get_list({})
+        sparse, sparse_queries = self.get_list({'fields': 'id,member,final_score'})
+        self.assertEqual(sparse,
+                         [{'id': app['id'], 'member': app['member'], 'final_score': app['final_score']}
+                          for app in full])
+        self.assertLess(sparse_queries, full_queries)
+
+    def test_omit(self):
+        """Исключенные поля не отдаются"""
+        full, _ = self.get_list({})
+        sparse, _ = self.get_list({'omit': 'notes,wishlist,booking,is_viewed'})
+        self.assertEqual(sparse, [{field: value for field, value in app.items()
+                                   if field not in ('notes', 'wishlist', 'booking', 'is_viewed')} for app in full])
+
+    def test_ordering_by_pruned_annotation(self):
+        """Сортировка по полю, которое не отдается"""
+        full, _ = self.get_list({'ordering': 'rank'})
+        sparse, _ = self.get_list({'ordering': 'rank', 'fields': 'id'})
+        self.assertCountEqual(sparse, [{'id': app['id']} for app in full])
+
+    def test_slave_list_serializer(self):
+        """Список для кандидата также отдает только запрошенные поля"""
+        data = ApplicationListSerializer(Application.objects.all(), many=True,
+                                         context={'fields': ('id', 'final_score')}).data
+        self.assertEqual([set(app) for app in data], [{'id', 'final_score'}] * 3)
+
+    def test_unknown_field(self):
+        """Неизвестное поле"""
+        response = self.client.get(reverse('application-list'), {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_working_list(self):
+        """Рабочий список без компетенций"""
+        full, full_queries = self.get_list({'affiliation': self.affiliation.id}, url_name='working-list')
+        sparse, sparse_queries = self.get_list({'affiliation': self.affiliation.id, 'omit': 'competences'},
+                                               url_name='working-list')
+        self.assertEqual(sparse, [{field: value for field, value in app.items() if field != 'competences'}
+                                  for app in full])
+        self.assertLess(sparse_queries, full_queries)
+
+
+class ApplicationListValuesTest(APITestCase):
+    def setUp(self) -> None:
+        direction, other_direction = DirectionFactory.create_batch(2)
+        self.affiliation = AffiliationFactory.create(direction=direction)
+        second_affiliation = AffiliationFactory.create(direction=direction)
+        other_affiliation = AffiliationFactory.create(direction=other_direction)
+        master_role = RoleFactory.create(role_name=const.MASTER_ROLE_NAME)
+        self.master_user = UserFactory.create()
+        master = MemberFactory.create(affiliations=[self.affiliation, second_affiliation], user=self.master_user,
+                                      role=master_role)
+        other_master = MemberFactory.create(affiliations=[other_affiliation], role=master_role)
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        apps = [create_uniq_application(slave_role, directions=[direction, other_direction][:i % 2 + 1])
+                for i in range(4)]
+        EducationFactory.create(application=apps[0], education_type='b', end_year=2018)
+        EducationFactory.create(application=apps[0], education_type='m', end_year=2020)
+        EducationFactory.create(application=apps[1], education_type='b')
+        self.apps = apps
+        booked, in_wishlist = BookingTypeFactory.create(), BookingTypeFactory.create(name=const.IN_WISHLIST)
+        BookingFactory.create(master=master, slave=apps[0].member, booking_type=booked, affiliation=self.affiliation)
+        BookingFactory.create(master=other_master, slave=apps[1].member, booking_type=booked,
+                              affiliation=other_affiliation)
+        BookingFactory.create(master=master, slave=apps[2].member, booking_type=in_wishlist,
+                              affiliation=second_affiliation)
+        BookingFactory.create(master=other_master, slave=apps[2].member, booking_type=in_wishlist,
+                              affiliation=other_affiliation)
+        # заметка видна в двух принадлежностях мастера
+        ApplicationNoteFactory.create(application=apps[0], author=master,
+                                      affiliations=[self.affiliation, second_affiliation])
+        ApplicationNoteFactory.create(application=apps[1], author=other_master, affiliations=[other_affiliation])
+        # несколько заметок и бронирований одной заявки
+        ApplicationNoteFactory.create(application=apps[0], author=master, affiliations=[second_affiliation])
+        ApplicationNoteFactory.create(application=apps[2], author=master, affiliations=[self.affiliation])
+        BookingFactory.create(master=master, slave=apps[2].member, booking_type=in_wishlist,
+                              affiliation=self.affiliation)
+        BookingFactory.create(master=other_master, slave=apps[0].member, booking_type=in_wishlist,
+                              affiliation=other_affiliation)
+        ViewedApplication.objects.create(application=apps[3], member=master)
+        competence = CompetenceFactory.create(parent_node=None, directions=[direction])
+        for app in apps:
+            ApplicationCompetenciesFactory.create(application=app, competence=competence, level=app.pk % 4)
+        self.client.force_login(user=self.master_user)
+
+    def assert_parity(self, url_name, params):
+        """Проверяет, что ответы через values() и через сериализаторы совпадают"""
+        expected = self.client.get(reverse(url_name), params)
+        with override_settings(APPLICATION_LIST_VALUES=True):
+            response = self.client.get(reverse(url_name), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), expected.json())
+        return response.json()
+
+    def test_application_list(self):
+        """Главный список заявок"""
+        self.assertEqual(len(self.assert_parity('application-list', {})['results']), 4)
+        self.assert_parity('application-list', {'ordering': '-final_score'})
+
+    def test_education_fields(self):
+        """В списке все образования заявки и отдельно последнее образование из копии в заявке"""
+        results = {app['id']: app for app in self.assert_parity('application-list', {})['results']}
+        self.assertEqual([education['education_type'] for education in results[self.apps[0].pk]['education']],
+                         ['Магистратура', 'Бакалавриат'])
+        self.assertEqual(results[self.apps[0].pk]['last_education']['education_type'], 'Магистратура')
+        self.assertIsNone(results[self.apps[2].pk]['last_education'])
+
+    def test_sparse_fields(self):
+        """Список с частью полей"""
+        self.assert_parity('application-list', {'fields': 'id,booking,wishlist,notes'})
+        self.assert_parity('application-list', {'omit': 'member,directions,is_viewed'})
+
+    def test_cursor_pagination(self):
+        """Курсорная пагинация строк values()"""
+        with mock.patch.object(CursorPaginationApplication, 'page_size', 3):
+            response = self.assert_parity('application-list', {'pagination': 'cursor'})
+            self.assertEqual(len(self.client.get(response['next']).json()['results']), 1)
+
+    def test_working_list(self):
+        """Рабочий список с компетенциями"""
+        self.assert_parity('working-list', {'affiliation': self.affiliation.id})
+
+    def test_streaming(self):
+        """Потоковая выдача всего списка пачками совпадает со страницей списка"""
+        for url_name, params in (('application-list', {'ordering': '-final_score'}),
+                                 ('working-list', {'affiliation': self.affiliation.id})):
+            for list_values in (True, False):
+                with override_settings(APPLICATION_LIST_VALUES=list_values), \
+                        mock.patch.object(StreamingListMixin, 'stream_chunk_size', 3):
+                    expected = self.client.get(reverse(url_name), params).json()['results']
+                    response = self.client.get(reverse(url_name), {**params, 'page_size': 'all'})
+                    self.assertEqual(response.status_code, status.HTTP_200_OK)
+                    self.assertTrue(response.streaming)
+                    self.assertEqual(json.loads(b''.join(response.streaming_content)), expected)
+
+
+class ApplicationExportTest(APITestCase):
+    def setUp(self) -> None:
+        direction = DirectionFactory.create()
+        self.affiliation = AffiliationFactory.create(direction=direction)
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[self.affiliation], user=self.master_user,
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+        self.slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.competence = CompetenceFactory.create(parent_node=None, directions=[direction])
+        self.direction = direction
+        self.apps = [self.create_application() for _ in range(2)]
+        self.client.force_login(user=self.master_user)
+
+    def create_application(self):
+        app = create_uniq_application(self.slave_role, directions=[self.direction])
+        EducationFactory.create(application=app)
+        ApplicationCompetenciesFactory.create(application=app, competence=self.competence, level=3)
+        return app
+
+    def export(self, url_name, **params):
+        """Возвращает строки выгруженного файла без заголовка и количество запросов"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name), params)
+            content = b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        rows = [[cell.value for cell in row] for row in load_workbook(BytesIO(content)).active.iter_rows(min_row=2)]
+        return rows, len(queries)
+
+    def test_constant_queries(self):
+        """Количество запросов не зависит от количества заявок"""
+        for url_name, params in (('application-export-applications-list', {}),
+                                 ('working-export-working-list', {'affiliation': self.affiliation.id})):
+            self.export(url_name, **params)
+            rows, queries = self.export(url_name, **params)
+            self.create_application()
+            self.create_application()
+            self.export(url_name, **params)
+            more_rows, more_queries = self.export(url_name, **params)
+            self.assertEqual(len(more_rows), len(rows) + 2)
+            self.assertEqual(more_queries, queries)
+
+    def test_filters(self):
+        """Экспорт учитывает фильтры, поиск и сортировку списка"""
+        for app, draft_year in zip(self.apps, (2031, 2032)):
+            app.draft_year = draft_year
+            app.save()
+        user = self.apps[1].member.user
+        user.last_name = 'Яковлев'
+        user.save()
+        rows, _ = self.export('application-export-applications-list', draft_year=2031)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][0].split()[0], self.apps[0].member.user.last_name)
+        rows, _ = self.export('working-export-working-list', affiliation=self.affiliation.id, search='яковлев')
+        self.assertEqual([row[0].split()[0] for row in rows], ['Яковлев'])
+        rows, _ = self.export('application-export-applications-list', ordering='-member__user__last_name')
+        self.assertEqual(rows[0][0].split()[0], 'Яковлев')
+
+    @staticmethod
+    def normalize(value):
+        """Приводит значение ячейки к общему виду для сравнения форматов"""
+        if value is None:
+            return ''
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+    def test_formats(self):
+        """Выгрузка в CSV и JSON Lines по параметру format и заголовку Accept совпадает с XLSX"""
+        for url_name, header, params in (
+                ('application-export-applications-list', const.HEADERS_FOR_EXCEL_APP_TABLES, {}),
+                ('working-export-working-list', const.WORK_LIST_HEADERS_FOR_EXCEL, {'affiliation': self.affiliation.id})):
+            rows, _ = self.export(url_name, **params)
+            expected = [list(map(self.normalize, row)) for row in rows]
+            with mock.patch.object(ApplicationExporter, 'chunk_size', 1):
+                response = self.client.get(reverse(url_name), {**params, 'format': 'csv'})
+                self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+                self.assertIn('.csv', response['Content-Disposition'])
+                csv_rows = list(csv.reader(StringIO(b''.join(response.streaming_content).decode())))
+                self.assertEqual(csv_rows[0], header)
+                self.assertEqual([list(map(self.normalize, row)) for row in csv_rows[1:]], expected)
+                response = self.client.get(reverse(url_name), params, HTTP_ACCEPT='application/jsonl')
+                self.assertEqual(response['Content-Type'], 'application/jsonl; charset=utf-8')
+                lines = b''.join(response.streaming_content).decode().splitlines()
+                self.assertEqual([list(json.loads(line).keys()) for line in lines], [header] * len(rows))
+                self.assertEqual([list(map(self.normalize, json.loads(line).values())) for line in lines], expected)
+
+    def test_format_errors(self):
+        """Ошибки отдаются в JSON, неизвестный формат - 404"""
+        response = self.client.get(reverse('working-export-working-list'), {'format': 'csv'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertTrue(response.json())
+        response = self.client.get(reverse('application-export-applications-list'), {'format': 'pdf'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ConditionalGetTest(APITestCase):
+    def setUp(self) -> None:
+        # изменения данных фиксируются, чтобы версия данных в тестах увеличивалась после setUp
+        with self.captureOnCommitCallbacks(execute=True):
+            direction = DirectionFactory.create()
+            self.affiliation = AffiliationFactory.create(direction=direction)
+            master_role = RoleFactory.create(role_name=const.MASTER_ROLE_NAME)
+            self.master_user, self.other_master_user = UserFactory.create_batch(2)
+            self.master = MemberFactory.create(affiliations=[self.affiliation], user=self.master_user, role=master_role)
+            MemberFactory.create(affiliations=[self.affiliation], user=self.other_master_user, role=master_role)
+            slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+            self.apps = [create_uniq_application(slave_role, directions=[direction]) for _ in range(2)]
+            # итоговые баллы пересчитываются при первом запросе списка, что тоже меняет версию данных
+            refresh_stale_final_scores()
+        self.client.force_login(user=self.master_user)
+
+    def get(self, url, **headers):
+        """Выполняет GET запрос и возвращает ответ и запросы к таблице заявок"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **headers)
+        return response, [query for query in queries if '"application_application"' in query['sql']]
+
+    def test_list_not_modified(self):
+        """Неизмененный список отдается ответом 304 без запросов к заявкам"""
+        response, _ = self.get(reverse('application-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Last-Modified', response)
+        response, app_queries = self.get(reverse('application-list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertFalse(app_queries)
+        self.assertFalse(response.content)
+
+    def test_if_modified_since(self):
+        """If-Modified-Since не учитывается: изменения в ту же секунду не должны давать 304"""
+        response, _ = self.get(reverse('application-list'), HTTP_IF_MODIFIED_SINCE=http_date(time.time() + 60))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_modified(self):
+        """После изменения бронирований, заметок и образований список отдается заново"""
+        etag = self.client.get(reverse('application-list'))['ETag']
+        changes = (
+            lambda: BookingFactory.create(master=self.master, slave=self.apps[0].member,
+                                          booking_type=BookingTypeFactory.create(), affiliation=self.affiliation),
+            lambda: ApplicationNoteFactory.create(application=self.apps[0], author=self.master,
+                                                  affiliations=[self.affiliation]),
+            lambda: EducationFactory.create(application=self.apps[1]),
+            lambda: ViewedApplication.objects.create(application=self.apps[1], member=self.master),
+        )
+        for change in changes:
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            response = self.client.get(reverse('application-list'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+    def test_etag_depends_on_user(self):
+        """Ответ другого мастера не считается актуальным"""
+        etag = self.client.get(reverse('application-list'))['ETag']
+        self.client.force_login(user=self.other_master_user)
+        response = self.client.get(reverse('application-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_retrieve_and_nested(self):
+        """Заявка и вложенные эндпоинты"""
+        for url_name in ('application-detail', 'application-get-chosen-direction-list',
+                         'application-get-competences-list'):
+            url = reverse(url_name, args=(self.apps[0].pk,))
+            etag = self.client.get(url)['ETag']
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.apps[0].birth_place = 'Москва'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.apps[0].save()
+        response = self.client.get(reverse('application-detail', args=(self.apps[0].pk,)), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_retrieve_checks_object(self):
+        """ETag списка не отдает 304 для несуществующей заявки и заявки, к которой нет доступа"""
+        etag = self.client.get(reverse('application-list'))['ETag']
+        response = self.client.get(reverse('application-detail', args=(0,)), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_login(user=self.apps[0].member.user)
+        etag = self.client.get(reverse('application-detail', args=(self.apps[0].pk,)))['ETag']
+        response = self.client.get(reverse('application-detail', args=(self.apps[1].pk,)), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_version_bumped_once(self):
+        """Версия данных увеличивается после фиксации транзакции один раз на транзакцию и на запрос"""
+        version = DataVersion.get().version
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.apps[0].birth_place = 'Москва'
+            self.apps[0].save()
+            EducationFactory.create(application=self.apps[0])
+            self.assertEqual(DataVersion.get().version, version)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(DataVersion.get().version, version + 1)
+        self.client.force_login(user=self.apps[1].member.user)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.client.patch(reverse('application-detail', args=(self.apps[1].pk,)),
+                                         data={'patents': not self.apps[1].patents})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([callback for callback in callbacks if callback.__qualname__.startswith('DataVersion')]),
+                         1)
+        self.assertEqual(DataVersion.get().version, version + 2)
+
+    def test_unauthenticated(self):
+        """Проверка прав выполняется до проверки версии"""
+        etag = self.client.get(reverse('application-list'))['ETag']
+        self.client.logout()
+        response = self.client.get(reverse('application-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class CachedCountTest(APITestCase):
+    def setUp(self) -> None:
+        cache.clear()
+        # изменения данных фиксируются, чтобы версия данных в тестах увеличивалась после setUp
+        with self.captureOnCommitCallbacks(execute=True):
+            direction = DirectionFactory.create()
+            self.affiliation = AffiliationFactory.create(direction=direction)
+            self.master = MemberFactory.create(affiliations=[self.affiliation], user=UserFactory.create(),
+                                               role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+            self.slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+            self.apps = [create_uniq_application(self.slave_role, directions=[direction]) for _ in range(3)]
+            refresh_stale_final_scores()
+        self.client.force_login(user=self.master.user)
+
+    def get_count(self, **params):
+        """Возвращает количество заявок в ответе и количество запросов COUNT"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('application-list'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['count'], len([query for query in queries if query['sql'].startswith('SELECT COUNT(*)')])
+
+    def test_count_cached(self):
+        """Количество считается один раз для набора фильтров, сортировка и страница на него не влияют"""
+        self.assertEqual(self.get_count(), (3, 1))
+        self.assertEqual(self.get_count(ordering='-final_score', page=1), (3, 0))
+        self.assertEqual(self.get_count(draft_year=self.apps[0].draft_year)[1], 1)
+
+    def test_count_invalidated(self):
+        """Кеш сбрасывается при изменении заявок и бронирований"""
+        self.get_count()
+        with self.captureOnCommitCallbacks(execute=True):
+            create_uniq_application(self.slave_role, directions=[])
+        self.assertEqual(self.get_count(), (4, 1))
+        with self.captureOnCommitCallbacks(execute=True):
+            BookingFactory.create(master=self.master, slave=self.apps[0].member,
+                                  booking_type=BookingTypeFactory.create(), affiliation=self.affiliation)
+        self.assertEqual(self.get_count(), (4, 1))
+
+    def test_count_without_unused_annotations(self):
+        """Запрос количества не считает аннотации, не участвующие в фильтрах"""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('application-list'))
+        count_query = next(query['sql'] for query in queries if query['sql'].startswith('SELECT COUNT(*)'))
+        self.assertNotIn('application_applicationrank', count_query)
+        self.assertNotIn('account_booking', count_query)
+
+    @override_settings(APPLICATION_APPROXIMATE_COUNT=True)
+    def test_approximate_count(self):
+        """Приблизительное количество не сверяется с версией данных"""
+        self.get_count()
+        create_uniq_application(self.slave_role, directions=[])
+        self.assertEqual(self.get_count(), (3, 0))
+
+    @override_settings(APPLICATION_COUNT_CACHE_TIMEOUT=0)
+    def test_cache_disabled(self):
+        """Кеширование отключается нулевым временем кеширования"""
+        self.get_count()
+        self.assertEqual(self.get_count(), (3, 1))
+
+
+class ApplicationSearchTest(APITestCase):
+    def setUp(self) -> None:
+        direction = DirectionFactory.create()
+        self.affiliation = AffiliationFactory.create(direction=direction)
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[self.affiliation], user=self.master_user,
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.apps = [create_uniq_application(slave_role, directions=[direction]) for _ in range(3)]
+        self.ivanov = self.apps[0]
+        self.ivanov.member.user.last_name = 'Иванов'
+        self.ivanov.member.user.save()
+        self.ivanov.birth_place = 'Нижний Новгород'
+        self.ivanov.military_commissariat = 'Ленинский'
+        self.ivanov.save()
+        MilitaryCommissariat.objects.create(name='Ленинский', subject='Самарская область', city='Самара')
+        EducationFactory.create(application=self.apps[1], university='МГТУ им. Баумана', specialization='Информатика')
+        self.client.force_login(user=self.master_user)
+
+    def search(self, query, url_name='application-list', **params):
+        """Возвращает id найденных заявок"""
+        response = self.client.get(reverse(url_name), {'search': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {app['id'] for app in response.data['results']}
+
+    def test_search_by_fields(self):
+        """Поиск по подстроке ФИО, места рождения, субъекта и образования без учета регистра"""
+        self.assertEqual(self.search('иванОВ'), {self.ivanov.pk})
+        self.assertEqual(self.search('новгор'), {self.ivanov.pk})
+        self.assertEqual(self.search('самарская'), {self.ivanov.pk})
+        self.assertEqual(self.search('баумана'), {self.apps[1].pk})
+        self.assertEqual(self.search('ИНФОРМ'), {self.apps[1].pk})
+        self.assertEqual(self.search('несуществующий'), set())
+
+    def test_all_terms_required(self):
+        """Каждое слово запроса должно встречаться в документе"""
+        self.assertEqual(self.search('иванов нижний'), {self.ivanov.pk})
+        self.assertEqual(self.search('иванов баумана'), set())
+
+    def test_short_term(self):
+        """Слова короче триграммы ищутся по полю документа"""
+        expected = {app.pk for app in Application.objects.select_related('member__user')
+                    if 'ов' in ' '.join((app.member.user.first_name, app.member.user.last_name,
+                                         app.member.father_name or '', app.birth_place)).lower()}
+        self.assertIn(self.ivanov.pk, expected)
+        self.assertEqual(self.search('ОВ'), expected)
+
+    def test_document_kept_after_full_save(self):
+        """Полное сохранение созданной заявки не затирает ее поисковый документ"""
+        app = create_uniq_application(self.apps[0].member.role, directions=[self.affiliation.direction])
+        app.hobby = 'Шахматы'
+        app.save()
+        self.assertIn(app.pk, self.search(app.member.user.last_name[:2]))
+
+    def test_document_updates(self):
+        """Документ обновляется при изменении пользователя, заявки, образований и комиссариата"""
+        user = self.apps[2].member.user
+        user.first_name = 'Аркадий'
+        user.save()
+        self.assertEqual(self.search('аркад'), {self.apps[2].pk})
+        self.ivanov.birth_place = 'Казань'
+        self.ivanov.save()
+        self.assertEqual(self.search('новгород'), set())
+        Education.objects.get(application=self.apps[1]).delete()
+        self.assertEqual(self.search('баумана'), set())
+        MilitaryCommissariat.objects.filter(name='Ленинский').update(subject='Тверская область')
+        MilitaryCommissariat.objects.get(name='Ленинский').save()
+        self.assertEqual(self.search('тверская'), {self.ivanov.pk})
+
+    def test_working_list(self):
+        """Поиск в рабочем списке"""
+        self.assertEqual(self.search('иванов', url_name='working-list', affiliation=self.affiliation.id),
+                         {self.ivanov.pk})
+
+    def test_no_joins(self):
+        """Поиск не соединяет заявки с образованиями и не использует DISTINCT"""
+        with CaptureQueriesContext(connection) as queries:
+            self.search('баумана')
+        search_queries = [query['sql'] for query in queries if 'application_search' in query['sql']]
+        self.assertTrue(search_queries)
+        self.assertFalse([sql for sql in search_queries if 'DISTINCT' in sql or 'JOIN "application_education"' in sql])
+
+    def test_education_change_writes(self):
+        """Изменение образования, не входящего в документ, не перезаписывает документ и поисковый индекс"""
+        education = Education.objects.get(application=self.apps[1])
+        education.avg_score = 3.5
+        with CaptureQueriesContext(connection) as queries:
+            education.save()
+        self.assertFalse([query for query in queries if 'application_search' in query['sql'] or
+                          'search_document" =' in query['sql']])
+        self.assertEqual(Application.objects.get(pk=self.apps[1].pk).last_education_avg_score, 3.5)
+        education.specialization = 'Математика'
+        education.save()
+        self.assertEqual(self.search('математика'), {self.apps[1].pk})
+        self.assertEqual(self.search('информатика'), set())
+        education.delete()
+        self.assertEqual(self.search('баумана'), set())
+        self.assertEqual(Application.objects.get(pk=self.apps[1].pk).last_education_type, '')
+
+    def test_rebuild_command(self):
+        """Пересборка документов командой"""
+        Application.objects.update(search_document='')
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM application_search')
+        self.assertEqual(self.search('иванов'), set())
+        call_command('rebuild_search_index', stdout=mock.MagicMock())
+        self.assertEqual(self.search('иванов'), {self.ivanov.pk})
@@ -0,0 +1,310 @@
+"""
+Бенчмарки путей записи, пересчитывающих баллы заявки, и списка заявок мастера.
+
+Для каждого пути записи при разном количестве образований, направлений, компетенций и файлов заявки измеряются
+количество запросов к БД и время выполнения запроса. Результаты сохраняются в json отчет
+(переменная окружения BENCHMARK_REPORT_PATH, по умолчанию - во временной папке) и сравниваются с базовыми
+значениями из benchmarks_baseline.json: тест падает, если запросов стало больше или время выросло больше чем
+в BENCHMARK_TIME_TOLERANCE раз. Чтобы перезаписать базовые значения, запустите тесты
+с BENCHMARK_UPDATE_BASELINE=1.
+
+Для списка заявок мастера аннотации get_applications_by_master сравниваются с прежними аннотациями
+на Count(..., distinct=True): совпадение значений, планы запросов и время подсчета и выборки первой страницы.
+По умолчанию используется небольшое количество заявок, для замеров на больших объемах задайте размеры
+в BENCHMARK_MASTER_LIST_SIZES, например BENCHMARK_MASTER_LIST_SIZES=10000,50000,100000. Отчет сохраняется
+в BENCHMARK_MASTER_LIST_REPORT_PATH.
+"""
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.db.models import Count, F, Q
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from account.models import Member, Booking, BookingType
+from application.models import Application, ViewedApplication
+from application.tests.factories import RoleFactory, DirectionFactory, EducationFactory, FileFactory, \
+    CompetenceFactory, ApplicationCompetenciesFactory, AffiliationFactory, MemberFactory, UserFactory, \
+    create_uniq_application
+from application.utils import get_applications_by_master
+from utils import constants as const
+
+logging.disable(logging.FATAL)
+
+temp_root = tempfile.mkdtemp()  # временная папка для хранения медиа в тестах
+
+BASELINE_PATH = Path(__file__).with_name('benchmarks_baseline.json')
+REPORT_PATH = Path(os.environ.get('BENCHMARK_REPORT_PATH',
+                                  Path(tempfile.gettempdir()) / 'write_paths_benchmark.json'))
+UPDATE_BASELINE = os.environ.get('BENCHMARK_UPDATE_BASELINE') == '1'
+TIME_TOLERANCE = float(os.environ.get('BENCHMARK_TIME_TOLERANCE', 5))
+TIME_SLACK = 0.05  # секунды, которые не считаются регрессией на быстрых запросах
+SIZES = (1, 5, 20)
+MASTER_LIST_SIZES = tuple(int(size) for size in os.environ.get('BENCHMARK_MASTER_LIST_SIZES', '300').split(','))
+MASTER_LIST_REPORT_PATH = Path(os.environ.get('BENCHMARK_MASTER_LIST_REPORT_PATH',
+                                              Path(tempfile.gettempdir()) / 'master_list_benchmark.json'))
+MASTER_LIST_PAGE_SIZE = 10
+MASTER_LIST_REPEATS = 3
+# аннотации списка заявок мастера, значения которых сравниваются
+MASTER_LIST_ANNOTATIONS = ('is_booked', 'is_booked_our', 'can_unbook', 'wishlist_len', 'is_in_wishlist',
+                           'our_direction', 'is_viewed')
+
+
+@override_settings(MEDIA_ROOT=temp_root)
+class WritePathsBenchmarkTest(APITestCase):
+    results = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.baseline = json.loads(BASELINE_PATH.read_text()) if BASELINE_PATH.exists() else {}
+
+    @classmethod
+    def tearDownClass(cls):
+        """Сохраняет отчет и удаляет временную папку с медиа файлами."""
+        super().tearDownClass()
+        shutil.rmtree(temp_root, ignore_errors=True)
+        report = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'results': cls.results,
+                  'baseline': cls.baseline}
+        REPORT_PATH.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+        if UPDATE_BASELINE:
+            BASELINE_PATH.write_text(json.dumps(cls.results, ensure_ascii=False, indent=2, sort_keys=True) + '\n')
+
+    def setUp(self) -> None:
+        self.slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+
+    def create_application(self, size):
+        """
+        Создает заявку с size образованиями, направлениями, оцененными компетенциями и файлами
+        и авторизует ее владельца
+        """
+        with self.captureOnCommitCallbacks(execute=True):
+            application = create_uniq_application(self.slave_role, directions=DirectionFactory.create_batch(size))
+            for i in range(size):
+                EducationFactory.create(application=application, education_type='b', avg_score=4.0,
+                                        end_year=2000 + i, is_ended=True)
+            for competence in CompetenceFactory.create_batch(size, parent_node=None):
+                ApplicationCompetenciesFactory.create(application=application, competence=competence, level=1)
+            FileFactory.create_batch(size, member=application.member)
+            application.refresh_from_db()
+            application.update_scores()
+        self.client.force_login(user=application.member.user)
+        return application
+
+    def measure(self, path, size, request):
+        """
+        Выполняет запрос, запоминает количество запросов к БД и время и сравнивает их с базовыми значениями.
+        Callback'и transaction.on_commit запроса (увеличение версии данных) выполняются и учитываются в замере,
+        поэтому данные для запроса тоже создаются с выполнением callback'ов.
+        :param path: название измеряемого пути
+        :param size: количество связанных с заявкой объектов
+        :param request: функция, выполняющая запрос
+        """
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            with self.captureOnCommitCallbacks(execute=True):
+                response = request()
+            elapsed = time.perf_counter() - start
+        self.assertLess(response.status_code, 300, response.data)
+        self.results.setdefault(path, {})[str(size)] = {'queries': len(queries), 'time': round(elapsed, 4)}
+        baseline = self.baseline.get(path, {}).get(str(size))
+        if UPDATE_BASELINE or not baseline:
+            return
+        self.assertLessEqual(len(queries), baseline['queries'],
+                             f'{path}, {size}: запросов {len(queries)}, базовое значение {baseline["queries"]}')
+        self.assertLessEqual(elapsed, baseline['time'] * TIME_TOLERANCE + TIME_SLACK,
+                             f'{path}, {size}: время {elapsed:.4f} с, базовое значение {baseline["time"]} с')
+
+    def test_education_create(self):
+        """Создание образования"""
+        for size in SIZES:
+            application = self.create_application(size)
+            data = {'application': application.pk, 'education_type': 'm', 'university': 'УлГТУ',
+                    'specialization': 'ИВТ', 'avg_score': 4.6, 'end_year': 2021, 'is_ended': True,
+                    'name_of_education_doc': 'Диплом', 'theme_of_diploma': 'Разработка системы'}
+            self.measure('education_create', size, lambda: self.client.post(
+                reverse('educations-list', args=(application.pk,)), data=data))
+
+    def test_education_update(self):
+        """Изменение последнего образования"""
+        for size in SIZES:
+            application = self.create_application(size)
+            education = application.education.order_by('-end_year').first()
+            self.measure('education_update', size, lambda: self.client.patch(
+                reverse('educations-detail', args=(application.pk, education.pk)), data={'avg_score': 4.8}))
+
+    def test_education_destroy(self):
+        """Удаление последнего образования"""
+        for size in SIZES:
+            application = self.create_application(size)
+            education = application.education.order_by('-end_year').first()
+            self.measure('education_destroy', size, lambda: self.client.delete(
+                reverse('educations-detail', args=(application.pk, education.pk))))
+
+    def test_application_update(self):
+        """Изменение поля заявки, влияющего на оценку"""
+        for size in SIZES:
+            application = self.create_application(size)
+            self.measure('application_update', size, lambda: self.client.patch(
+                reverse('application-detail', args=(application.pk,)), data={'patents': not application.patents}))
+
+    def test_set_chosen_direction_list(self):
+        """Выбор направлений"""
+        for size in SIZES:
+            application = self.create_application(size)
+            with self.captureOnCommitCallbacks(execute=True):
+                directions = DirectionFactory.create_batch(min(size, const.MAX_APP_DIRECTIONS))
+            data = [{'id': direction.pk} for direction in directions]
+            self.measure('set_chosen_direction_list', size, lambda: self.client.post(
+                reverse('application-get-chosen-direction-list', args=(application.pk,)), data=data, format='json'))
+
+    def test_set_competences_list(self):
+        """Оценка компетенций"""
+        for size in SIZES:
+            application = self.create_application(size)
+            with self.captureOnCommitCallbacks(execute=True):
+                competences = CompetenceFactory.create_batch(size, parent_node=None)
+            data = [{'application': application.pk, 'competence': competence.pk, 'level': 2}
+                    for competence in competences]
+            self.measure('set_competences_list', size, lambda: self.client.post(
+                reverse('application-get-competences-list', args=(application.pk,)), data=data, format='json'))
+
+    def test_file_upload(self):
+        """Загрузка файла"""
+        for size in SIZES:
+            application = self.create_application(size)
+            data = {'file_path': SimpleUploadedFile('file.jpg', b'file_content', content_type='image/jpg')}
+            self.measure('file_upload', size, lambda: self.client.post(reverse('files-list'), data=data,
+                                                                       format='multipart'))
+            self.assertEqual(Application.objects.get(pk=application.pk).fullness, application.fullness)
+
+
+def get_count_annotations(user, master_affiliations, master_directions_id):
+    """Прежние аннотации списка заявок мастера на Count(..., distinct=True) по соединению с бронированиями"""
+    return {
+        'is_booked': Count(F('member__candidate'), filter=Q(member__candidate__booking_type__name=const.BOOKED),
+                           distinct=True),
+        'is_booked_our': Count(F('member__candidate'), filter=Q(
+            member__candidate__booking_type__name=const.BOOKED,
+            member__candidate__affiliation__in=master_affiliations), distinct=True),
+        'can_unbook': Count(F('member__candidate'), filter=Q(
+            member__candidate__booking_type__name=const.BOOKED, member__candidate__affiliation__in=master_affiliations,
+            member__candidate__master=user.member), distinct=True),
+        'wishlist_len': Count(F('member__candidate'),
+                              filter=Q(member__candidate__booking_type__name=const.IN_WISHLIST), distinct=True),
+        'is_in_wishlist': Count(F('member__candidate'), filter=Q(
+            member__candidate__booking_type__name=const.IN_WISHLIST,
+            member__candidate__affiliation__in=master_affiliations), distinct=True),
+        'our_direction': Count(F('directions'), filter=Q(directions__id__in=master_directions_id), distinct=True),
+        'is_viewed': Count(F('viewed'), filter=Q(viewed__member=user.member), distinct=True),
+    }
+
+
+class MasterListBenchmarkTest(APITestCase):
+    results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        """Сохраняет отчет."""
+        super().tearDownClass()
+        report = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'results': cls.results}
+        MASTER_LIST_REPORT_PATH.write_text(json.dumps(report, ensure_ascii=False, indent=2))
+
+    def setUp(self) -> None:
+        self.directions = DirectionFactory.create_batch(4)
+        self.affiliations = [AffiliationFactory.create(direction=direction) for direction in self.directions]
+        self.master_user = UserFactory.create()
+        self.master = MemberFactory.create(affiliations=self.affiliations[:2], user=self.master_user,
+                                           role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+        self.other_master = MemberFactory.create(affiliations=self.affiliations[2:],
+                                                 role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME))
+        self.booked, self.in_wishlist = BookingType.objects.create(name=const.BOOKED), \
+            BookingType.objects.create(name=const.IN_WISHLIST)
+        self.slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.created = 0
+
+    def create_applications(self, count):
+        """
+        Массово создает заявки с направлениями, просмотрами, бронированиями и избранным:
+        каждая пятая заявка отобрана, у каждой второй от одного до трех добавлений в избранное
+        """
+        start = self.created
+        users = User.objects.bulk_create([User(username=f'benchmark{start + i}', last_name=f'Кандидат{start + i}')
+                                          for i in range(count)], batch_size=1000)
+        members = Member.objects.bulk_create([Member(user=user, role=self.slave_role, phone='89998887766')
+                                              for user in users], batch_size=1000)
+        applications = Application.objects.bulk_create([
+            Application(member=member, birth_day=datetime.date(2000, 1, 1), birth_place='Город', nationality='РФ',
+                        military_commissariat='Комиссариат', group_of_health='А1', draft_year=2030, draft_season=1)
+            for member in members], batch_size=1000)
+        Application.directions.through.objects.bulk_create([
+            Application.directions.through(application=app, direction=self.directions[(start + i) % 4])
+            for i, app in enumerate(applications)], batch_size=1000)
+        ViewedApplication.objects.bulk_create([ViewedApplication(member=self.master, application=app)
+                                               for i, app in enumerate(applications) if (start + i) % 3 == 0],
+                                              batch_size=1000)
+        bookings = []
+        for i, member in enumerate(members, start):
+            affiliation = self.affiliations[i % 4]
+            master = self.master if i % 4 < 2 else self.other_master
+            if i % 5 == 0:
+                bookings.append(Booking(booking_type=self.booked, master=master, slave=member,
+                                        affiliation=affiliation))
+            if i % 2 == 0:
+                bookings.extend(Booking(booking_type=self.in_wishlist, master=master, slave=member,
+                                        affiliation=self.affiliations[(i + j) % 4]) for j in range(i % 3 + 1))
+        Booking.objects.bulk_create(bookings, batch_size=1000)
+        self.created += count
+
+    def get_querysets(self):
+        """Возвращает queryset списка мастера с новыми и с прежними аннотациями"""
+        master_affiliations = self.master.affiliations.all()
+        master_directions_id = master_affiliations.values_list('direction__id', flat=True)
+        apps = get_applications_by_master(self.master_user, master_affiliations, self.directions[:2],
+                                          master_directions_id).prefetch_related(None)
+        legacy = Application.objects.annotate(**get_count_annotations(self.master_user, master_affiliations,
+                                                                      master_directions_id))
+        return apps, legacy
+
+    @staticmethod
+    def measure(queryset):
+        """
+        Измеряет время подсчета заявок и выборки первой страницы, как при запросе списка
+        :return: лучшее время из MASTER_LIST_REPEATS повторов в секундах
+        """
+        timings = []
+        for _ in range(MASTER_LIST_REPEATS):
+            start = time.perf_counter()
+            queryset.count()
+            list(queryset.order_by('-our_direction', 'pk').values_list('pk', *MASTER_LIST_ANNOTATIONS)
+                 [:MASTER_LIST_PAGE_SIZE])
+            timings.append(time.perf_counter() - start)
+        return round(min(timings), 4)
+
+    def test_master_list_annotations(self):
+        """Аннотации подзапросами совпадают с аннотациями на Count и не группируют основной запрос"""
+        for size in sorted(MASTER_LIST_SIZES):
+            self.create_applications(size - self.created)
+            apps, legacy = self.get_querysets()
+            values = apps.order_by('pk').values_list('pk', *MASTER_LIST_ANNOTATIONS)
+            legacy_values = legacy.order_by('pk').values_list('pk', *MASTER_LIST_ANNOTATIONS)
+            self.assertEqual([(pk, *map(int, row)) for pk, *row in values],
+                             [(pk, *(min(value, 1) if name != 'wishlist_len' else value
+                                     for name, value in zip(MASTER_LIST_ANNOTATIONS, row)))
+                              for pk, *row in legacy_values])
+            self.assertIsNone(apps.query.group_by)
+            self.results[str(size)] = {
+                'exists': {'time': self.measure(apps), 'plan': apps.explain()},
+                'count': {'time': self.measure(legacy), 'plan': legacy.explain()},
+            }
@@ -1,10 +1,14 @@
 import logging
+from io import StringIO
 
+from django.core.management import call_command
+from django.test import override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 from account.models import Booking
+from application.models import MasterApplicationState
 from application.tests.factories import UserFactory, RoleFactory, DirectionFactory, AffiliationFactory, MemberFactory, \
     create_uniq_application, BookingTypeFactory, BookingFactory, WorkGroupFactory, create_uniq_member
 from utils import constants as const
@@ -247,3 +251,84 @@ class BookingTest(APITestCase):
         response = self.client.delete(
             reverse('wishlist-detail', args=(self.slave_application_main.id, self.wishlist.id)))
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(MASTER_APPLICATION_STATES=True)
+class MasterApplicationStateTest(APITestCase):
+    def setUp(self) -> None:
+        master_role = RoleFactory.create(role_name=const.MASTER_ROLE_NAME)
+        direction = DirectionFactory.create()
+        self.affiliation = AffiliationFactory.create(direction=direction)
+        self.master_user = UserFactory.create()
+        self.master = MemberFactory.create(affiliations=[self.affiliation], role=master_role, user=self.master_user)
+        self.other_master = MemberFactory.create(affiliations=[AffiliationFactory.create()], role=master_role)
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.applications = [create_uniq_application(slave_role, directions=[direction]) for _ in range(3)]
+        self.booked = BookingTypeFactory.create()
+        self.in_wishlist = BookingTypeFactory.create(name=const.IN_WISHLIST)
+
+    def get_flags(self, url_name='application-list', params=None):
+        """Возвращает флаги заявок списка мастера"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse(url_name), params or {})
+        return {app['id']: tuple(app[flag] for flag in MasterApplicationState.flags)
+                for app in response.data['results']}
+
+    def assert_flags_match_subqueries(self, url_name='application-list', params=None):
+        """Проверяет, что флаги из таблицы совпадают с флагами, посчитанными подзапросами"""
+        flags = self.get_flags(url_name, params)
+        with self.settings(MASTER_APPLICATION_STATES=False):
+            self.assertEqual(flags, self.get_flags(url_name, params))
+        return flags
+
+    def test_booking(self):
+        """Флаги обновляются при бронировании и отмене бронирования"""
+        app = self.applications[0]
+        self.client.force_login(user=self.master_user)
+        response = self.client.post(reverse('booking-list', args=(app.pk,)), data={'affiliation': self.affiliation.pk})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        flags = self.assert_flags_match_subqueries()
+        self.assertEqual(flags[app.pk][:3], (True, True, True))
+        Booking.objects.get(slave=app.member).delete()
+        self.assertEqual(self.assert_flags_match_subqueries()[app.pk], tuple(MasterApplicationState.flags.values()))
+        self.assertFalse(MasterApplicationState.objects.exists())
+
+    def test_booking_by_other_master(self):
+        """Бронирование другим мастером на его принадлежность"""
+        BookingFactory.create(master=self.other_master, slave=self.applications[1].member, booking_type=self.booked,
+                              affiliation=self.other_master.affiliations.get())
+        BookingFactory.create(master=self.other_master, slave=self.applications[1].member,
+                              booking_type=self.in_wishlist, affiliation=self.other_master.affiliations.get())
+        BookingFactory.create(master=self.master, slave=self.applications[1].member, booking_type=self.in_wishlist,
+                              affiliation=self.affiliation)
+        flags = self.assert_flags_match_subqueries()
+        self.assertEqual(flags[self.applications[1].pk], (True, False, False, 2, True, False))
+
+    def test_view(self):
+        """Флаг просмотра обновляется при просмотре заявки"""
+        self.client.force_login(user=self.master_user)
+        self.client.post(reverse('application-view-application', args=(self.applications[2].pk,)))
+        self.assertTrue(self.assert_flags_match_subqueries()[self.applications[2].pk][-1])
+
+    def test_working_list(self):
+        """Рабочий список читает флаги из таблицы"""
+        BookingFactory.create(master=self.master, slave=self.applications[0].member, booking_type=self.booked,
+                              affiliation=self.affiliation)
+        self.assert_flags_match_subqueries('working-list', {'affiliation': self.affiliation.pk})
+
+    def test_affiliations_change(self):
+        """Флаги мастера пересчитываются при изменении его принадлежностей"""
+        BookingFactory.create(master=self.other_master, slave=self.applications[0].member, booking_type=self.booked,
+                              affiliation=self.other_master.affiliations.get())
+        self.master.affiliations.add(self.other_master.affiliations.get())
+        self.assertEqual(self.assert_flags_match_subqueries()[self.applications[0].pk][:3], (True, True, False))
+
+    def test_rebuild_command(self):
+        """Пересчет таблицы командой"""
+        BookingFactory.create(master=self.master, slave=self.applications[0].member, booking_type=self.booked,
+                              affiliation=self.affiliation)
+        states = set(MasterApplicationState.objects.values_list('master', 'application', *MasterApplicationState.flags))
+        MasterApplicationState.objects.all().delete()
+        call_command('rebuild_master_states', stdout=StringIO())
+        self.assertEqual(set(MasterApplicationState.objects.values_list('master', 'application',
+                                                                        *MasterApplicationState.flags)), states)
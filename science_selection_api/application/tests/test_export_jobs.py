@@ -0,0 +1,162 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from application import export_jobs
+from application.export_jobs import export_runner, run_export_job
+from application.models import ExportJob
+from application.scoring import refresh_stale_final_scores
+from application.tests.factories import UserFactory, RoleFactory, DirectionFactory, AffiliationFactory, MemberFactory, \
+    create_uniq_application
+from utils import constants as const
+
+logging.disable(logging.FATAL)
+
+temp_root = tempfile.mkdtemp()  # временная папка для хранения медиа в тестах
+
+
+@override_settings(MEDIA_ROOT=temp_root, EXPORT_JOBS_BACKGROUND=False)
+class ExportJobTest(APITestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        """Удаляет временную папку с медиа файлами."""
+        super().tearDownClass()
+        shutil.rmtree(temp_root, ignore_errors=True)
+
+    def setUp(self) -> None:
+        # изменения данных фиксируются, чтобы версия данных в тестах увеличивалась после setUp
+        with self.captureOnCommitCallbacks(execute=True):
+            direction = DirectionFactory.create()
+            self.affiliation = AffiliationFactory.create(direction=direction)
+            master_role = RoleFactory.create(role_name=const.MASTER_ROLE_NAME)
+            self.master_user, self.other_master_user = UserFactory.create_batch(2)
+            MemberFactory.create(affiliations=[self.affiliation], user=self.master_user, role=master_role)
+            MemberFactory.create(affiliations=[self.affiliation], user=self.other_master_user, role=master_role)
+            slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+            self.apps = [create_uniq_application(slave_role, directions=[direction]) for _ in range(2)]
+            # итоговые баллы пересчитываются при первой выгрузке, что меняет версию данных
+            refresh_stale_final_scores()
+        self.client.force_login(user=self.master_user)
+
+    def create_job(self, document_type='applications', **params):
+        response = self.client.post(reverse('export-jobs-list'), {'document_type': document_type, 'params': params},
+                                    format='json')
+        return response
+
+    def test_create_and_download(self):
+        """Выгрузка выполняется и отдает тот же файл, что и синхронный эндпоинт"""
+        response = self.create_job(format='csv', ordering='member__user__last_name')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        job_id = response.data['id']
+        response = self.client.get(reverse('export-jobs-detail', args=(job_id,)))
+        self.assertEqual(response.data['status'], ExportJob.DONE)
+        self.assertEqual(response.data['filename'], 'Список заявок.csv')
+        response = self.client.get(reverse('export-jobs-download', args=(job_id,)))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        expected = self.client.get(reverse('application-export-applications-list'),
+                                   {'format': 'csv', 'ordering': 'member__user__last_name'})
+        self.assertEqual(b''.join(response.streaming_content), b''.join(expected.streaming_content))
+
+    def test_working_list_and_service_document(self):
+        """Выгрузка рабочего листа и служебного документа"""
+        response = self.create_job('working-list', affiliation=str(self.affiliation.id))
+        self.assertEqual(response.data['status'], ExportJob.DONE)
+        self.assertEqual(response.data['filename'], 'Рабочий лист.xlsx')
+        response = self.create_job('service-document', doc='rating')
+        self.assertEqual(response.data['status'], ExportJob.DONE, response.data['error'])
+        self.assertEqual(response.data['filename'], 'Рейтинговый список призыва.docx')
+
+    def test_cached_result(self):
+        """Повторная выгрузка отдается из готового файла, пока данные не изменятся"""
+        job_id = self.create_job(format='jsonl').data['id']
+        with mock.patch.object(export_jobs, 'get_export_response') as get_export_response:
+            response = self.create_job(format='jsonl')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            get_export_response.assert_not_called()
+        self.assertEqual(ExportJob.objects.get(pk=response.data['id']).file.name,
+                         ExportJob.objects.get(pk=job_id).file.name)
+        self.assertNotEqual(self.create_job(format='csv').data['id'], job_id)
+        self.apps[0].birth_place = 'Москва'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.apps[0].save()
+        with mock.patch.object(export_jobs, 'get_export_response', wraps=export_jobs.get_export_response) as get:
+            self.create_job(format='jsonl')
+            get.assert_called_once()
+
+    def test_superseded_deleted(self):
+        """Новый результат удаляет прежние выгрузки мастера с теми же параметрами по устаревшим данным"""
+        old_job = ExportJob.objects.get(pk=self.create_job(format='jsonl').data['id'])
+        other_job_id = self.create_job(format='csv').data['id']
+        self.apps[0].birth_place = 'Москва'
+        with self.captureOnCommitCallbacks(execute=True):
+            self.apps[0].save()
+        job = ExportJob.objects.get(pk=self.create_job(format='jsonl').data['id'])
+        self.assertFalse(ExportJob.objects.filter(pk=old_job.pk).exists())
+        self.assertFalse(os.path.exists(old_job.file.path))
+        self.assertTrue(os.path.exists(job.file.path))
+        self.assertTrue(ExportJob.objects.filter(pk=other_job_id).exists())
+
+    def test_cleanup_command(self):
+        """Команда удаляет старые выгрузки с файлами и старые файлы без выгрузок"""
+        old_job = ExportJob.objects.get(pk=self.create_job(format='jsonl').data['id'])
+        job_id = self.create_job(format='csv').data['id']
+        ExportJob.objects.filter(pk=old_job.pk).update(create_date=timezone.now() - timedelta(hours=25))
+        orphan = os.path.join(temp_root, export_jobs.EXPORT_DIR, 'orphan.tmp')
+        Path(orphan).touch()
+        os.utime(orphan, (time.time() - 25 * 3600,) * 2)
+        call_command('cleanup_exports', stdout=mock.MagicMock())
+        self.assertFalse(ExportJob.objects.filter(pk=old_job.pk).exists())
+        self.assertFalse(os.path.exists(old_job.file.path))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(ExportJob.objects.get(pk=job_id).file.path))
+
+    def test_failed_job(self):
+        """Ошибка эндпоинта выгрузки сохраняется в выгрузке, скачать файл нельзя"""
+        response = self.create_job('service-document', doc='unknown')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], ExportJob.FAILED)
+        self.assertIn('400', response.data['error'])
+        response = self.client.get(reverse('export-jobs-download', args=(response.data['id'],)))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_invalid_params(self):
+        response = self.create_job('unknown')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('export-jobs-list'),
+                                    {'document_type': 'applications', 'params': {'format': 1}}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(EXPORT_JOBS_BACKGROUND=True)
+    def test_background(self):
+        """В фоновом режиме выгрузка ставится в пул после фиксации транзакции"""
+        with mock.patch.object(export_runner, 'executor', mock.MagicMock()) as executor, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.create_job()
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], ExportJob.PENDING)
+        executor.submit.assert_called_once_with(export_runner.run, response.data['id'])
+        run_export_job(response.data['id'])
+        self.assertEqual(ExportJob.objects.get(pk=response.data['id']).status, ExportJob.DONE)
+
+    def test_permissions(self):
+        """Выгрузка доступна только создавшему ее мастеру"""
+        job_id = self.create_job().data['id']
+        self.client.force_login(user=self.other_master_user)
+        response = self.client.get(reverse('export-jobs-download', args=(job_id,)))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.client.force_login(user=self.apps[0].member.user)
+        self.assertEqual(self.create_job().status_code, status.HTTP_403_FORBIDDEN)
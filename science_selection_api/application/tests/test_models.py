@@ -4,7 +4,7 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 
 from application.models import Direction, File, Competence, Universities, Education, Application, validate_draft_year, \
-    ApplicationScores, Specialization, MilitaryCommissariat
+    Specialization, MilitaryCommissariat
 from account.models import Member, Role
 from utils.constants import DEFAULT_FILED_BLOCKS
 
@@ -82,7 +82,6 @@ class ApplicationModelTest(TestCase):
         cls.education = Education.objects.create(application=app, education_type='b', university='МЭИ', specialization='ИВТ',
                                                  avg_score=5, end_year=2020, is_ended=True, name_of_education_doc='Высшее',
                                                  theme_of_diploma='Тест')
-        ApplicationScores.objects.create(application=app)
 
     def test_birth_place_max_length(self):
         app = Application.objects.get(id=1)
@@ -115,6 +114,20 @@ class ApplicationModelTest(TestCase):
         filed_blocks.update({'Основные данные': True, 'Образование': True})
         self.assertEquals(filed_blocks, app.get_filed_blocks())
 
+    def test_get_filed_blocks_annotated(self):
+        """Аннотации заполненности используются без запросов, пока заявка и ее направления не изменились"""
+        app = Application.objects.with_filled_blocks().get(id=1)
+        with self.assertNumQueries(0):
+            self.assertFalse(app.get_filed_blocks()['Направления'])
+        app.directions.add(Direction.objects.create(name='ИВТ', description='описание'))
+        self.assertTrue(app.get_filed_blocks()['Направления'])
+        app = Application.objects.with_filled_blocks().get(id=1)
+        app.birth_place = 'Москва'
+        File.objects.create(member=app.member, file_name='file', file_path='file')
+        self.assertTrue(app.get_filed_blocks()['Загруженные файлы'])
+        app.save()
+        self.assertTrue(app.get_filed_blocks()['Загруженные файлы'])
+
     def test_calculate_fullness(self):
         app = Application.objects.get(id=1)
         fullness = app.calculate_fullness()
@@ -175,6 +188,31 @@ class EducationModelTest(TestCase):
         education = Education.objects.get(id=1)
         self.assertEquals(education.get_education_type_display(), Education.education_program[0][1])
 
+    def test_last_education_snapshot_on_create(self):
+        app = Application.objects.get(id=1)
+        Education.objects.create(application=app, education_type=Education.education_program[1][0], university='МГУ',
+                                 specialization='ПМИ', avg_score=4.5, end_year=2022, is_ended=False,
+                                 theme_of_diploma='Тест')
+        app.refresh_from_db()
+        with self.assertNumQueries(0):
+            education = app.get_last_education_snapshot()
+        self.assertEquals((education.education_type, education.university, education.specialization,
+                           education.avg_score, education.end_year, education.is_ended),
+                          ('m', 'МГУ', 'ПМИ', 4.5, 2022, False))
+
+    def test_last_education_snapshot_on_update(self):
+        education = Education.objects.get(id=1)
+        education.avg_score = 4
+        education.save()
+        self.assertEquals(Application.objects.get(id=1).last_education_avg_score, 4)
+
+    def test_last_education_snapshot_on_delete(self):
+        Education.objects.get(id=1).delete()
+        app = Application.objects.get(id=1)
+        self.assertEquals(app.last_education_type, '')
+        self.assertIsNone(app.last_education_avg_score)
+        self.assertIsNone(app.get_last_education_snapshot())
+
 
 class SpecializationModelTest(TestCase):
 
@@ -209,3 +247,37 @@ class MilitaryCommissariatModelTest(TestCase):
         mc = MilitaryCommissariat.objects.get(id=1)
         max_length = mc._meta.get_field('city').max_length
         self.assertEquals(max_length, 128)
+
+    def create_application(self, military_commissariat):
+        member = Member.objects.create(user=User.objects.create(username=f'test{Application.objects.count()}'),
+                                       phone='1110001115', role=Role.objects.get_or_create(role_name='Оператор')[0])
+        return Application.objects.create(member=member, birth_day=datetime.strptime('18/09/19', '%d/%m/%y'),
+                                          birth_place='Test', nationality='РФ',
+                                          military_commissariat=military_commissariat, group_of_health='А1',
+                                          draft_year=2020, draft_season=1)
+
+    def test_application_commissariat(self):
+        """Заявка привязывается к комиссариату справочника по названию при сохранении"""
+        mc = MilitaryCommissariat.objects.get(id=1)
+        app = self.create_application(mc.name)
+        self.assertEqual(app.commissariat, mc)
+        app = Application.objects.get(pk=app.pk)
+        app.military_commissariat = 'Другой'
+        app.save()
+        self.assertIsNone(Application.objects.get(pk=app.pk).commissariat)
+        app.military_commissariat = mc.name
+        app.save(update_fields=['military_commissariat'])
+        self.assertEqual(Application.objects.get(pk=app.pk).commissariat, mc)
+
+    def test_commissariat_change(self):
+        """Заявки перепривязываются при добавлении, переименовании и удалении комиссариата"""
+        app = self.create_application('Ленинский')
+        self.assertIsNone(app.commissariat)
+        mc = MilitaryCommissariat.objects.create(name='Ленинский', subject='Самарская область', city='Самара')
+        self.assertEqual(Application.objects.get(pk=app.pk).commissariat, mc)
+        duplicate = MilitaryCommissariat.objects.create(name='Ленинский', subject='Самарская область', city='Самара')
+        mc.name = 'Кировский'
+        mc.save()
+        self.assertEqual(Application.objects.get(pk=app.pk).commissariat, duplicate)
+        duplicate.delete()
+        self.assertIsNone(Application.objects.get(pk=app.pk).commissariat)
@@ -0,0 +1,549 @@
+import logging
+import shutil
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from application.models import Application, ApplicationScores, ScoringCoefficients, ApplicationRank
+from application.scoring import rescore_applications, refresh_stale_final_scores
+from application.workers import ScoresWorker, scores_worker, recompute_scores
+from application.tests.factories import RoleFactory, DirectionFactory, EducationFactory, FileFactory, \
+    AffiliationFactory, MemberFactory, UserFactory, create_uniq_application, create_batch_competences_scores
+from utils import constants as const
+
+logging.disable(logging.FATAL)
+
+temp_root = tempfile.mkdtemp()  # временная папка для хранения медиа в тестах
+
+
+@override_settings(MEDIA_ROOT=temp_root)
+class RescoreApplicationsTest(TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        """Удаляет временную папку с медиа файлами."""
+        super().tearDownClass()
+        shutil.rmtree(temp_root, ignore_errors=True)
+
+    def setUp(self) -> None:
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.applications = [create_uniq_application(slave_role, directions=DirectionFactory.create_batch(2))
+                             for _ in range(3)]
+        self.applications.append(create_uniq_application(slave_role, directions=[]))
+        EducationFactory.create_batch(2, application=self.applications[0])
+        EducationFactory.create(application=self.applications[1], education_type='a', is_ended=True)
+        EducationFactory.create(application=self.applications[2], education_type='b')
+        create_batch_competences_scores(2, application=self.applications[1])
+        FileFactory.create(member=self.applications[2].member)
+
+    def get_expected_scores(self):
+        """Рассчитывает баллы заявок построчно и возвращает их, обнуляя сохраненные значения"""
+        expected = {}
+        for app in Application.objects.all():
+            app.update_scores()
+            expected[app.pk] = (app.fullness, app.final_score,
+                                [getattr(app.scores, criterion) for criterion in const.SCORE_CRITERIA])
+        Application.objects.update(fullness=0, final_score=0)
+        ApplicationScores.objects.all().delete()
+        return expected
+
+    def get_actual_scores(self):
+        return {app.pk: (app.fullness, app.final_score,
+                         [getattr(app.scores, criterion) for criterion in const.SCORE_CRITERIA])
+                for app in Application.objects.select_related('scores')}
+
+    def test_rescore_matches_row_calculation(self):
+        """Массовый пересчет совпадает с построчным"""
+        expected = self.get_expected_scores()
+        self.assertEqual(rescore_applications(), len(self.applications))
+        actual = self.get_actual_scores()
+        for pk, (fullness, final_score, criteria) in expected.items():
+            self.assertEqual(actual[pk][0], fullness)
+            self.assertAlmostEqual(actual[pk][1], final_score, places=2)
+            for expected_value, actual_value in zip(criteria, actual[pk][2]):
+                self.assertAlmostEqual(actual_value, expected_value, places=2)
+
+    def test_rescore_queries_do_not_depend_on_count(self):
+        """Количество запросов не зависит от количества заявок"""
+        Application.objects.update(draft_year=2030, draft_season=1)
+        rescore_applications()
+        with CaptureQueriesContext(connection) as small:
+            rescore_applications(Application.objects.filter(pk=self.applications[0].pk))
+        with CaptureQueriesContext(connection) as full:
+            rescore_applications()
+        self.assertEqual(len(small), len(full))
+
+    def test_actual_fullness_in_one_query(self):
+        """Заполненность всех заявок считается одним запросом и совпадает с построчной"""
+        with self.assertNumQueries(1):
+            actual = dict(Application.objects.with_actual_fullness().values_list('pk', 'actual_fullness'))
+        for app in Application.objects.all():
+            self.assertEqual(actual[app.pk], app.calculate_fullness())
+
+    def test_rescore_empty_queryset(self):
+        """Пересчет пустого списка заявок"""
+        self.assertEqual(rescore_applications(Application.objects.none()), 0)
+
+    def test_rescore_command(self):
+        """Пересчет заявок всех призывов командой"""
+        out = StringIO()
+        call_command('rescore_applications', '--all', stdout=out)
+        self.assertIn(str(len(self.applications)), out.getvalue())
+        self.assertEqual(ApplicationScores.objects.count(), len(self.applications))
+
+
+class IncrementalScoresTest(TestCase):
+    def setUp(self) -> None:
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.application = create_uniq_application(slave_role, directions=DirectionFactory.create_batch(2))
+        EducationFactory.create(application=self.application, education_type='b', avg_score=4.5, end_year=2020)
+        self.application.update_scores()
+        self.application = Application.objects.select_related('scores').get(pk=self.application.pk)
+
+    def test_dirty_fields(self):
+        """Измененные поля заявки отслеживаются до сохранения"""
+        self.assertEqual(self.application.get_dirty_fields(), set())
+        self.application.patents = not self.application.patents
+        self.application.birth_place = 'Другое место'
+        self.assertEqual(self.application.get_dirty_fields(), {'patents'})
+        self.application.save()
+        self.assertEqual(self.application.saved_dirty_fields, {'patents'})
+        self.assertEqual(self.application.get_dirty_fields(), set())
+
+    def test_criteria_by_fields(self):
+        """Поля заявки сопоставляются с критериями"""
+        self.assertEqual(Application.get_criteria_by_fields(['patents', 'hobby']), {'a1'})
+        self.assertEqual(Application.get_criteria_by_fields(['compliance_additional_direction']), {'a3', 'a5'})
+        self.assertEqual(Application.get_criteria_by_fields(['birth_place']), set())
+
+    def test_update_only_affected_criterion(self):
+        """Пересчитывается только критерий измененного поля"""
+        ApplicationScores.objects.filter(application=self.application).update(a2=99)
+        application = Application.objects.select_related('scores').get(pk=self.application.pk)
+        application.patents = not application.patents
+        application.save()
+        application.update_scores(criteria=application.get_criteria_by_fields(application.saved_dirty_fields),
+                                  fullness=False)
+        scores = ApplicationScores.objects.get(application=application)
+        self.assertEqual(scores.a1, application.calculate_criterion_by_fields('a1'))
+        self.assertEqual(scores.a2, 99)
+
+    def test_update_without_changes_has_no_queries(self):
+        """Сохранение без изменений отслеживаемых полей не пересчитывает баллы"""
+        with self.assertNumQueries(0):
+            self.application.update_scores(criteria=(), fullness=False)
+            self.application.scores.save()
+
+    def test_update_education_scores(self):
+        """Изменение и удаление образования пересчитывают критерий a2"""
+        education = self.application.education.get()
+        education.avg_score = 3.5
+        education.save()
+        self.assertEqual(ApplicationScores.objects.get(application=self.application).a2,
+                         round(3.5 * const.BACHELOR_COEF, 2))
+        education.delete()
+        self.application.refresh_from_db()
+        self.assertEqual(ApplicationScores.objects.get(application=self.application).a2, 0)
+        self.assertEqual(self.application.fullness, self.application.calculate_fullness())
+
+
+class ScoringCoefficientsTest(APITestCase):
+    def setUp(self) -> None:
+        direction = DirectionFactory.create()
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[AffiliationFactory.create(direction=direction)],
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME), user=self.master_user)
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.applications = [create_uniq_application(slave_role, directions=[direction]) for _ in range(3)]
+        for app in self.applications:
+            app.update_scores()
+        self.old_coefficients = ScoringCoefficients.get_current()
+        self.new_coefficients = ScoringCoefficients.objects.create(
+            **{k: v + 1 for k, v in self.old_coefficients.as_dict().items()})
+
+    def get_expected_final_score(self, application):
+        return ApplicationScores.objects.get(application=application) \
+            .calculate_weighted_score(self.new_coefficients.as_dict())
+
+    def test_update_scores_stores_version(self):
+        """Итоговый балл запоминает версию коэффициентов, по которой посчитан"""
+        self.assertTrue(Application.objects.filter(coefficients=self.old_coefficients).exists())
+        self.applications[0].update_scores()
+        self.applications[0].refresh_from_db()
+        self.assertEqual(self.applications[0].coefficients, self.new_coefficients)
+
+    def test_new_version_does_not_rescore_on_write(self):
+        """Создание новой версии коэффициентов не пересчитывает заявки сразу"""
+        self.assertEqual(Application.objects.filter(coefficients=self.new_coefficients).count(), 0)
+
+    def test_refresh_stale_final_scores(self):
+        """Устаревшие итоговые баллы пересчитываются пачками"""
+        self.assertEqual(refresh_stale_final_scores(chunk_size=2), len(self.applications))
+        for app in Application.objects.all():
+            self.assertEqual(app.coefficients, self.new_coefficients)
+            self.assertAlmostEqual(app.final_score, self.get_expected_final_score(app), places=2)
+        self.assertEqual(refresh_stale_final_scores(), 0)
+
+    def test_refresh_on_retrieve(self):
+        """Итоговый балл отдаваемой заявки пересчитывается при чтении"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('application-detail', args=(self.applications[0].pk,)))
+        expected = self.get_expected_final_score(self.applications[0])
+        self.assertAlmostEqual(response.data['final_score'], expected, places=2)
+        self.assertEqual(Application.objects.filter(coefficients=self.new_coefficients).count(), 1)
+
+    def test_refresh_on_list(self):
+        """Итоговые баллы заявок страницы списка пересчитываются при чтении"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('application-list'))
+        self.assertEqual(len(response.data['results']), len(self.applications))
+        for app in response.data['results']:
+            self.assertAlmostEqual(app['final_score'], self.get_expected_final_score(app['id']), places=2)
+        self.assertFalse(Application.objects.exclude(coefficients=self.new_coefficients).exists())
+
+    def test_no_refresh_on_full_list(self):
+        """Список без пагинации и выгрузка не пересчитывают все заявки при чтении"""
+        self.client.force_login(user=self.master_user)
+        for response in (self.client.get(reverse('application-list'), {'page_size': 'all'}),
+                         self.client.get(reverse('application-export-applications-list'), {'format': 'csv'})):
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            b''.join(response.streaming_content)
+        self.assertFalse(Application.objects.filter(coefficients=self.new_coefficients).exists())
+
+    def test_refresh_command(self):
+        """Пересчет устаревших итоговых баллов командой"""
+        out = StringIO()
+        call_command('refresh_final_scores', stdout=out)
+        self.assertIn(str(len(self.applications)), out.getvalue())
+        self.assertFalse(Application.objects.exclude(coefficients=self.new_coefficients).exists())
+
+
+class CalculatedFinalScoreTest(APITestCase):
+    def setUp(self) -> None:
+        direction = DirectionFactory.create()
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[AffiliationFactory.create(direction=direction)],
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME), user=self.master_user)
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.applications = [create_uniq_application(slave_role, directions=[direction]) for _ in range(3)]
+        for i, app in enumerate(self.applications):
+            app.update_scores()
+            ApplicationScores.objects.filter(application=app).update(**{criterion: i for criterion in const.SCORE_CRITERIA})
+        # сохраненные итоговые баллы устарели и упорядочены обратно рассчитанным
+        for i, app in enumerate(self.applications):
+            Application.objects.filter(pk=app.pk).update(final_score=-i)
+
+    def test_annotation_matches_weighted_score(self):
+        """Итоговый балл, рассчитанный в БД, совпадает с рассчитанным в Python"""
+        with self.assertNumQueries(2):
+            calculated = dict(Application.objects.with_calculated_final_score()
+                              .values_list('pk', 'calculated_final_score'))
+        for scores in ApplicationScores.objects.all():
+            self.assertAlmostEqual(calculated[scores.application_id], scores.calculate_weighted_score(
+                ScoringCoefficients.get_current().as_dict()), places=2)
+
+    def test_ordering_by_calculated_final_score(self):
+        """Сортировка по итоговому баллу не зависит от сохраненного значения"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('application-list'), {'ordering': '-final_score'})
+        self.assertEqual([app['id'] for app in response.data['results']],
+                         [app.pk for app in reversed(self.applications)])
+
+    def test_filter_by_calculated_final_score(self):
+        """Фильтрация по диапазону итогового балла, рассчитанного в БД"""
+        threshold = Application.objects.with_calculated_final_score() \
+            .get(pk=self.applications[1].pk).calculated_final_score
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('application-list'), {'final_score_min': threshold})
+        self.assertEqual({app['id'] for app in response.data['results']},
+                         {app.pk for app in self.applications[1:]})
+        response = self.client.get(reverse('application-list'), {'final_score_max': threshold})
+        self.assertEqual({app['id'] for app in response.data['results']},
+                         {app.pk for app in self.applications[:2]})
+
+
+class RankingSimulationTest(APITestCase):
+    def setUp(self) -> None:
+        self.direction = DirectionFactory.create()
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[AffiliationFactory.create(direction=self.direction)],
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME), user=self.master_user)
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.applications = [create_uniq_application(slave_role, directions=[self.direction]) for _ in range(3)]
+        Application.objects.update(draft_year=2030, draft_season=1)
+        # текущий рейтинг определяется критерием a1, предлагаемый - критерием a2
+        for i, app in enumerate(self.applications):
+            ApplicationScores.objects.create(application=app, a1=i, a2=len(self.applications) - i)
+        self.data = {'draft_year': 2030, 'draft_season': 1, 'k1': 0, 'k2': 1, 'k3': 0, 'k4': 0, 'k5': 0, 'k6': 0,
+                     'k7': 0}
+
+    def test_simulation(self):
+        """Моделирование рейтинга по другим коэффициентам"""
+        ScoringCoefficients.objects.create(k1=1, k2=0, k3=0, k4=0, k5=0, k6=0, k7=0)
+        self.client.force_login(user=self.master_user)
+        response = self.client.post(reverse('ranking-simulation'), data=self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([app['id'] for app in response.data], [app.pk for app in self.applications])
+        self.assertEqual([app['current_rank'] for app in response.data], [3, 2, 1])
+        self.assertEqual([app['rank_delta'] for app in response.data], [2, 0, -2])
+
+    def test_simulation_without_writes(self):
+        """Моделирование рейтинга ничего не сохраняет"""
+        self.client.force_login(user=self.master_user)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('ranking-simulation'), data=self.data, format='json')
+        self.assertFalse([query for query in queries if query['sql'].startswith(('UPDATE', 'INSERT', 'DELETE'))])
+
+    def test_simulation_by_directions(self):
+        """Моделирование рейтинга по направлениям"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.post(reverse('ranking-simulation'),
+                                    data={**self.data, 'directions': [DirectionFactory.create().pk]}, format='json')
+        self.assertEqual(response.data, [])
+
+    def test_simulation_by_slave(self):
+        """Моделирование рейтинга доступно только отбирающим"""
+        self.client.force_login(user=self.applications[0].member.user)
+        response = self.client.post(reverse('ranking-simulation'), data=self.data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_simulation_with_invalid_coefficients(self):
+        """Моделирование рейтинга без коэффициентов"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.post(reverse('ranking-simulation'), data={'k1': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ApplicationRankTest(APITestCase):
+    def setUp(self) -> None:
+        self.direction = DirectionFactory.create()
+        self.master_user = UserFactory.create()
+        MemberFactory.create(affiliations=[AffiliationFactory.create(direction=self.direction)],
+                             role=RoleFactory.create(role_name=const.MASTER_ROLE_NAME), user=self.master_user)
+        self.slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.applications = [create_uniq_application(self.slave_role, directions=[self.direction])
+                             for _ in range(4)]
+        for i, app in enumerate(self.applications):
+            app.draft_year, app.draft_season, app.final_score = 2030, 1, i * 10
+            app.save()
+
+    def get_ranks(self):
+        """Возвращает id заявок в порядке мест рейтинга направления"""
+        ranks = list(ApplicationRank.objects.filter(direction=self.direction, draft_year=2030, draft_season=1)
+                     .order_by('rank').values_list('application_id', 'rank'))
+        self.assertEqual([rank for _, rank in ranks], list(range(1, len(ranks) + 1)))
+        return [app_id for app_id, _ in ranks]
+
+    def assert_matches_rebuild(self):
+        """Проверяет, что инкрементальный рейтинг совпадает с полностью пересчитанным"""
+        ranks = self.get_ranks()
+        ApplicationRank.rebuild(2030, 1)
+        self.assertEqual(self.get_ranks(), ranks)
+
+    def test_ranks_by_final_score(self):
+        """Заявки упорядочены по убыванию итогового балла"""
+        self.assertEqual(self.get_ranks(), [app.pk for app in reversed(self.applications)])
+        self.assert_matches_rebuild()
+
+    def test_move(self):
+        """Изменение итогового балла перемещает заявку в рейтинге"""
+        app = self.applications[0]
+        app.final_score = 15
+        app.save()
+        self.assertEqual(self.get_ranks(), [self.applications[3].pk, self.applications[2].pk, app.pk,
+                                            self.applications[1].pk])
+        self.assert_matches_rebuild()
+
+    def test_equal_scores(self):
+        """При равных баллах выше заявка, поданная раньше"""
+        app = self.applications[3]
+        app.final_score = 10
+        app.save()
+        self.assertEqual(self.get_ranks(), [self.applications[2].pk, self.applications[1].pk, app.pk,
+                                            self.applications[0].pk])
+        self.assert_matches_rebuild()
+
+    def test_change_draft(self):
+        """Заявка переходит в рейтинг другого призыва"""
+        app = self.applications[1]
+        app.draft_season = 2
+        app.save()
+        self.assertEqual(ApplicationRank.objects.get(application=app).draft_season, 2)
+        self.assertNotIn(app.pk, self.get_ranks())
+        self.assert_matches_rebuild()
+
+    def test_change_directions(self):
+        """Изменение направлений заявки добавляет и удаляет ее из рейтингов"""
+        app = self.applications[2]
+        new_direction = DirectionFactory.create()
+        app.directions.set([new_direction])
+        self.assertNotIn(app.pk, self.get_ranks())
+        self.assertEqual(ApplicationRank.objects.get(application=app).direction, new_direction)
+        self.assert_matches_rebuild()
+
+    def test_delete(self):
+        """Удаление заявки сдвигает заявки ниже нее"""
+        self.applications[2].delete()
+        self.assertEqual(self.get_ranks(), [self.applications[3].pk, self.applications[1].pk,
+                                            self.applications[0].pk])
+        self.assert_matches_rebuild()
+
+    def test_cascade_delete(self):
+        """Каскадное удаление и удаление queryset заявок сдвигают заявки ниже них"""
+        self.applications[3].member.user.delete()
+        Application.objects.filter(pk=self.applications[1].pk).delete()
+        self.assertEqual(self.get_ranks(), [self.applications[2].pk, self.applications[0].pk])
+        self.assert_matches_rebuild()
+
+    def test_queries_do_not_depend_on_directions(self):
+        """Количество запросов на перемещение заявки не зависит от количества ее направлений"""
+        queries = []
+        for app in self.applications[:2]:
+            app.directions.add(*DirectionFactory.create_batch(1 if app is self.applications[0] else 5))
+            app.final_score = 25
+            with CaptureQueriesContext(connection) as captured:
+                app.save()
+            queries.append(len(captured))
+        self.assertEqual(queries[0], queries[1])
+        self.assert_matches_rebuild()
+
+    def test_matches_rebuild_after_changes(self):
+        """Рейтинги после последовательности изменений совпадают с полностью пересчитанными"""
+        directions = [self.direction, *DirectionFactory.create_batch(2)]
+        for i, app in enumerate(self.applications):
+            app.directions.set(directions[:i % 3 + 1])
+        for i, (index, final_score) in enumerate([(0, 30), (1, 5), (3, 5), (2, 40), (0, 0), (1, 40), (3, 50)]):
+            app = self.applications[index]
+            app.final_score = final_score
+            if i % 3 == 2:
+                app.directions.set(directions[i % 2:])
+            app.save()
+            ranks = {direction.pk: list(ApplicationRank.objects.filter(direction=direction)
+                                        .order_by('rank').values_list('application_id', 'rank'))
+                     for direction in directions}
+            ApplicationRank.rebuild(2030, 1)
+            self.assertEqual({direction.pk: list(ApplicationRank.objects.filter(direction=direction)
+                                                 .order_by('rank').values_list('application_id', 'rank'))
+                              for direction in directions}, ranks)
+
+    def test_rank_in_master_list(self):
+        """Место в рейтинге в списке заявок мастера"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('application-list'), {'ordering': 'rank'})
+        self.assertEqual([(app['id'], app['rank']) for app in response.data['results']],
+                         [(app.pk, rank) for rank, app in enumerate(reversed(self.applications), 1)])
+
+    def test_direction_top(self):
+        """Лучшие заявки направления"""
+        self.client.force_login(user=self.master_user)
+        response = self.client.get(reverse('direction-top', args=(self.direction.pk,)),
+                                   {'n': 2, 'draft_year': 2030, 'draft_season': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([app['application'] for app in response.data],
+                         [self.applications[3].pk, self.applications[2].pk])
+        self.assertEqual([app['rank'] for app in response.data], [1, 2])
+
+    def test_direction_top_by_slave(self):
+        """Лучшие заявки направления доступны только отбирающим"""
+        self.client.force_login(user=self.applications[0].member.user)
+        response = self.client.get(reverse('direction-top', args=(self.direction.pk,)))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_rebuild_command(self):
+        """Пересчет рейтингов командой"""
+        ApplicationRank.objects.all().delete()
+        call_command('rebuild_ranks', '--year', '2030', '--season', '1', stdout=StringIO())
+        self.assertEqual(self.get_ranks(), [app.pk for app in reversed(self.applications)])
+
+    def test_rescore_rebuilds_ranks(self):
+        """Массовый пересчет баллов пересчитывает рейтинги"""
+        rescore_applications()
+        self.assert_matches_rebuild()
+        self.assertEqual(dict(ApplicationRank.objects.values_list('application_id', 'final_score')),
+                         dict(Application.objects.values_list('pk', 'final_score')))
+
+
+class ScoresWorkerTest(TestCase):
+    def setUp(self) -> None:
+        slave_role = RoleFactory.create(role_name=const.SLAVE_ROLE_NAME)
+        self.application = create_uniq_application(slave_role, directions=DirectionFactory.create_batch(2))
+        EducationFactory.create(application=self.application, education_type='b', avg_score=4.5, end_year=2020)
+        # баллы, посчитанные при добавлении образования, удаляются, чтобы проверять пересчет воркером
+        ApplicationScores.objects.filter(application=self.application).delete()
+        self.worker = ScoresWorker(delay=60)
+
+    def schedule(self, *args, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.worker.schedule(*args, **kwargs)
+
+    def test_jobs_are_coalesced(self):
+        """Повторные задачи на заявку объединяются в одну и отмечают баллы как ожидающие пересчета"""
+        self.schedule(self.application.pk, criteria={'a1'}, fullness=False)
+        with self.assertNumQueries(0):
+            self.schedule(self.application.pk, criteria={'a3'}, fullness=True)
+        self.assertEqual(self.worker.jobs[self.application.pk]['criteria'], {'a1', 'a3'})
+        self.assertTrue(self.worker.jobs[self.application.pk]['fullness'])
+        self.schedule(self.application.pk)
+        self.assertIsNone(self.worker.jobs[self.application.pk]['criteria'])
+        self.assertTrue(Application.objects.get(pk=self.application.pk).scores_pending)
+
+    def test_jobs_wait_for_delay(self):
+        """Задачи не выполняются до истечения времени ожидания"""
+        self.schedule(self.application.pk)
+        self.assertEqual(self.worker.run_pending(), 0)
+        self.assertFalse(ApplicationScores.objects.filter(application=self.application).exists())
+
+    def test_run_pending(self):
+        """Выполнение задачи пересчитывает баллы и снимает флаг ожидания"""
+        self.schedule(self.application.pk)
+        self.assertEqual(self.worker.run_pending(force=True), 1)
+        application = Application.objects.select_related('scores').get(pk=self.application.pk)
+        self.assertFalse(application.scores_pending)
+        self.assertEqual(application.scores.a2, round(4.5 * const.BACHELOR_COEF, 2))
+        self.assertEqual(application.fullness, application.calculate_fullness())
+
+    def test_run_pending_for_deleted_application(self):
+        """Задача на удаленную заявку пропускается"""
+        self.schedule(self.application.pk)
+        self.application.delete()
+        self.assertEqual(self.worker.run_pending(force=True), 1)
+
+    @override_settings(SCORES_BACKGROUND_RECOMPUTE=True)
+    def test_recompute_in_background(self):
+        """При включенном фоновом пересчете запрос только ставит задачу в очередь"""
+        with mock.patch.object(scores_worker, 'start') as start, self.captureOnCommitCallbacks() as callbacks:
+            recompute_scores(self.application)
+            self.assertNotIn(self.application.pk, scores_worker.jobs)
+        start.assert_called_once()
+        callbacks[0]()
+        self.assertIn(self.application.pk, scores_worker.jobs)
+        self.assertFalse(ApplicationScores.objects.filter(application=self.application).exists())
+        scores_worker.run_pending(force=True)
+        self.assertTrue(ApplicationScores.objects.filter(application=self.application).exists())
+
+    def test_jobs_wait_for_commit(self):
+        """Задача попадает в очередь только после фиксации транзакции, флаг ожидания ставится сразу"""
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.worker.schedule(self.application.pk)
+        self.assertNotIn(self.application.pk, self.worker.jobs)
+        self.assertTrue(Application.objects.get(pk=self.application.pk).scores_pending)
+        callbacks[0]()
+        self.assertIn(self.application.pk, self.worker.jobs)
+
+    def test_recompute_pending_command(self):
+        """Команда пересчитывает заявки, оставшиеся с флагом ожидания пересчета"""
+        Application.objects.filter(pk=self.application.pk).update(scores_pending=True)
+        out = StringIO()
+        call_command('recompute_pending_scores', stdout=out)
+        self.assertIn('Пересчитано заявок: 1', out.getvalue())
+        application = Application.objects.select_related('scores').get(pk=self.application.pk)
+        self.assertFalse(application.scores_pending)
+        self.assertEqual(application.scores.a2, round(4.5 * const.BACHELOR_COEF, 2))
@@ -1,4 +1,5 @@
 import logging
+import os
 import shutil
 import tempfile
 from urllib.parse import urlencode
@@ -13,6 +14,7 @@ from application.models import Application, Competence
 from application.tests.factories import UserFactory, RoleFactory, DirectionFactory, AffiliationFactory, MemberFactory, \
     create_uniq_application, WorkGroupFactory, create_uniq_member, CompetenceFactory, ApplicationNoteFactory, \
     FileFactory, BookingTypeFactory, BookingFactory, create_batch_competences_scores
+from application.utils import DocxTemplateCache
 from utils import constants as const
 
 logging.disable(logging.FATAL)
@@ -217,6 +219,22 @@ class DownloadServiceDocumentsTest(APITestCase):
             reverse('download-file') + '?' + urlencode({'doc': 'candidates', 'directions': False}))
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
 
+    def test_docx_template_cache(self):
+        """ Разобранный шаблон переиспользуется, не изменяется рендерингом и разбирается заново при изменении файла"""
+        path = os.path.join(tempfile.mkdtemp(), 'candidates.docx')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        shutil.copy(const.PATH_TO_CANDIDATES_LIST, path)
+        templates = DocxTemplateCache()
+        template = templates.get(path)
+        pristine_xml = template.parsed.docx.element.xml
+        template.render({'directions': [{'name': 'Тестовое направление', 'company_number': 1,
+                                         'members': [{'number': 1, 'last_name': 'Тестовый'}]}]})
+        self.assertIn('Тестовый', template.docx.element.xml)
+        self.assertEqual(template.parsed.docx.element.xml, pristine_xml)
+        self.assertIs(templates.get(path).parsed, template.parsed)
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+        self.assertIsNot(templates.get(path).parsed, template.parsed)
+
 
 class DirectionsCompetencesTest(APITestCase):
     def setUp(self) -> None:
@@ -4,7 +4,7 @@ from rest_framework_nested import routers
 
 from .views import DirectionsViewSet, ApplicationViewSet, EducationViewSet, CompetenceViewSet, BookingViewSet, \
     WishlistViewSet, WorkGroupViewSet, DownloadServiceDocuments, DirectionsCompetences, ApplicationNoteViewSet, \
-    FileViewSet, WorkingListViewSet
+    FileViewSet, WorkingListViewSet, RankingSimulationView, DirectionTopApplications, ExportJobViewSet
 
 router = DefaultRouter()
 router.register(r'directions', DirectionsViewSet)
@@ -13,6 +13,7 @@ router.register(r'competences', CompetenceViewSet)
 router.register(r'files', FileViewSet, basename='files')
 router.register(r'work-groups', WorkGroupViewSet, basename='work-groups')
 router.register(r'working-list', WorkingListViewSet, basename='working')
+router.register(r'export-jobs', ExportJobViewSet, basename='export-jobs')
 
 domains_router = routers.NestedSimpleRouter(router, r'applications', lookup='application')
 domains_router.register(r'educations', EducationViewSet, basename='educations')
@@ -22,6 +23,8 @@ domains_router.register(r'notes', ApplicationNoteViewSet, basename='notes')
 
 urlpatterns = [
     path(r'download-files/', DownloadServiceDocuments.as_view(), name='download-file'),
+    path(r'ranking-simulation/', RankingSimulationView.as_view(), name='ranking-simulation'),
+    path(r'directions/<int:direction_id>/top/', DirectionTopApplications.as_view(), name='direction-top'),
     path(r'directions/<int:direction_id>/competences/', DirectionsCompetences.as_view(), name='direction-competences'),
     path(r'', include(router.urls)),
     path(r'', include(domains_router.urls)),
@@ -1,33 +1,258 @@
+import base64
+import binascii
+import copy
+import csv
 import datetime
+import hashlib
+import json
+import os
 import re
-from io import BytesIO
-
+import threading
+from collections import OrderedDict
+from io import BytesIO, StringIO
+from itertools import islice
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
-from django.db.models import Prefetch, Count, Q, F, Case, When, Value, OuterRef
+from django.db.models import Prefetch, OuterRef, Exists, F, Q, prefetch_related_objects
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.encoding import escape_uri_path
+from django.utils.functional import cached_property
 from django_filters import NumberFilter, BaseInFilter, CharFilter, AllValuesMultipleFilter
 from django_filters.rest_framework import FilterSet
 from docxtpl import DocxTemplate
+from jinja2 import Environment
 from openpyxl import load_workbook, Workbook
 from openpyxl.utils.cell import get_column_letter
-from rest_framework.exceptions import ValidationError, ParseError
-from rest_framework.filters import OrderingFilter
+from rest_framework.exceptions import ValidationError, ParseError, NotFound
+from rest_framework.filters import OrderingFilter, SearchFilter
 from rest_framework.generics import get_object_or_404
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param, remove_query_param
 
 from account.models import Member, Affiliation, Booking, BookingType
 from utils import constants as const
 from utils.calculations import get_current_draft_year, convert_float
-from utils.constants import BOOKED, MEANING_COEFFICIENTS, PATH_TO_RATING_LIST, \
+from utils.constants import BOOKED, PATH_TO_RATING_LIST, \
     PATH_TO_CANDIDATES_LIST, PATH_TO_EVALUATION_STATEMENT, TRUE_VALUES, FALSE_VALUES, MASTER_ROLE_NAME
 from utils.constants import NAME_ADDITIONAL_FIELD_TEMPLATE
-from .models import Application, AdditionField, AdditionFieldApp, MilitaryCommissariat, Competence, ViewedApplication, \
-    Education, ApplicationNote
+from .models import Application, AdditionField, AdditionFieldApp, Competence, ViewedApplication, \
+    Education, ApplicationNote, ScoringCoefficients, ApplicationRank, DataVersion
+from .scoring import refresh_stale_applications
+from .search import filter_by_search_term
+
+
+class CachedCountPaginator(Paginator):
+    """
+    Paginator, который считает заявки без аннотаций, не участвующих в фильтрах, и кеширует количество по cache_key
+    """
+
+    def __init__(self, object_list, per_page, cache_key=None, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.cache_key = cache_key
+
+    @cached_property
+    def count(self):
+        if self.cache_key is not None:
+            count = cache.get(self.cache_key)
+            if count is not None:
+                return count
+        # values('pk') оставляет в запросе только аннотации, на которые ссылаются фильтры
+        count = self.object_list.order_by().values('pk').count()
+        if self.cache_key is not None:
+            cache.set(self.cache_key, count, settings.APPLICATION_COUNT_CACHE_TIMEOUT)
+        return count
 
 
 class PaginationApplication(PageNumberPagination):
-    """Пагинация для списка анкет."""
+    """
+    Пагинация для списка анкет.
+    Количество заявок кешируется для набора фильтров и пользователя до изменения данных заявок (DataVersion),
+    а при APPLICATION_APPROXIMATE_COUNT - на время APPLICATION_COUNT_CACHE_TIMEOUT без сверки с версией данных.
+    """
+    page_size = 50
+    count_cache_prefix = 'application-count'
+    # query параметры, не влияющие на количество заявок
+    count_ignored_params = ('page', 'ordering', 'fields', 'omit', 'pagination')
+
+    def get_count_cache_key(self, request):
+        """
+        Возвращает ключ кеша количества заявок
+        :param request: запрос списка
+        :return: строка ключа
+        """
+        params = sorted((param, sorted(values)) for param, values in request.query_params.lists()
+                        if param not in self.count_ignored_params)
+        parts = [request.path, request.user.pk, params]
+        if not settings.APPLICATION_APPROXIMATE_COUNT:
+            data_version = DataVersion.get()
+            parts.append([data_version.version, data_version.update_date.timestamp()])
+        digest = hashlib.md5(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+        return f'{self.count_cache_prefix}:{digest}'
+
+    def django_paginator_class(self, object_list, per_page):
+        """Создает paginator страницы (вызывается из PageNumberPagination.paginate_queryset)"""
+        return CachedCountPaginator(object_list, per_page, cache_key=self.count_cache_key)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_cache_key = self.get_count_cache_key(request) if settings.APPLICATION_COUNT_CACHE_TIMEOUT else None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class CursorPaginationApplication(BasePagination):
+    """
+    Курсорная (keyset) пагинация для списка анкет.
+
+    Страница выбирается условием на значения полей сортировки последней (первой) заявки предыдущей страницы,
+    а не OFFSET, и без подсчета всех заявок, поэтому любая страница стоит столько же, сколько первая.
+    Поддерживает составную сортировку queryset (например, -our_direction и выбранные пользователем поля),
+    в конец которой добавляется id для однозначного порядка. Пустые значения всегда идут в конце.
+    """
     page_size = 50
+    cursor_query_param = 'cursor'
+    mode_query_param = 'pagination'
+    mode = 'cursor'
+    invalid_cursor_message = 'Неверный курсор'
+
+    @classmethod
+    def is_requested(cls, request):
+        """Возвращает True, если в запросе выбрана курсорная пагинация"""
+        return request.query_params.get(cls.mode_query_param) == cls.mode or \
+            cls.cursor_query_param in request.query_params
+
+    @staticmethod
+    def get_ordering(queryset):
+        """
+        Возвращает сортировку queryset без повторяющихся полей с id в конце
+        :return: список кортежей (поле, по убыванию)
+        """
+        ordering = {}
+        for term in queryset.query.order_by or queryset.model._meta.ordering:
+            ordering.setdefault(term.lstrip('-'), term.startswith('-'))
+        ordering = list(ordering.items())
+        if not any(field in ('pk', 'id') for field, _ in ordering):
+            ordering.append(('pk', False))
+        return ordering
+
+    @staticmethod
+    def is_nullable(queryset, field):
+        """Возвращает True, если поле сортировки может быть пустым"""
+        if field in queryset.query.annotations:
+            return not isinstance(queryset.query.annotations[field], Exists)
+        opts = queryset.model._meta
+        for name in field.split('__'):
+            model_field = opts.pk if name == 'pk' else opts.get_field(name)
+            if model_field.null:
+                return True
+            if model_field.is_relation:
+                opts = model_field.related_model._meta
+        return False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(queryset)
+        self.aliases = [f'keyset_{i}' for i in range(len(self.ordering))]
+        self.nullable = [self.is_nullable(queryset, field) for field, _ in self.ordering]
+        cursor = self.decode_cursor(request)
+        self.reverse = bool(cursor and cursor['reverse'])
+
+        queryset = queryset.annotate(**{alias: F(field) for alias, (field, _) in zip(self.aliases, self.ordering)})
+        if cursor:
+            queryset = queryset.filter(self.get_cursor_filter(cursor['values']))
+        order_by = []
+        for alias, (_, descending), nullable in zip(self.aliases, self.ordering, self.nullable):
+            expression = F(alias).desc if descending != self.reverse else F(alias).asc
+            nulls = {'nulls_first': True} if self.reverse else {'nulls_last': True}
+            order_by.append(expression(**nulls) if nullable else expression())
+        results = list(queryset.order_by(*order_by)[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+        self.has_next = bool(cursor) if self.reverse else has_more
+        self.has_previous = has_more if self.reverse else bool(cursor)
+        return self.page
+
+    def get_cursor_filter(self, values):
+        """
+        Строит условие на заявки после курсора в порядке сортировки (перед курсором при обратном проходе):
+        (a после va) или (a = va и b после vb) или ...
+        :param values: значения полей сортировки заявки, на которой стоит курсор
+        """
+        condition, equal = Q(pk__in=[]), Q()
+        for alias, (_, descending), nullable, value in zip(self.aliases, self.ordering, self.nullable, values):
+            if self.reverse:
+                # перед значением: пустые значения в конце, поэтому перед пустым - все непустые
+                after = Q(**{f'{alias}__isnull': False}) if value is None else \
+                    Q(**{f'{alias}__{"gt" if descending else "lt"}': value})
+            else:
+                after = Q(pk__in=[]) if value is None else Q(**{f'{alias}__{"lt" if descending else "gt"}': value})
+                if nullable and value is not None:
+                    after |= Q(**{f'{alias}__isnull': True})
+            condition |= equal & after
+            equal &= Q(**{f'{alias}__isnull': True}) if value is None else Q(**{alias: value})
+        return condition
+
+    def decode_cursor(self, request):
+        """
+        Декодирует курсор из query параметра
+        :return: словарь {'values': значения полей сортировки, 'reverse': обратный проход} или None
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            values, reverse = cursor['v'], bool(cursor['r'])
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if cursor.get('o') != [field for field, _ in self.ordering] or len(values) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return {'values': values, 'reverse': reverse}
+
+    def encode_cursor(self, application, reverse):
+        """Возвращает ссылку на страницу после (перед) заявкой application (экземпляром или строкой values())"""
+        cursor = {'o': [field for field, _ in self.ordering], 'r': reverse,
+                  'v': [application[alias] if isinstance(application, dict) else getattr(application, alias)
+                        for alias in self.aliases]}
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor, cls=DjangoJSONEncoder).encode()).decode()
+        url = replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+        return remove_query_param(url, self.mode_query_param)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
 
 
 def has_affiliation(member, affiliation):
@@ -134,6 +359,81 @@ def add_additional_fields(request, user_app):
                                                           f"{NAME_ADDITIONAL_FIELD_TEMPLATE}{field.id}")})
 
 
+class CachedTemplateEnvironment(Environment):
+    """ Окружение jinja, которое компилирует шаблон из строки один раз """
+
+    def __init__(self):
+        super().__init__()
+        self.compiled = {}
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals is not None or template_class is not None:
+            return super().from_string(source, globals, template_class)
+        template = self.compiled.get(source)
+        if template is None:
+            template = self.compiled[source] = super().from_string(source)
+        return template
+
+
+class ParsedDocxTemplate:
+    """ Разобранный ворд шаблон: документ, исправленный xml частей и скомпилированные jinja шаблоны """
+
+    def __init__(self, path, mtime):
+        self.path = path
+        self.mtime = mtime
+        template = DocxTemplate(path)
+        template.init_docx()
+        self.docx = template.docx
+        self.patched_xml = {}
+        self.jinja_env = CachedTemplateEnvironment()
+
+
+class CachedDocxTemplate(DocxTemplate):
+    """ DocxTemplate, который рендерится в копии разобранного шаблона, не изменяя его """
+
+    def __init__(self, parsed):
+        super().__init__(parsed.path)
+        self.parsed = parsed
+        self.docx = copy.deepcopy(parsed.docx)
+
+    def patch_xml(self, src_xml):
+        patched_xml = self.parsed.patched_xml.get(src_xml)
+        if patched_xml is None:
+            patched_xml = self.parsed.patched_xml[src_xml] = super().patch_xml(src_xml)
+        return patched_xml
+
+    def render(self, context, jinja_env=None, autoescape=False):
+        if jinja_env is None and not autoescape:
+            jinja_env = self.parsed.jinja_env
+        super().render(context, jinja_env, autoescape)
+
+
+class DocxTemplateCache:
+    """ Кеш разобранных ворд шаблонов процесса по пути и времени изменения файла """
+
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Возвращает шаблон для рендеринга документа, при изменении файла шаблон разбирается заново
+        :param path: путь к файлу шаблона
+        :return: экземпляр CachedDocxTemplate
+        """
+        mtime = os.stat(path).st_mtime_ns
+        parsed = self.templates.get(path)
+        if parsed is None or parsed.mtime != mtime:
+            with self.lock:
+                parsed = self.templates.get(path)
+                if parsed is None or parsed.mtime != mtime:
+                    parsed = self.templates[path] = ParsedDocxTemplate(path, mtime)
+        return CachedDocxTemplate(parsed)
+
+
+docx_templates = DocxTemplateCache()
+
+
 class WordTemplate:
     """ Класс для создания шаблона ворд документа по файлу, через путь path_to_template """
 
@@ -141,9 +441,14 @@ class WordTemplate:
         self.request = request
         self.path = path_to_template
 
+    @cached_property
+    def coefficients(self):
+        """ Актуальные весовые коэффициенты итоговой оценки, получаются один раз на документ """
+        return ScoringCoefficients.get_current().as_dict()
+
     def create_word_in_buffer(self, context):
         """ Создает ворд документ и добавлет в него данные и сохраняет в буфер """
-        template = DocxTemplate(self.path)
+        template = docx_templates.get(self.path)
         user_docx = BytesIO()
         template.render(context=context)
         template.save(user_docx)
@@ -152,9 +457,9 @@ class WordTemplate:
 
     def create_context_to_interview_list(self, pk):
         """ Создает контекст для шаблона - 'Лист собеседования' """
-        user_app = Application.objects.select_related('member').prefetch_related('education').defer('id').get(pk=pk)
-        user_education = user_app.education.order_by('-end_year').values()
-        user_education = user_education[0] if user_education else {}
+        user_app = Application.objects.select_related('member__user').defer('id').get(pk=pk)
+        # кроме копии последнего образования шаблону нужны документ об образовании и тема диплома
+        user_education = user_app.education.order_by('-end_year', 'pk').values().first() or {}
         context = {**user_app.__dict__, **user_education}
         context.update({'father_name': user_app.member.father_name, 'phone': user_app.member.phone})
         context.update({'first_name': user_app.member.user.first_name, 'last_name': user_app.member.user.last_name})
@@ -175,14 +480,13 @@ class WordTemplate:
             }
             booked = Booking.objects.select_related('slave').filter(affiliation=direction, booking_type__name=BOOKED)
             booked_slaves = [b.slave for b in booked]
-            booked_user_apps = Application.objects.select_related('scores', 'member__user').prefetch_related(
-                'education'). \
+            booked_user_apps = Application.objects.select_related('scores', 'member__user', 'commissariat'). \
                 filter(member__in=booked_slaves, draft_year=current_year, draft_season=current_season[0]).all()
+            refresh_stale_applications(booked_user_apps)
 
             for i, user_app in enumerate(booked_user_apps):
-                try:
-                    user_last_education = user_app.education.all()[0]
-                except IndexError:
+                user_last_education = user_app.get_last_education_snapshot()
+                if user_last_education is None:
                     raise ValidationError(f'Файл не может быть сформирован, т.к. {user_app} не указал образование!')
                 general_info, additional_info = {'number': i + 1,
                                                  'first_name': user_app.member.user.first_name,
@@ -222,7 +526,7 @@ class WordTemplate:
 
     def _get_evaluation_st_info(self, user_app):
         return {
-            **{k: convert_float(v) for k, v in MEANING_COEFFICIENTS.items()},
+            **{k: convert_float(v) for k, v in self.coefficients.items()},
             **{k: convert_float(v) for k, v in user_app.scores.__dict__.items() if isinstance(v, float)},
         }
 
@@ -236,9 +540,8 @@ class WordTemplate:
         }
 
     def _get_candidates_info(self, user_app, user_last_education):
-        commissariat = MilitaryCommissariat.objects.filter(name=user_app.military_commissariat).first()
         return {
-            'subject': commissariat.subject if commissariat else '',
+            'subject': user_app.commissariat.subject if user_app.commissariat else '',
             'birth_day': user_app.birth_day.year,
             'avg_score': convert_float(user_last_education.avg_score),
         }
@@ -264,12 +567,6 @@ def get_service_file(request, path_to_file, all_directions):
     return word_template.create_word_in_buffer(context)
 
 
-def update_user_application_scores(pk):
-    """Обновляет баллы анкеты с pk"""
-    user_app = get_object_or_404(Application, pk=pk)
-    user_app.update_scores(update_fields=['fullness', 'final_score'])
-
-
 def set_is_final(application, value):
     """Разблокирует заявку для бронирования"""
     application.is_final = value
@@ -371,6 +668,8 @@ class ApplicationFilter(FilterSet):
                                  method='filter_booking_aff')  # id affiliation, на которые отобраны заявки
     wishlist_aff = NumberInFilter(label='Избранны для взводов',
                                   method='filter_wishlist_aff')  # id affiliation, для которых заявки добавлены в вишлист
+    final_score_min = NumberFilter(label='Итоговый балл от', method='filter_final_score')
+    final_score_max = NumberFilter(label='Итоговый балл до', method='filter_final_score')
 
     def filter_booking_aff(self, queryset, name, value):
         """
@@ -400,9 +699,21 @@ class ApplicationFilter(FilterSet):
             .values_list('slave', flat=True)
         return queryset.filter(member__id__in=wish_list_members).distinct()
 
+    def filter_final_score(self, queryset, name, value):
+        """
+        Фильтрует queryset по итоговому баллу, рассчитанному в БД.
+        :param queryset: исходный queryset
+        :param name: имя query-параметра (final_score_min - нижняя граница, final_score_max - верхняя)
+        :param value: граница итогового балла
+        :return: отфильтрованный queryset
+        """
+        lookup = 'gte' if name == 'final_score_min' else 'lte'
+        return queryset.with_calculated_final_score().filter(**{f'calculated_final_score__{lookup}': value})
+
     class Meta:
         model = Application
-        fields = ('directions', 'booking_aff', 'wishlist_aff', 'draft_season', 'draft_year')
+        fields = ('directions', 'booking_aff', 'wishlist_aff', 'draft_season', 'draft_year',
+                  'final_score_min', 'final_score_max')
 
 
 class WorkingListFilter(FilterSet):
@@ -437,50 +748,175 @@ class WorkingListFilter(FilterSet):
 class CustomOrderingFilter(OrderingFilter):
     """Фильтр со стандартной сортировкой анкет"""
 
+    # поля, сортировка по которым выполняется по значению, рассчитанному в БД
+    calculated_ordering_fields = {'final_score': 'calculated_final_score'}
+
     def filter_queryset(self, request, queryset, view):
         # Сортирует queryset.
         # Default ordering применяется всегда. Остальные сортировки происходят после default.
         # Сортирует только если пользователь является отбирающим.
         if not is_master(request.user):
             return queryset
-        ordering = super().get_default_ordering(view)
-        ordering.extend(self.get_ordering(request, queryset, view))
+        ordering = [*super().get_default_ordering(view), *self.get_ordering(request, queryset, view)]
+        ordering = [self.get_calculated_ordering_term(term) for term in ordering]
+        if any(term.lstrip('-') in self.calculated_ordering_fields.values() for term in ordering):
+            queryset = queryset.with_calculated_final_score()
 
         if ordering:
             return queryset.order_by(*ordering)
 
         return queryset
 
+    def get_calculated_ordering_term(self, term):
+        """Заменяет поле сортировки на аннотацию, рассчитываемую в БД, сохраняя направление сортировки"""
+        field = term.lstrip('-')
+        if field in self.calculated_ordering_fields:
+            return term.replace(field, self.calculated_ordering_fields[field])
+        return term
+
+
+class ApplicationSearchFilter(SearchFilter):
+    """
+    Поиск заявок по поисковому документу (см. application.search) вместо icontains по каждому полю с соединениями
+    и DISTINCT. Поля, входящие в документ, задает application.search, а не search_fields вьюсета.
+    Каждое слово запроса должно встречаться в документе.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        for term in self.get_search_terms(request):
+            queryset = filter_by_search_term(queryset, term)
+        return queryset
+
+
+class ExportRenderer(JSONRenderer):
+    """
+    Формат выгрузки заявок для согласования по query параметру format или заголовку Accept.
+    Файл формирует действие выгрузки, а renderer используется только для ответов с ошибками, которые отдаются в JSON.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = JSONRenderer.media_type
+        return super().render(data, JSONRenderer.media_type, renderer_context)
+
+
+class XlsxExportRenderer(ExportRenderer):
+    media_type = 'application/xlsx'
+    format = 'xlsx'
+
+
+class CsvExportRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class JsonLinesExportRenderer(ExportRenderer):
+    media_type = 'application/jsonl'
+    format = 'jsonl'
+
+
+# форматы выгрузки заявок, первый используется по умолчанию
+EXPORT_RENDERERS = [XlsxExportRenderer, CsvExportRenderer, JsonLinesExportRenderer]
+
 
 class ApplicationExporter:
-    """Экспорт списка заявок в exel"""
+    """
+    Экспорт списка заявок в exel.
+    Заявки читаются через iterator() пачками по chunk_size со связанными данными для каждой пачки, строки листа
+    write-only книги openpyxl пишутся во временный файл, а готовая книга сохраняется во временный файл,
+    который остается в памяти до spool_max_size байт, и отдается FileResponse блоками.
+    """
+    chunk_size = 500
+    spool_max_size = 10 * 1024 * 1024
+    # поля заявки и участника, которые попадают в файлы, остальные поля не загружаются
+    export_fields = ('birth_day', 'birth_place', 'draft_year', 'draft_season', 'final_score',
+                     *Application.last_education_fields.values(), 'member__phone', 'member__father_name',
+                     'member__user__first_name', 'member__user__last_name', 'member__user__email')
 
     def __init__(self, applications):
         """
         Устанавливает список анкет, создает и устанавливает книгу и лист.
-        :param applications: queryset заявок
+        :param applications: queryset заявок (субъект - аннотация subject,
+                             для рабочего листа - компетенции в rated_competences)
         """
         self.applications = applications
         self.wb = Workbook(write_only=True)
         self.sheet = self.wb.create_sheet()
 
+    def iter_applications(self):
+        """
+        Возвращает заявки queryset только с полями export_fields, загружая их и связанные данные пачками.
+        Последнее образование берется из его копии в заявке, поэтому на пачку приходится постоянное число запросов.
+        """
+        applications = self.applications.select_related('member__user').only(*self.export_fields)
+        lookups = applications._prefetch_related_lookups
+        for chunk in iter_chunks(applications.iterator(chunk_size=self.chunk_size), self.chunk_size):
+            prefetch_related_objects(chunk, *lookups)
+            yield from chunk
+
+    def get_application_rows(self):
+        """Возвращает генератор строк списка заявок."""
+        for app in self.iter_applications():
+            yield self._convert_applications_to_required_format(app)
+
+    def get_work_list_rows(self):
+        """Возвращает генератор строк рабочего листа."""
+        for app in self.iter_applications():
+            yield self._convert_work_list_to_required_format(app)
+
     def add_applications_to_sheet(self):
         """Добавляет заявки в файл и сохраняет его."""
-        header = const.HEADERS_FOR_EXCEL_APP_TABLES
-        self._set_column_dimensions(header)
-        self.sheet.append(header)
-        for app in self.applications:
-            row = self._convert_applications_to_required_format(app)
-            self.sheet.append(row)
-        return self._save()
+        return self._add_rows_to_sheet(const.HEADERS_FOR_EXCEL_APP_TABLES, self.get_application_rows())
 
     def add_work_list_to_sheet(self):
         """Добавляет заявки забочего листа в файл и сохраняет."""
-        header = const.WORK_LIST_HEADERS_FOR_EXCEL
+        return self._add_rows_to_sheet(const.WORK_LIST_HEADERS_FOR_EXCEL, self.get_work_list_rows())
+
+    def get_response(self, export_format, header, rows, filename):
+        """
+        Возвращает ответ с файлом выгрузки. CSV и JSON Lines пишутся по мере чтения заявок пачками.
+        :param export_format: формат файла (xlsx, csv или jsonl)
+        :param header: заголовки колонок
+        :param rows: генератор строк
+        :param filename: имя файла без расширения
+        :return: FileResponse или StreamingHttpResponse
+        """
+        if export_format == CsvExportRenderer.format:
+            response = StreamingHttpResponse(self.stream_csv(header, rows), content_type='text/csv; charset=utf-8')
+        elif export_format == JsonLinesExportRenderer.format:
+            response = StreamingHttpResponse(self.stream_json_lines(header, rows),
+                                             content_type='application/jsonl; charset=utf-8')
+        else:
+            export_format = XlsxExportRenderer.format
+            response = FileResponse(self._add_rows_to_sheet(header, rows), content_type='application/xlsx')
+        response['Content-Disposition'] = 'attachment; filename="' + \
+                                          escape_uri_path(f'{filename}.{export_format}') + '"'
+        return response
+
+    def stream_csv(self, header, rows):
+        """Возвращает генератор частей CSV файла: заголовок, затем строки пачками по chunk_size."""
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for chunk in iter_chunks(rows, self.chunk_size):
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    def stream_json_lines(self, header, rows):
+        """Возвращает генератор частей JSON Lines файла: по объекту {заголовок: значение} на строку."""
+        for chunk in iter_chunks(rows, self.chunk_size):
+            yield ''.join(json.dumps(dict(zip(header, row)), cls=JSONEncoder, ensure_ascii=False) + '\n'
+                          for row in chunk).encode()
+
+    def _add_rows_to_sheet(self, header, rows):
+        """Добавляет заголовок и строки на лист и сохраняет файл."""
         self._set_column_dimensions(header)
         self.sheet.append(header)
-        for app in self.applications:
-            row = self._convert_work_list_to_required_format(app)
+        for row in rows:
             self.sheet.append(row)
         return self._save()
 
@@ -495,7 +931,7 @@ class ApplicationExporter:
 
     def _get_education_info(self, application):
         """Возвращает информацию об образовании кандидата, если оно существует."""
-        education = application.education.first()
+        education = application.get_last_education_snapshot()
         return (education.university, education.get_education_type_display(), education.specialization,
                 education.avg_score) if education else ('', '', '', '')
 
@@ -525,7 +961,7 @@ class ApplicationExporter:
 
     def _save(self):
         """Сохраняет файл."""
-        buffer = BytesIO()
+        buffer = SpooledTemporaryFile(max_size=self.spool_max_size)
         self.wb.save(buffer)
         buffer.seek(0)
         return buffer
@@ -537,120 +973,118 @@ class ApplicationExporter:
             self.sheet.column_dimensions[letter].width = 30
 
 
-def get_applications_by_master(user, master_affiliations, master_directions, master_directions_id):
+def iter_chunks(iterable, chunk_size):
+    """
+    Разбивает итерируемый объект на пачки
+    :param iterable: итерируемый объект
+    :param chunk_size: размер пачки
+    :return: генератор списков
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, chunk_size)):
+        yield chunk
+
+
+def stream_json_list(chunks):
+    """
+    Собирает JSON массив по частям, не держа в памяти весь список
+    :param chunks: итерируемый объект со списками элементов массива
+    :return: генератор байтовых частей JSON
+    """
+    yield b'['
+    separator = b''
+    for chunk in chunks:
+        if chunk:
+            yield separator + b','.join(json.dumps(item, cls=JSONEncoder, ensure_ascii=False).encode()
+                                        for item in chunk)
+            separator = b','
+    yield b']'
+
+
+def get_applications_by_master(user, master_affiliations, master_directions, master_directions_id, fields=None):
     """
     Возвращает queryset заявок с аннотированными полями.
+    Флаги бронирования, избранного и просмотра читаются из таблицы MasterApplicationState,
+    если включен MASTER_APPLICATION_STATES, иначе считаются подзапросами.
+    Если переданы fields, загружаются только связанные данные и флаги, нужные для этих полей сериализатора.
+    Аннотации our_direction, subject и rank добавляются всегда, так как по ним выполняются сортировка и поиск.
+    Вместе с полем fullness аннотируется заполненность блоков анкеты (with_filled_blocks), поэтому ее пересчет
+    для загруженной заявки не требует отдельного запроса.
 
     Переданный user должен иметь роль master.
     :param user: экземляр user(мастер)
     :param master_affiliations: список принадлежностей мастера
     :param master_directions: список направлений мастера
     :param master_directions_id: список id направлений мастера
+    :param fields: поля сериализатора списка, которые будут отданы (по умолчанию - все)
     :return: queryset(Application)
     """
-    apps = (
-        Application.objects.all()
-            .select_related("member", "member__user")
-            .prefetch_related(
-            "education",
+    prefetches = {
+        'education': "education",
+        'directions': "directions",
+        'notes': Prefetch(
+            "notes",
+            queryset=ApplicationNote.objects.filter(
+                author=user.member,
+                affiliations__in=master_affiliations,
+            )
+                .select_related("author__user")
+                .prefetch_related("affiliations"),
+        ),
+        'wishlist': Prefetch(
+            "member__candidate",
+            queryset=Booking.objects.filter(
+                affiliation__in=master_affiliations,
+                booking_type__name=const.IN_WISHLIST,
+            ).select_related("affiliation", "master__user"),
+        ),
+        'booking': Prefetch(
+            "member__candidate",
+            queryset=Booking.objects.filter(
+                booking_type__name=const.BOOKED
+            ).select_related("affiliation", "master__user"),
+            to_attr="booking_affiliation",
+        ),
+        'available_booking_direction': Prefetch(
             "directions",
-            Prefetch(
-                "notes",
-                queryset=ApplicationNote.objects.filter(
-                    author=user.member,
-                    affiliations__in=master_affiliations,
-                )
-                    .select_related("author__user")
-                    .prefetch_related("affiliations"),
-            ),
-            Prefetch(
-                "member__candidate",
-                queryset=Booking.objects.filter(
-                    affiliation__in=master_affiliations,
-                    booking_type__name=const.IN_WISHLIST,
-                ).select_related("affiliation", "master__user"),
-            ),
-            Prefetch(
-                "member__candidate",
-                queryset=Booking.objects.filter(
-                    booking_type__name=const.BOOKED
-                ).select_related("affiliation", "master__user"),
-                to_attr="booking_affiliation",
-            ),
-            Prefetch(
-                "directions",
-                queryset=master_directions,
-                to_attr="available_booking_direction",
-            ),
-        )
+            queryset=master_directions,
+            to_attr="available_booking_direction",
+        ),
+    }
+    apps = Application.objects.all()
+    if fields is None or {'member', 'wishlist', 'booking'} & set(fields):
+        apps = apps.select_related("member", "member__user")
+    apps = (
+        apps.prefetch_related(*(prefetch for field, prefetch in prefetches.items() if fields is None or field in fields))
             .annotate(
-            is_booked=Count(
-                F("member__candidate"),
-                filter=Q(member__candidate__booking_type__name=const.BOOKED),
-                distinct=True,
-            ),
-            is_booked_our=Count(
-                F("member__candidate"),
-                filter=Q(
-                    member__candidate__booking_type__name=const.BOOKED,
-                    member__candidate__affiliation__in=master_affiliations,
-                ),
-                distinct=True,
-            ),
-            can_unbook=Count(
-                F("member__candidate"),
-                filter=Q(
-                    member__candidate__booking_type__name=const.BOOKED,
-                    member__candidate__affiliation__in=master_affiliations,
-                    member__candidate__master=user.member,
-                ),
-                distinct=True,
-            ),
-            wishlist_len=Count(
-                F("member__candidate"),
-                filter=Q(member__candidate__booking_type__name=const.IN_WISHLIST),
-                distinct=True,
-            ),
-            is_in_wishlist=Count(
-                F("member__candidate"),
-                filter=Q(
-                    member__candidate__booking_type__name=const.IN_WISHLIST,
-                    member__candidate__affiliation__in=master_affiliations,
-                ),
-                distinct=True,
-            ),
-            our_direction_count=Count(
-                F('directions'),
-                filter=Q(directions__id__in=master_directions_id),
-                distinct=True
-            ),
-            our_direction=Case(
-                When(our_direction_count__gt=0, then=Value(True)),
-                default=Value(False),
-            ),
-            subject=(
-                MilitaryCommissariat.objects.filter(
-                    name=OuterRef("military_commissariat")
-                ).values_list("subject")[:1]
+            our_direction=Exists(
+                Application.directions.through.objects.filter(
+                    application=OuterRef("pk"), direction__in=master_directions_id
+                )
             ),
-            is_viewed=Count(
-                F("viewed"),
-                filter=Q(viewed__member=user.member),
-                distinct=True,
+            subject=F("commissariat__subject"),
+            rank=(
+                ApplicationRank.objects.filter(
+                    application=OuterRef("pk"), direction__in=master_directions_id
+                ).order_by("rank").values_list("rank")[:1]
             ),
         )
     )
-    return apps
+    if fields is None or 'fullness' in fields:
+        apps = apps.with_filled_blocks()
+    if settings.MASTER_APPLICATION_STATES:
+        return apps.with_master_states(user.member, flags=fields)
+    return apps.with_booking_flags(user.member, master_affiliations, flags=fields)
 
 
 def get_applications_by_slave():
     """
-    Возвращает queryset заявок с аннотированными полями.
+    Возвращает queryset заявок с аннотированными полями и заполненностью блоков анкеты.
 
     :return: queryset(Application)
     """
     apps = (
-        Application.objects.all()
+        Application.objects.with_filled_blocks()
             .select_related("member", "member__user")
             .prefetch_related(
             "education",
@@ -664,16 +1098,10 @@ def get_applications_by_slave():
             ),
         )
             .annotate(
-            is_booked=Count(
-                F("member__candidate"),
-                filter=Q(member__candidate__booking_type__name=const.BOOKED),
-                distinct=True,
-            ),
-            subject=(
-                MilitaryCommissariat.objects.filter(
-                    name=OuterRef("military_commissariat")
-                ).values_list("subject")[:1]
+            is_booked=Exists(
+                Booking.objects.filter(slave=OuterRef("member"), booking_type__name=const.BOOKED)
             ),
+            subject=F("commissariat__subject"),
         )
     )
     return apps
@@ -1,13 +1,13 @@
 import os
 
 from django.db.models import Q, Prefetch
-from django.http import FileResponse
+from django.http import FileResponse, Http404
 from django.utils.encoding import escape_uri_path
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import viewsets, status, serializers, mixins
 from rest_framework.decorators import action
 from rest_framework.exceptions import ParseError, PermissionDenied
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.generics import get_object_or_404
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
@@ -15,13 +15,16 @@ from rest_framework.views import APIView
 from rest_framework.viewsets import GenericViewSet
 
 from account.models import Booking
-from application.mixins import PermissionPolicyMixin, DataApplicationMixin
+from application.mixins import PermissionPolicyMixin, DataApplicationMixin, ActualFinalScoreMixin, \
+    CursorPaginationMixin, SparseFieldsetMixin, StreamingListMixin, ConditionalGetMixin
 from application.models import Application, Direction, Education, ApplicationCompetencies, Competence, WorkGroup, \
-    ApplicationNote, File
+    ApplicationNote, File, ApplicationRank, ExportJob, ScoringCoefficients
+from application.export_jobs import create_export_job
 from application.permissions import IsMasterPermission, IsApplicationOwnerPermission, IsSlavePermission, \
     ApplicationIsNotFinalPermission, IsBookedOnMasterDirectionPermission, IsNestedApplicationOwnerPermission, \
     IsNotFinalNestedApplicationPermission, IsNestedApplicationBookedOnMasterDirectionPermission, \
-    IsApplicationBookedByCurrentMasterPermission, DoesMasterHaveDirectionPermission
+    IsApplicationBookedByCurrentMasterPermission, DoesMasterHaveDirectionPermission, get_nested_application
+from application.scoring import simulate_ranking
 from application.serializers import ChooseDirectionSerializer, \
     ApplicationListSerializer, DirectionDetailSerializer, DirectionListSerializer, ApplicationSlaveDetailSerializer, \
     ApplicationMasterDetailSerializer, EducationDetailSerializer, ApplicationWorkGroupSerializer, \
@@ -29,14 +32,18 @@ from application.serializers import ChooseDirectionSerializer, \
     ApplicationCompetenciesSerializer, CompetenceDetailSerializer, \
     BookingSerializer, BookingCreateSerializer, WorkGroupSerializer, ApplicationIsFinalSerializer, \
     WorkGroupDetailSerializer, CompetenceSerializer, ApplicationNoteSerializer, ViewedApplicationSerializer, \
-    FileSerializer, ApplicationMasterListSerializer, BookingDetailSerializer, WorkingListSerializer
+    FileSerializer, ApplicationMasterListSerializer, BookingDetailSerializer, WorkingListSerializer, \
+    RankingSimulationSerializer, ApplicationRankSerializer, ExportJobSerializer
 from application.utils import get_booked_type, get_in_wishlist_type, get_master_affiliations_id, \
-    get_application_as_word, get_service_file, update_user_application_scores, set_work_group, set_is_final, \
+    get_application_as_word, get_service_file, set_work_group, set_is_final, \
     has_affiliation, get_competence_list, parse_str_to_bool, remove_direction_from_competence_list, \
     add_direction_to_competence_list, has_application_viewed, PaginationApplication, ApplicationFilter, \
     CustomOrderingFilter, ApplicationExporter, get_applications_by_master, get_applications_by_slave, is_master, \
-    is_slave, WorkingListFilter, get_chosen_affiliation_id
+    is_slave, WorkingListFilter, get_chosen_affiliation_id, ApplicationSearchFilter, EXPORT_RENDERERS
+from application.workers import recompute_scores
 from utils import constants as const
+from utils.calculations import get_current_draft_year
+from utils.exceptions import ExportJobNotReadyException
 
 """
 todo: не реализован функционал: рабочий список, дополнительные поля заявки(возможно)
@@ -55,18 +62,22 @@ class DirectionsViewSet(viewsets.ReadOnlyModelViewSet):
         return self.serializers.get(self.action, self.default_serializer_class)
 
 
-class ApplicationViewSet(PermissionPolicyMixin, DataApplicationMixin, viewsets.ModelViewSet):
+class ApplicationViewSet(PermissionPolicyMixin, DataApplicationMixin, ActualFinalScoreMixin, CursorPaginationMixin,
+                         SparseFieldsetMixin, StreamingListMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     """
     Главный список заявок
     Также дополнительные вложенные эндпоинты для получения и сохранения компетенций, направлений, рабочих групп.
     """
     pagination_class = PaginationApplication
-    filter_backends = [DjangoFilterBackend, CustomOrderingFilter, SearchFilter]
+    filter_backends = [DjangoFilterBackend, CustomOrderingFilter, ApplicationSearchFilter]
     filterset_class = ApplicationFilter
-    ordering_fields = ['member__user__last_name', 'birth_place', 'subject', 'final_score', 'fullness']
+    ordering_fields = ['member__user__last_name', 'birth_place', 'subject', 'final_score', 'fullness', 'rank']
     ordering = ['-our_direction']
-    search_fields = ['member__user__first_name', 'member__user__last_name', 'member__father_name',
-                     'education__university', 'subject', 'education__specialization', 'birth_place']
+    conditional_actions = ('list', 'retrieve', 'get_chosen_direction_list', 'get_work_group', 'get_competences_list')
+    # действия, которым нужна только сама заявка без связанных данных сериализаторов списка и анкеты
+    object_actions = ('get_chosen_direction_list', 'set_chosen_direction_list', 'get_work_group', 'set_work_group',
+                      'set_is_final', 'get_competences_list', 'set_competences_list', 'view_application',
+                      'download_application_as_word')
 
     master_serializers = {
         'get_chosen_direction_list': DirectionDetailSerializer,
@@ -111,13 +122,30 @@ class ApplicationViewSet(PermissionPolicyMixin, DataApplicationMixin, viewsets.M
         """Возвращает разные queryset для разных ролей."""
         if is_master(self.request.user):
             apps = get_applications_by_master(self.request.user, self.get_master_affiliations(),
-                                              self.get_master_directions(), self.get_master_directions_id())
+                                              self.get_master_directions(), self.get_master_directions_id(),
+                                              fields=self.get_sparse_fields())
         elif is_slave(self.request.user) or self.request.user.is_superuser:
             apps = get_applications_by_slave()
         else:
             apps = Application.objects.all()
+        if self.action in self.object_actions:
+            apps = apps.prefetch_related(None)
+        elif self.action in ('update', 'partial_update'):
+            # связанные данные анкеты после сохранения все равно читаются заново, а баллы пересчитываются
+            apps = apps.prefetch_related(None).select_related('scores')
+        if self.detail:
+            apps = apps.with_current_coefficients()
         return apps
 
+    def get_export_queryset(self):
+        """
+        Возвращает queryset заявок для экспорта с теми же фильтрами, поиском и сортировкой, что и в списке,
+        но без флагов и связанных данных списка, которые не попадают в файл
+        """
+        apps = get_applications_by_master(self.request.user, self.get_master_affiliations(),
+                                          self.get_master_directions(), self.get_master_directions_id(), fields=())
+        return self.filter_queryset(apps)
+
     def get_serializer_class(self):
         if is_slave(self.request.user):
             return self.slave_serializers.get(self.action, self.default_slave_serializer_class)
@@ -127,22 +155,24 @@ class ApplicationViewSet(PermissionPolicyMixin, DataApplicationMixin, viewsets.M
 
     def perform_create(self, serializer):
         application = serializer.save(member=self.request.user.member)
-        update_user_application_scores(pk=application.pk)
+        recompute_scores(application)
 
     def perform_update(self, serializer):
-        serializer.save()
-        update_user_application_scores(pk=self.kwargs['pk'])
+        """Сохраняет заявку и пересчитывает только критерии, на которые повлияли измененные поля."""
+        application = serializer.save()
+        recompute_scores(application, criteria=application.get_criteria_by_fields(application.saved_dirty_fields),
+                         fullness=False)
 
-    @action(detail=False, methods=['get'], url_path='export')
+    @action(detail=False, methods=['get'], url_path='export', renderer_classes=EXPORT_RENDERERS)
     def export_applications_list(self, request):
-        """Сохраняет список заявок в exel файл и возвращает его."""
-        # queryset = self.filter_queryset(self.get_queryset())
-        queryset = self.get_queryset()
-        excel_from_apps = ApplicationExporter(queryset)
-        excel_file = excel_from_apps.add_applications_to_sheet()
-        response = FileResponse(excel_file, content_type='application/xlsx')
-        response['Content-Disposition'] = 'attachment; filename="' + escape_uri_path('Список заявок.xlsx') + '"'
-        return response
+        """
+        Сохраняет список заявок в файл и возвращает его.
+        Формат (xlsx, csv или jsonl) выбирается query параметром format или заголовком Accept, по умолчанию xlsx.
+        """
+        queryset = self.get_export_queryset()
+        exporter = ApplicationExporter(queryset)
+        return exporter.get_response(request.accepted_renderer.format, const.HEADERS_FOR_EXCEL_APP_TABLES,
+                                     exporter.get_application_rows(), 'Список заявок')
 
     @action(detail=True, methods=['get'], url_path='directions')
     def get_chosen_direction_list(self, request, pk=None):
@@ -235,23 +265,45 @@ class EducationViewSet(PermissionPolicyMixin, viewsets.ModelViewSet):
         ]
     }
 
+    # действия, для которых образование загружается вместе с заявкой и остальными ее образованиями
+    object_write_actions = ('update', 'partial_update', 'destroy')
+
+    def get_nested_application_queryset(self):
+        """Заявка для проверок прав и пересчета ее данных после добавления образования"""
+        return Application.objects.select_related('scores', 'member__user', 'commissariat').with_current_coefficients()
+
     def get_queryset(self):
         if getattr(self, 'swagger_fake_view', False):
             # queryset just for schema generation metadata
             return Education.objects.none()
-        return Education.objects.filter(application=self.kwargs['application_pk'])
+        educations = Education.objects.filter(application=self.kwargs['application_pk'])
+        if self.action in self.object_write_actions:
+            educations = educations.select_related('application__scores', 'application__member__user',
+                                                   'application__commissariat', 'application__coefficients') \
+                .annotate(current_coefficients_id=ScoringCoefficients.get_current_id_subquery())
+        return educations
+
+    def get_object(self):
+        """
+        Для изменения и удаления загружает образование одним запросом с заявкой и остальными ее образованиями,
+        по которым после записи пересчитываются данные заявки (см. Application.update_education_data)
+        """
+        if self.action not in self.object_write_actions:
+            return super().get_object()
+        educations = list(self.get_queryset())
+        education = next((education for education in educations if str(education.pk) == self.kwargs['pk']), None)
+        if education is None:
+            raise Http404
+        application = education.application
+        application.current_coefficients_id = education.current_coefficients_id
+        for other in educations:
+            other.application = application
+        application.set_educations(educations)
+        self.check_object_permissions(self.request, education)
+        return education
 
     def perform_create(self, serializer):
-        serializer.save()
-        update_user_application_scores(pk=self.kwargs['application_pk'])
-
-    def perform_destroy(self, instance):
-        instance.delete()
-        update_user_application_scores(pk=self.kwargs['application_pk'])
-
-    def perform_update(self, serializer):
-        serializer.save()
-        update_user_application_scores(pk=self.kwargs['application_pk'])
+        serializer.save(application=get_nested_application(self))
 
 
 class ApplicationNoteViewSet(viewsets.ModelViewSet, DataApplicationMixin):
@@ -467,44 +519,60 @@ class FileViewSet(mixins.CreateModelMixin,
         instance.delete()
 
 
-class WorkingListViewSet(DataApplicationMixin, mixins.ListModelMixin, GenericViewSet):
+class WorkingListViewSet(DataApplicationMixin, ActualFinalScoreMixin, CursorPaginationMixin, SparseFieldsetMixin,
+                         StreamingListMixin, ConditionalGetMixin, mixins.ListModelMixin, GenericViewSet):
     """Рабочий список."""
     permission_classes = [IsMasterPermission, ]
     serializer_class = WorkingListSerializer
 
     pagination_class = PaginationApplication
-    filter_backends = [DjangoFilterBackend, OrderingFilter, SearchFilter]
+    filter_backends = [DjangoFilterBackend, OrderingFilter, ApplicationSearchFilter]
 
     filterset_class = WorkingListFilter
     ordering_fields = ['member__user__last_name', 'birth_place', 'subject']
     ordering = ['member__user__last_name']
-    search_fields = ['member__user__first_name', 'member__user__last_name', 'member__father_name',
-                     'education__university', 'subject', 'education__specialization', 'birth_place']
 
     def get_queryset(self):
-        chosen_affiliation_id = get_chosen_affiliation_id(self.request)
-        chosen_direction = Direction.objects.get(affiliation__id=chosen_affiliation_id)
+        rated_competences = self.get_rated_competences_prefetch()
+        fields = self.get_sparse_fields()
         apps = get_applications_by_master(self.request.user, self.get_master_affiliations(),
-                                          self.get_master_directions(), self.get_master_directions_id())
-        apps = apps.prefetch_related(
-            Prefetch(
-                "app_competence",
-                queryset=ApplicationCompetencies.objects.filter(competence__directions=chosen_direction,
-                                                                level__in=[1, 2, 3]).select_related('competence'),
-                to_attr='rated_competences'
-            ))
+                                          self.get_master_directions(), self.get_master_directions_id(), fields=fields)
+        if fields is not None and 'competences' not in fields:
+            return apps
+        return apps.prefetch_related(rated_competences)
+
+    def get_rated_competences_prefetch(self):
+        """Возвращает Prefetch оцененных компетенций заявок по направлению выбранной принадлежности"""
+        chosen_direction = Direction.objects.get(affiliation__id=get_chosen_affiliation_id(self.request))
+        return Prefetch(
+            "app_competence",
+            queryset=ApplicationCompetencies.objects.filter(competence__directions=chosen_direction,
+                                                            level__in=[1, 2, 3]).select_related('competence'),
+            to_attr='rated_competences'
+        )
+
+    def get_export_queryset(self):
+        """
+        Возвращает queryset заявок рабочего листа для экспорта с теми же фильтрами, поиском и сортировкой,
+        что и в списке, но без флагов и связанных данных списка, кроме компетенций
+        """
+        apps = get_applications_by_master(self.request.user, self.get_master_affiliations(),
+                                          self.get_master_directions(), self.get_master_directions_id(), fields=())
+        return self.filter_queryset(apps).prefetch_related(self.get_rated_competences_prefetch())
 
-        return apps
+    def get_list_values(self, **kwargs):
+        chosen_direction = Direction.objects.get(affiliation__id=get_chosen_affiliation_id(self.request))
+        return super().get_list_values(competences_direction=chosen_direction, **kwargs)
 
-    @action(detail=False, methods=['get'], url_path='export')
+    @action(detail=False, methods=['get'], url_path='export', renderer_classes=EXPORT_RENDERERS)
     def export_working_list(self, request):
-        """Сохраняет рабочей список заявок в exel файл и возвращает его."""
-        queryset = self.filter_queryset(self.get_queryset())
-        excel_from_apps = ApplicationExporter(queryset)
-        excel_file = excel_from_apps.add_work_list_to_sheet()
-        response = FileResponse(excel_file, content_type='application/xlsx')
-        response['Content-Disposition'] = 'attachment; filename="' + escape_uri_path('Рабочий лист.xlsx') + '"'
-        return response
+        """
+        Сохраняет рабочей список заявок в файл и возвращает его.
+        Формат (xlsx, csv или jsonl) выбирается query параметром format или заголовком Accept, по умолчанию xlsx.
+        """
+        exporter = ApplicationExporter(self.get_export_queryset())
+        return exporter.get_response(request.accepted_renderer.format, const.WORK_LIST_HEADERS_FOR_EXCEL,
+                                     exporter.get_work_list_rows(), 'Рабочий лист')
 
 
 class DownloadServiceDocuments(APIView):
@@ -533,6 +601,58 @@ class DownloadServiceDocuments(APIView):
         raise ParseError('Плохой query параметр')
 
 
+class RankingSimulationView(APIView):
+    """
+    Моделирование рейтинга заявок при других весовых коэффициентах итоговой оценки
+    """
+    permission_classes = [IsMasterPermission]
+
+    def post(self, request):
+        """
+        Возвращает рейтинг заявок призыва, пересчитанный по переданным коэффициентам k1..k7, с изменением мест
+        относительно текущего рейтинга. Ничего не сохраняет.
+        body params:
+            k1..k7: предлагаемые весовые коэффициенты
+            draft_year, draft_season: призыв (по умолчанию - текущий)
+            directions: список id направлений (по умолчанию - все)
+        """
+        serializer = RankingSimulationSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        current_year, current_season = get_current_draft_year()
+        applications = Application.objects.filter(draft_year=data.get('draft_year', current_year),
+                                                  draft_season=data.get('draft_season', current_season[0]))
+        if data.get('directions'):
+            applications = applications.filter(directions__in=data['directions']).distinct()
+        coefficients = {f'k{i}': data[f'k{i}'] for i in range(1, 8)}
+        return Response(simulate_ranking(applications, coefficients))
+
+
+class DirectionTopApplications(APIView):
+    """ Лучшие заявки направления по рейтингу призыва """
+    permission_classes = [IsMasterPermission]
+
+    def get(self, request, direction_id):
+        """
+        Возвращает первые n мест рейтинга направления с id=direction_id
+        query params:
+            n: количество мест (по умолчанию - 10)
+            draft_year, draft_season: призыв (по умолчанию - текущий)
+        """
+        current_year, current_season = get_current_draft_year()
+        try:
+            n = int(request.GET.get('n', 10))
+            draft_year = int(request.GET.get('draft_year', current_year))
+            draft_season = int(request.GET.get('draft_season', current_season[0]))
+        except ValueError:
+            raise ParseError('Плохой query параметр')
+        queryset = ApplicationRank.objects.filter(direction_id=direction_id, draft_year=draft_year,
+                                                  draft_season=draft_season) \
+            .select_related('application__member__user').order_by('rank')[:max(n, 0)]
+        serializer = ApplicationRankSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+
 class DirectionsCompetences(APIView):
     """ Компетенции направлений """
     permission_classes = [DoesMasterHaveDirectionPermission]
@@ -557,3 +677,35 @@ class DirectionsCompetences(APIView):
         remove_direction_from_competence_list(direction_id, old_competences_set_id - new_competences_set_id)
         add_direction_to_competence_list(direction_id, new_competences_set_id - old_competences_set_id)
         return Response(status=status.HTTP_201_CREATED)
+
+
+class ExportJobViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, GenericViewSet):
+    """
+    Фоновые выгрузки списка заявок, рабочего листа и служебных документов.
+    params - query параметры соответствующего эндпоинта выгрузки (фильтры, поиск, сортировка, format, doc).
+    Повторная выгрузка с теми же параметрами отдается из готового файла, пока данные заявок не изменятся.
+    """
+    permission_classes = [IsMasterPermission]
+    serializer_class = ExportJobSerializer
+
+    def get_queryset(self):
+        return ExportJob.objects.filter(member=self.request.user.member)
+
+    def create(self, request, *args, **kwargs):
+        """Создает выгрузку: 201 - если файл уже готов (из кеша или без фонового режима), 202 - если выгрузка в очереди"""
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        job = create_export_job(request.user.member, serializer.validated_data['document_type'],
+                                serializer.validated_data.get('params', {}))
+        response_status = status.HTTP_201_CREATED if job.status == ExportJob.DONE else status.HTTP_202_ACCEPTED
+        return Response(self.get_serializer(job).data, status=response_status)
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """Отдает файл выполненной выгрузки"""
+        job = self.get_object()
+        if job.status != ExportJob.DONE:
+            raise ExportJobNotReadyException()
+        response = FileResponse(job.file.open('rb'), content_type=job.content_type)
+        response['Content-Disposition'] = 'attachment; filename="' + escape_uri_path(job.filename) + '"'
+        return response
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import Application, DataVersion
+
+logger = logging.getLogger(__name__)
+
+# критерии, зависящие от образования
+EDUCATION_CRITERIA = ('a2', 'a5')
+
+
+class ScoresWorker:
+    """
+    Пересчет баллов заявок в фоновом потоке.
+    Задачи на одну заявку, поставленные в течение delay секунд после первой, объединяются в один пересчет.
+    Пока пересчет не выполнен, у заявки установлен флаг scores_pending.
+    """
+
+    def __init__(self, delay=None):
+        """
+        :param delay: время ожидания повторных задач на заявку в секундах (по умолчанию - SCORES_RECOMPUTE_DELAY)
+        """
+        self.delay = settings.SCORES_RECOMPUTE_DELAY if delay is None else delay
+        self.jobs = {}  # {id заявки: {'due': время запуска, 'criteria': критерии, 'fullness': пересчет заполненности}}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, application_id, criteria=None, fullness=True):
+        """
+        Отмечает баллы заявки как ожидающие пересчета и после фиксации текущей транзакции ставит пересчет в очередь
+        или объединяет его с уже ожидающим пересчетом, чтобы поток не пересчитал баллы по незафиксированным данным
+        :param application_id: id заявки
+        :param criteria: пересчитываемые критерии (по умолчанию - все)
+        :param fullness: нужно ли пересчитать заполненность анкеты
+        """
+        with self.condition:
+            queued = application_id in self.jobs
+        if not queued:
+            Application.objects.filter(pk=application_id).update(scores_pending=True)
+            DataVersion.bump_on_commit()
+        transaction.on_commit(lambda: self.enqueue(application_id, criteria, fullness))
+
+    def enqueue(self, application_id, criteria=None, fullness=True):
+        """
+        Ставит пересчет баллов заявки в очередь или объединяет его с уже ожидающим пересчетом
+        :param application_id: id заявки
+        :param criteria: пересчитываемые критерии (по умолчанию - все)
+        :param fullness: нужно ли пересчитать заполненность анкеты
+        """
+        with self.condition:
+            job = self.jobs.get(application_id)
+            if job is None:
+                self.jobs[application_id] = {'due': time.monotonic() + self.delay,
+                                             'criteria': None if criteria is None else set(criteria),
+                                             'fullness': fullness}
+                self.condition.notify()
+                return
+            if criteria is None or job['criteria'] is None:
+                job['criteria'] = None
+            else:
+                job['criteria'].update(criteria)
+            job['fullness'] = job['fullness'] or fullness
+
+    def pop_due_jobs(self, force=False):
+        """
+        Забирает из очереди задачи, время ожидания которых истекло
+        :param force: забрать все задачи независимо от времени ожидания
+        :return: словарь {id заявки: задача}
+        """
+        with self.condition:
+            now = time.monotonic()
+            due = {pk: job for pk, job in self.jobs.items() if force or job['due'] <= now}
+            for pk in due:
+                del self.jobs[pk]
+        return due
+
+    def run_pending(self, force=False):
+        """
+        Выполняет задачи, время ожидания которых истекло
+        :param force: выполнить все задачи независимо от времени ожидания
+        :return: количество выполненных задач
+        """
+        due = self.pop_due_jobs(force)
+        for pk, job in due.items():
+            try:
+                application = Application.objects.select_related('scores').get(pk=pk)
+                application.update_scores(criteria=job['criteria'], fullness=job['fullness'])
+            except Application.DoesNotExist:
+                continue
+            except Exception:
+                logger.exception(f'Не удалось пересчитать баллы заявки {pk}')
+                continue
+            with self.condition:
+                # за время пересчета на заявку могла прийти новая задача, тогда баллы все еще ожидают пересчета
+                if pk not in self.jobs:
+                    Application.objects.filter(pk=pk).update(scores_pending=False)
+                    DataVersion.bump()
+        return len(due)
+
+    def run(self):
+        """Цикл фонового потока: ждет истечения времени ожидания ближайшей задачи и выполняет задачи"""
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                timeout = min(job['due'] for job in self.jobs.values()) - time.monotonic()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+            close_old_connections()
+            self.run_pending()
+            close_old_connections()
+
+    def start(self):
+        """Запускает фоновый поток, если он еще не запущен"""
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='scores-worker', daemon=True)
+                self.thread.start()
+
+
+scores_worker = ScoresWorker()
+
+
+def recompute_pending_scores():
+    """
+    Пересчитывает баллы заявок, оставшихся с флагом scores_pending (например, после перезапуска процесса,
+    очередь которого не была выполнена), и снимает флаг
+    :return: количество пересчитанных заявок
+    """
+    count = 0
+    for application in Application.objects.filter(scores_pending=True).select_related('scores').iterator():
+        application.update_scores()
+        Application.objects.filter(pk=application.pk).update(scores_pending=False)
+        count += 1
+    if count:
+        DataVersion.bump()
+    return count
+
+
+def recompute_scores(application, criteria=None, fullness=True, fields=()):
+    """
+    Пересчитывает баллы заявки в запросе или, если включен фоновый пересчет, ставит пересчет в очередь
+    :param application: экземпляр Application
+    :param criteria: пересчитываемые критерии (по умолчанию - все)
+    :param fullness: нужно ли пересчитать заполненность анкеты
+    :param fields: другие отслеживаемые поля заявки, которые сохраняются сразу, если изменились
+    """
+    if not settings.SCORES_BACKGROUND_RECOMPUTE:
+        application.update_scores(criteria=criteria, fullness=fullness, fields=fields)
+        return
+    if fields:
+        application.update_scores(criteria=(), fullness=False, fields=fields)
+    scores_worker.schedule(application.pk, criteria=criteria, fullness=fullness)
+    scores_worker.start()
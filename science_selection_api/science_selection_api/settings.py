@@ -54,6 +54,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'application.middleware.DataVersionMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
 
@@ -191,3 +192,32 @@ LOGGING = {
         },
     }
 }
+
+# Пересчет баллов заявок в фоновом потоке вместо пересчета в запросе (application/workers.py).
+# Задачи на одну заявку, поставленные в течение SCORES_RECOMPUTE_DELAY секунд, объединяются в один пересчет.
+# Очередь хранится в памяти процесса: при запуске нужно выполнить команду recompute_pending_scores,
+# которая пересчитает заявки, оставшиеся с флагом scores_pending после перезапуска.
+SCORES_BACKGROUND_RECOMPUTE = os.getenv('DJANGO_SCORES_BACKGROUND_RECOMPUTE', 'False') == 'True'
+SCORES_RECOMPUTE_DELAY = float(os.getenv('DJANGO_SCORES_RECOMPUTE_DELAY', 1))
+
+# Флаги бронирования, избранного и просмотра в списках заявок мастера читаются из таблицы MasterApplicationState
+# вместо подзапросов к бронированиям. После включения заполните таблицу командой rebuild_master_states.
+MASTER_APPLICATION_STATES = os.getenv('DJANGO_MASTER_APPLICATION_STATES', 'False') == 'True'
+
+# Списки заявок мастера собираются из строк values() без экземпляров моделей и сериализаторов.
+# Вложенные списки без Meta.ordering (бронирования, заметки) отдаются в порядке БД, как и через сериализаторы.
+APPLICATION_LIST_VALUES = os.getenv('DJANGO_APPLICATION_LIST_VALUES', 'False') == 'True'
+
+# Количество заявок в постраничных списках кешируется на APPLICATION_COUNT_CACHE_TIMEOUT секунд для пары
+# (фильтры, пользователь) и сбрасывается при изменении данных (DataVersion). При APPLICATION_APPROXIMATE_COUNT
+# количество не сверяется с версией данных и может отставать от данных не дольше времени кеширования.
+APPLICATION_COUNT_CACHE_TIMEOUT = int(os.getenv('DJANGO_APPLICATION_COUNT_CACHE_TIMEOUT', 60))
+APPLICATION_APPROXIMATE_COUNT = os.getenv('DJANGO_APPLICATION_APPROXIMATE_COUNT', 'False') == 'True'
+
+# Фоновые выгрузки (application/export_jobs.py) при включенном EXPORT_JOBS_BACKGROUND выполняются в пуле
+# из EXPORT_JOBS_WORKERS потоков процесса, принявшего запрос, иначе - в запросе создания выгрузки. Фоновый режим
+# требует долгоживущих процессов приложения: выгрузки в очереди процесса, который перезапущен, остаются в статусе
+# "В очереди". Выгрузки старше EXPORT_RESULTS_MAX_AGE часов удаляются командой cleanup_exports (запускайте по cron).
+EXPORT_JOBS_BACKGROUND = os.getenv('DJANGO_EXPORT_JOBS_BACKGROUND', 'False') == 'True'
+EXPORT_JOBS_WORKERS = int(os.getenv('DJANGO_EXPORT_JOBS_WORKERS', 2))
+EXPORT_RESULTS_MAX_AGE = float(os.getenv('DJANGO_EXPORT_RESULTS_MAX_AGE', 24))
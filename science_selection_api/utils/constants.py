@@ -1,4 +1,6 @@
 import os
+import re
+from pathlib import Path
 
 # диапозон оценок средних баллов
 MINIMUM_SCORE = 2
@@ -70,6 +72,39 @@ SCIENCE_EXPERIENCE_SCORE = 6
 MILITARY_SPORT_ACHIEVEMENTS_SCORE = 4
 SPORT_ACHIEVEMENTS_SCORE = 2
 
+# критерии, которые складываются из баллов за отмеченные поля заявки: {критерий: {поле заявки: балл}}
+CRITERIA_FIELDS_SCORES = {
+    'a1': {'international_articles': INTERNATIONAL_ARTICLES_SCORE, 'patents': PATENTS_SCORE,
+           'vac_articles': VAC_ARTICLES_SCORE, 'innovation_proposals': INNOVATION_PROPOSALS_SCORE,
+           'rinc_articles': RINC_ARTICLES_SCORE, 'evm_register': EVM_REGISTER_SCORE},
+    'a3': {'compliance_prior_direction': COMPLIANCE_PRIOR_DIRECTION_SCORE,
+           'compliance_additional_direction': COMPLIANCE_ADDITIONAL_DIRECTION_SCORE},
+    'a4': {'international_olympics': INTERNATIONAL_OLYMPICS_SCORE, 'president_scholarship': PRESIDENT_SCHOLARSHIP_SCORE,
+           'country_olympics': COUNTRY_OLYMPICS_SCORE, 'government_scholarship': GOVERNMENT_SCHOLARSHIP_SCORE,
+           'military_grants': MILITARY_GRANTS_SCORE, 'region_olympics': REGION_OLYMPICS_SCORE,
+           'city_olympics': CITY_OLYMPICS_SCORE},
+    'a6': {'science_experience': SCIENCE_EXPERIENCE_SCORE, 'opk_experience': OPK_EXPERIENCE_SCORE,
+           'commercial_experience': COMMERCIAL_EXPERIENCE_SCORE},
+    'a7': {'military_sport_achievements': MILITARY_SPORT_ACHIEVEMENTS_SCORE,
+           'sport_achievements': SPORT_ACHIEVEMENTS_SCORE},
+}
+# поля заявки, баллы за которые начисляются в критерии a5 только при оконченной аспирантуре
+POSTGRADUATE_FIELDS_SCORES = {'postgraduate_prior_direction': POSTGRADUATE_PRIOR_DIRECTION_SCORE,
+                              'compliance_additional_direction': POSTGRADUATE_ADDITIONAL_DIRECTION_SCORE}
+# все критерии итогового балла
+SCORE_CRITERIA = ('a1', 'a2', 'a3', 'a4', 'a5', 'a6', 'a7')
+
+# программы образования
+EDUCATION_PROGRAMS = [
+    ('b', 'Бакалавриат'),
+    ('m', 'Магистратура'),
+    ('a', 'Аспирантура'),
+    ('s', 'Специалитет'),
+]
+
+# ширина интервала итоговой оценки в рейтинге направления
+RANK_SCORE_BUCKET_SIZE = 1
+
 # шаблон для заполненности заявки
 DEFAULT_FILED_BLOCKS = {
     'Основные данные': False,
@@ -79,15 +114,23 @@ DEFAULT_FILED_BLOCKS = {
     'Загруженные файлы': False,
 }
 
+# корневая папка проекта, от нее считаются пути к шаблонам
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def get_template_path(env_name):
+    """ Возвращает путь к шаблону из переменной окружения, разделители пути в ней могут быть и / и \\ """
+    return os.path.join(BASE_DIR, *re.split(r'[\\/]', os.environ.get(env_name)))
+
+
 # пути к шаблоннам файлов word, но основе которых генерируются основные документы
-PATH_TO_INTERVIEW_LIST = os.path.join(os.path.abspath(os.curdir), os.environ.get("DJANGO_PATH_TO_INTERVIEW_LIST"))
-PATH_TO_CANDIDATES_LIST = os.path.join(os.path.abspath(os.curdir), os.environ.get("DJANGO_PATH_TO_CANDIDATES_LIST"))
-PATH_TO_RATING_LIST = os.path.join(os.path.abspath(os.curdir), os.environ.get("DJANGO_PATH_TO_RATING_LIST"))
-PATH_TO_EVALUATION_STATEMENT = os.path.join(os.path.abspath(os.curdir),
-                                            os.environ.get("DJANGO_PATH_TO_EVALUATION_STATEMENT"))
+PATH_TO_INTERVIEW_LIST = get_template_path("DJANGO_PATH_TO_INTERVIEW_LIST")
+PATH_TO_CANDIDATES_LIST = get_template_path("DJANGO_PATH_TO_CANDIDATES_LIST")
+PATH_TO_RATING_LIST = get_template_path("DJANGO_PATH_TO_RATING_LIST")
+PATH_TO_EVALUATION_STATEMENT = get_template_path("DJANGO_PATH_TO_EVALUATION_STATEMENT")
 PATH_TO_PSYCHOLOGICAL_TESTS = {
     os.environ.get("DJANGO_NAME_OF_FIRST_PSYCHOLOGICAL_TEST"):
-        os.path.join(os.path.abspath(os.curdir), os.environ.get("DJANGO_PATH_TO_FIRST_PSYCHOLOGICAL_TEST")),
+        get_template_path("DJANGO_PATH_TO_FIRST_PSYCHOLOGICAL_TEST"),
 }
 
 TYPE_SERVICE_DOCUMENT = {
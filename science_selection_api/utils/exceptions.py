@@ -15,7 +15,23 @@ class MasterHasNoDirectionsException(APIException):
     default_code = 'Отсутствуют направления.'
 
 
+class ExportJobNotReadyException(APIException):
+    status_code = 409
+    default_detail = 'Выгрузка еще не выполнена.'
+    default_code = 'Выгрузка не готова.'
+
+
+class NotModifiedException(Exception):
+    """Прерывает обработку запроса готовым ответом 304 Not Modified"""
+
+    def __init__(self, response):
+        super().__init__('Not Modified')
+        self.response = response
+
+
 def custom_exception_handler(exc, context):
+    if isinstance(exc, NotModifiedException):
+        return exc.response
     response = exception_handler(exc, context)
     # print(exc)
     # print(response)